@@ -0,0 +1,162 @@
+"""
+Sampled estimates of screen scores with confidence intervals.
+
+The internal similarity (:func:`cockatoo.screen.internal_similarity`) is the
+mean over cocktails i of the average distance from i to every cocktail, and
+the screen distance (:func:`cockatoo.screen.distance`) is the mean over the
+cocktails of each screen of the distance to the nearest cocktail of the other
+screen. Both are means of per cocktail values, so they are estimated by
+computing those values exactly for a random sample of cocktails (rows).
+
+Rows are drawn without replacement in batches. After each batch the
+confidence interval of the mean is computed from the sample variance (with
+the finite population correction) and sampling stops once its half width is
+below the requested tolerance. If every row ends up being sampled the result
+is exact and the half width is 0.
+
+"""
+import math
+import logging
+import numpy as np
+import scipy.stats
+import cockatoo
+
+logger = logging.getLogger(__name__)
+
+# Rows sampled before the first check of the tolerance
+MIN_SAMPLES = 32
+
+class _RowSampler(object):
+    """
+    Private class drawing the rows of one screen in random order and keeping
+    the values computed for them.
+
+    """
+
+    def __init__(self, n, rng):
+        self.n = n
+        self.order = rng.permutation(n)
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def done(self):
+        return len(self.values) >= self.n
+
+    def next(self, size):
+        start = len(self.values)
+        return self.order[start:start + size]
+
+    def add(self, values):
+        self.values.extend(np.asarray(values, dtype=np.double).tolist())
+
+    def mean(self):
+        return float(np.mean(self.values))
+
+    def variance(self):
+        """
+        :returns: variance of the mean of the sampled values
+        """
+        k = len(self.values)
+        if k >= self.n:
+            return 0.0
+        if k < 2:
+            return float('inf')
+        return float(np.var(self.values, ddof=1)) / k * (1.0 - float(k) / self.n)
+
+def _z(confidence):
+    if not 0 < confidence < 1:
+        raise ValueError('Confidence must be between 0 and 1: %s' % confidence)
+    return float(scipy.stats.norm.ppf(0.5 + confidence / 2.0))
+
+def internal_similarity(s, weights, tolerance=0.005, confidence=0.95, batch_size=64, seed=0):
+    """
+    Estimate the internal similarity of a screen from a sample of cocktails.
+
+    :param screen s: The screen
+    :param array weights: weights
+    :param float tolerance: stop once the confidence interval half width is
+        below this value (default: 0.005)
+    :param float confidence: confidence level of the interval (default: 0.95)
+    :param int batch_size: number of cocktails sampled at a time (default: 64)
+    :param int seed: random seed (default: 0)
+
+    :returns: tuple (score, half_width, samples) with the estimated score, the
+        half width of its confidence interval and the number of cocktails
+        sampled
+    """
+    z = _z(confidence)
+    n = len(s)
+    if n == 0:
+        raise ValueError('Screen %s has no cocktails' % s.name)
+
+    (unique, index, groups) = cockatoo.screen.unique_cocktails(s.cocktails)
+    counts = np.bincount(index, minlength=len(unique)).astype(np.double)
+    (ph, fps, valid) = cockatoo.metric._arrays(unique)
+
+    sampler = _RowSampler(n, np.random.RandomState(seed))
+    while not sampler.done():
+        rows = index[sampler.next(batch_size)]
+        dm = cockatoo.metric._cdist(ph[rows], fps[rows], valid[rows], ph, fps, valid, weights)
+        sampler.add(dm.dot(counts) / n)
+
+        if len(sampler) >= MIN_SAMPLES and z * math.sqrt(sampler.variance()) <= tolerance:
+            break
+
+    half_width = z * math.sqrt(sampler.variance())
+    logger.info("Sampled %s of %s cocktails (half width %s)" % (len(sampler), n, half_width))
+    return (sampler.mean(), half_width, len(sampler))
+
+def distance(screen1, screen2, weights, tolerance=0.005, confidence=0.95, batch_size=64, seed=0):
+    """
+    Estimate the distance between two screens from a sample of cocktails of
+    each screen.
+
+    :param screen screen1: First screen
+    :param screen screen2: Second screen
+    :param array weights: weights
+    :param float tolerance: stop once the confidence interval half width is
+        below this value (default: 0.005)
+    :param float confidence: confidence level of the interval (default: 0.95)
+    :param int batch_size: number of cocktails sampled from each screen at a
+        time (default: 64)
+    :param int seed: random seed (default: 0)
+
+    :returns: tuple (score, half_width, samples) with the estimated score, the
+        half width of its confidence interval and the number of cocktails
+        sampled from both screens
+    """
+    z = _z(confidence)
+    if len(screen1) == 0 or len(screen2) == 0:
+        raise ValueError('Screens must have at least one cocktail')
+
+    (unique1, index1, groups1) = cockatoo.screen.unique_cocktails(screen1.cocktails)
+    (unique2, index2, groups2) = cockatoo.screen.unique_cocktails(screen2.cocktails)
+    (ph, fps, valid) = cockatoo.metric._arrays(unique1 + unique2)
+    cols1 = np.arange(len(unique1))
+    cols2 = np.arange(len(unique1), len(unique1) + len(unique2))
+
+    rng = np.random.RandomState(seed)
+    samplers = [
+        (_RowSampler(len(screen1), rng), index1, cols2),
+        (_RowSampler(len(screen2), rng), index2 + len(unique1), cols1),
+    ]
+
+    def half_width():
+        return z * math.sqrt(sum(sampler.variance() for (sampler, index, cols) in samplers) / 4.0)
+
+    while not all(sampler.done() for (sampler, index, cols) in samplers):
+        for (sampler, index, cols) in samplers:
+            if sampler.done(): continue
+            rows = index[sampler.next(batch_size)]
+            dm = cockatoo.metric._cdist(ph[rows], fps[rows], valid[rows], ph[cols], fps[cols], valid[cols], weights)
+            sampler.add(dm.min(axis=1))
+
+        if all(len(sampler) >= min(MIN_SAMPLES, sampler.n) for (sampler, index, cols) in samplers) and half_width() <= tolerance:
+            break
+
+    score = (samplers[0][0].mean() + samplers[1][0].mean()) / 2.0
+    samples = sum(len(sampler) for (sampler, index, cols) in samplers)
+    logger.info("Sampled %s of %s cocktails (half width %s)" % (samples, len(screen1) + len(screen2), half_width()))
+    return (score, half_width(), samples)
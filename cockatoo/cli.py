@@ -26,14 +26,39 @@ class WeightsParamType(click.ParamType):
 
 WEIGHTS_PARAM = WeightsParamType()
 
+class MemoryParamType(click.ParamType):
+    name = 'memory'
+
+    def convert(self, value, param, ctx):
+        if value is None or len(str(value)) == 0:
+            return None
+
+        try:
+            mem = cockatoo.dmatrix.parse_memory(value)
+            if mem <= 0:
+                self.fail('%s must be > 0' % value, param, ctx)
+            return mem
+        except ValueError:
+            self.fail('%s is not a valid memory size (ex. 512M, 8G)' % value, param, ctx)
+
+MEMORY_PARAM = MemoryParamType()
+
 @click.group()
 @click.option('--verbose', '-v', is_flag=True, default=False, help='Turn on verbose logging')
+@click.option('--fp-radius', default=2, type=click.IntRange(0, None), help='Morgan radius of compound fingerprints')
+@click.option('--fp-length', default=2048, type=click.IntRange(1, None), help='Number of bits compound fingerprints are folded to')
+@click.option('--fp-counts', is_flag=True, default=False, help='Count substructure occurrences in fingerprints instead of setting bits')
+@click.option('--dense', is_flag=True, default=False, help='Compare fingerprints as dense vectors of the folded length')
+@click.option('--metric', default='braycurtis', type=click.Choice(sorted(cockatoo.metric.METRICS)), help='Fingerprint distance metric')
 @click.pass_context
-def cli(ctx, verbose):
+def cli(ctx, verbose, fp_radius, fp_length, fp_counts, dense, metric):
     ctx.obj['VERBOSE'] = verbose
     if verbose:
         logging.getLogger().setLevel(logging.DEBUG)
 
+    cockatoo.screen.set_fingerprint_settings(cockatoo.screen.FingerprintSettings(fp_radius, fp_length, fp_counts, dense))
+    cockatoo.metric.set_metric(metric)
+
 @cli.command()
 @click.pass_context
 def version(ctx):
@@ -42,31 +67,63 @@ def version(ctx):
 
 @cli.command()
 @click.option('--name', '-n', default='screen', help='Name of the screen')
-@click.option('--csvin', '-i', required=True, type=click.File(mode='r'), help='Path to input csv file')
-@click.option('--output', '-o', required=True, type=click.File(mode='w'), help='Path to output file')
+@click.option('--csvin', '-i', required=False, type=click.File(mode='r'), help='Path to input csv file')
+@click.option('--screen', '-j', 'screenin', required=False, help='Path to input screen in JSON or binary format (instead of csv)')
+@click.option('--output', '-o', required=True, type=click.Path(), help='Path to output file')
 @click.option('--summary', '-s', required=False, type=click.Path(), help='Path to compound summary data')
+@click.option('--fingerprints', '-f', is_flag=True, default=False, help='Embed compound and cocktail fingerprints in output')
+@click.option('--format', '-t', 'fmt', type=click.Choice(['json', 'npz']), default=None, help='Output format (default: npz if output ends in .npz otherwise json)')
 @click.pass_context
-def convert(ctx, name, csvin, output, summary):
-    """Convert CSV screen to JSON format"""
-    screen = cockatoo.screen.Screen(name)
-    reader = csv.reader(csvin)
-    for row in reader:
-        # Skip comments
-        if re.search(r'^#', row[0]): continue
-        cocktail = cockatoo.screen._parse_cocktail_csv(row)
-        if cocktail is not None:
-            screen.add_cocktail(cocktail)
+def convert(ctx, name, csvin, screenin, output, summary, fingerprints, fmt):
+    """Convert CSV screen to JSON or binary format"""
+    if csvin is None and screenin is None:
+        raise click.UsageError('Please provide an input csv file or screen')
+
+    if screenin is not None:
+        screen = cockatoo.screen.load(screenin)
+    else:
+        screen = cockatoo.screen._parse_csv_file(name, csvin)
 
     if summary:
         screen._set_summary_stats(summary)
 
-    output.write(screen.json())
+    if output == '-':
+        click.echo(screen.json(fingerprints))
+    else:
+        cockatoo.screen.save(screen, output, fmt, fingerprints)
 
     if ctx.obj['VERBOSE']:
         click.echo("Screen stats:")
         screen.print_stats()
         click.echo("Done converting screen.")
 
+@cli.command('bulk-convert')
+@click.option('--input', '-i', 'inputs', required=True, multiple=True, help='Directory, glob pattern or path of CSV screens (can be repeated)')
+@click.option('--outdir', '-o', required=True, type=click.Path(), help='Output directory')
+@click.option('--summary', '-s', required=False, type=click.Path(), help='Path to compound summary data')
+@click.option('--fingerprints', '-f', is_flag=True, default=False, help='Embed compound and cocktail fingerprints in output')
+@click.option('--format', '-t', 'fmt', type=click.Choice(['json', 'npz']), default='json', help='Output format')
+@click.option('--jobs', '-j', default=None, type=int, help='Number of parallel processes (default: number of cpus)')
+@click.option('--report', '-r', default=None, type=click.Path(), help='Path to write conversion report (default: <outdir>/convert-report.tsv)')
+@click.pass_context
+def bulk_convert(ctx, inputs, outdir, summary, fingerprints, fmt, jobs, report):
+    """Convert a directory or glob of CSV screens"""
+    import cockatoo.convert
+    try:
+        results = cockatoo.convert.bulk_convert(inputs, outdir, fmt, summary, fingerprints, jobs)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    if report is None:
+        report = os.path.join(outdir, 'convert-report.tsv')
+    if not os.path.isdir(os.path.dirname(os.path.abspath(report))):
+        os.makedirs(os.path.dirname(os.path.abspath(report)))
+    cockatoo.convert.write_report(results, report)
+
+    errors = len([r for r in results if r['error'] is not None])
+    warnings = sum(len(r['messages']) for r in results)
+    click.echo("Converted {} of {} screens ({} errors, {} warnings). Report: {}".format(len(results) - errors, len(results), errors, warnings, report))
+
 @cli.command()
 @click.option('--cocktail1', '-1', required=True, help='Path to cocktail1 in JSON format or Xtuition cocktail id to fetch using Api')
 @click.option('--cocktail2', '-2', required=True, help='Path to cocktail2 in JSON format or Xtuition cocktail id to fetch using Api')
@@ -85,28 +142,123 @@ def cdist(ctx, cocktail1, cocktail2, weights):
 @click.option('--screen1', '-1', required=True, help='Path to screen1 in JSON format or Xtuition screen id to fetch using Api')
 @click.option('--screen2', '-2', required=True, help='Path to screen2 in JSON format or Xtuition screen id to fetch using Api')
 @click.option('--weights', '-w', type=WEIGHTS_PARAM, help='weights=1,1')
+@click.option('--approx', is_flag=True, default=False, help='Estimate the distance from a sample of cocktails')
+@click.option('--tolerance', default=0.005, type=float, help='Confidence interval half width to stop sampling at (with --approx)')
+@click.option('--confidence', default=0.95, type=float, help='Confidence level of the interval (with --approx)')
+@click.option('--seed', default=0, type=int, help='Random seed (with --approx)')
+@click.option('--mapping', '-m', default=None, type=click.File(mode='w'), help='Write the nearest well of each cocktail in the other screen to this TSV file (- for stdout)')
 @click.pass_context
-def sdist(ctx, screen1, screen2, weights):
+def sdist(ctx, screen1, screen2, weights, approx, tolerance, confidence, seed, mapping):
     """Compute the distance between 2 screens"""
+    import cockatoo.approx
     s1 = cockatoo.screen.load(screen1)
     s2 = cockatoo.screen.load(screen2)
 
-    click.echo("Computing distance between {} and {}...".format(s1.name, s2.name))
-    score = cockatoo.screen.distance(s1, s2, weights)
-    click.echo("Distance: {}".format(score))
+    # Keep stdout for the mapping if written there
+    err = mapping is not None and mapping.name == '<stdout>'
+    click.echo("Computing distance between {} and {}...".format(s1.name, s2.name), err=err)
+    if approx and mapping is not None:
+        raise click.UsageError('--mapping requires the exact distance (without --approx)')
+
+    if approx:
+        (score, half_width, samples) = cockatoo.approx.distance(s1, s2, weights, tolerance, confidence, seed=seed)
+        click.echo("Distance: {} +/- {} ({:g}% confidence, {} of {} cocktails sampled)".format(score, half_width, confidence*100, samples, len(s1) + len(s2)))
+        return
+
+    if mapping is not None:
+        (score, rows) = cockatoo.screen.distance_mapping(s1, s2, weights)
+        cockatoo.screen.write_mapping(rows, mapping)
+    else:
+        score = cockatoo.screen.distance(s1, s2, weights)
+    click.echo("Distance: {}".format(score), err=err)
+
+@cli.command('sdist-matrix')
+@click.option('--screen', '-s', 'screens', required=True, multiple=True, help='Path to screen or Xtuition screen id (can be repeated)')
+@click.option('--output', '-o', default='-', type=click.File(mode='w'), help='Write the distance matrix to this TSV file (default: stdout)')
+@click.option('--weights', '-w', type=WEIGHTS_PARAM, help='weights=1,1')
+@click.option('--jobs', '-j', default=None, type=int, help='Number of parallel processes (default: number of cpus)')
+@click.option('--loaders', default=4, type=int, help='Number of threads loading screens')
+@click.pass_context
+def sdist_matrix(ctx, screens, output, weights, jobs, loaders):
+    """Compute the distances between all pairs of screens"""
+    import cockatoo.pipeline
+    click.echo("Computing distances between {} screens...".format(len(screens)), err=True)
+    (names, matrix) = cockatoo.pipeline.distance_matrix(screens, weights, loaders, jobs)
+    cockatoo.pipeline.write_distance_matrix(names, matrix, output)
 
 @cli.command()
 @click.option('--screen', '-s', required=True, help='Path to screen in JSON format or Xtuition screen id to fetch using Api')
 @click.option('--weights', '-w', type=WEIGHTS_PARAM, help='weights=1,1')
+@click.option('--approx', is_flag=True, default=False, help='Estimate the score from a sample of cocktails')
+@click.option('--tolerance', default=0.005, type=float, help='Confidence interval half width to stop sampling at (with --approx)')
+@click.option('--confidence', default=0.95, type=float, help='Confidence level of the interval (with --approx)')
+@click.option('--seed', default=0, type=int, help='Random seed (with --approx)')
 @click.pass_context
-def isim(ctx, screen, weights):
+def isim(ctx, screen, weights, approx, tolerance, confidence, seed):
     """Compute the internal similarity score for a screen"""
+    import cockatoo.approx
     s = cockatoo.screen.load(screen)
 
     click.echo("Computing internal similarity for {}...".format(s.name))
+    if approx:
+        (score, half_width, samples) = cockatoo.approx.internal_similarity(s, weights, tolerance, confidence, seed=seed)
+        click.echo("Internal similarity score: {} +/- {} ({:g}% confidence, {} of {} cocktails sampled)".format(score, half_width, confidence*100, samples, len(s)))
+        return
+
     score = cockatoo.screen.internal_similarity(s, weights)
     click.echo("Internal similarity score: {}".format(score))
 
+@cli.command()
+@click.option('--screen', '-s', required=True, help='Path to screen (pool of cocktails) to select from')
+@click.option('--k', '-k', required=True, type=int, help='Number of cocktails to select')
+@click.option('--output', '-o', required=True, type=click.Path(), help='Path to output screen file (JSON or .npz)')
+@click.option('--require', '-r', multiple=True, help='Name of a cocktail which must be selected (can be repeated)')
+@click.option('--name', '-n', default=None, help='Name of the selected screen')
+@click.option('--weights', '-w', type=WEIGHTS_PARAM, help='weights=1,1')
+@click.pass_context
+def select(ctx, screen, k, output, require, name, weights):
+    """Select a maximally diverse subset of a screen"""
+    import cockatoo.diversity
+    s = cockatoo.screen.load(screen)
+
+    click.echo("Selecting {} of {} cocktails from {}...".format(k, len(s), s.name))
+    try:
+        sub = cockatoo.diversity.select(s, k, weights, list(require) if len(require) > 0 else None, name)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    cockatoo.screen.save(sub, output)
+    if ctx.obj['VERBOSE']:
+        click.echo("Internal similarity score: {}".format(cockatoo.screen.internal_similarity(sub, weights)))
+
+@cli.command()
+@click.option('--screen', '-s', required=True, help='Path to screen (library of cocktails) to search')
+@click.option('--query', '-q', required=True, help='Path to screen with the query cocktails')
+@click.option('--index', '-i', default=None, type=click.Path(), help='Path to sketch index of the library. Built and saved if it does not exist')
+@click.option('--k', '-k', default=10, type=int, help='Number of nearest cocktails to report')
+@click.option('--hashes', default=64, type=int, help='Sketch length')
+@click.option('--bands', default=16, type=int, help='Number of LSH bands (more bands increases recall)')
+@click.option('--max-candidates', '-m', default=None, type=int, help='Maximum number of candidates re-ranked per query')
+@click.option('--weights', '-w', type=WEIGHTS_PARAM, help='weights=1,1')
+@click.pass_context
+def search(ctx, screen, query, index, k, hashes, bands, max_candidates, weights):
+    """Approximate search for the nearest cocktails in a large screen"""
+    import cockatoo.sketch
+    library = cockatoo.screen.load(screen)
+    queries = cockatoo.screen.load(query)
+
+    if index is not None and os.path.exists(index):
+        idx = cockatoo.sketch.load(index, library.cocktails)
+    else:
+        idx = cockatoo.sketch.SketchIndex(library.cocktails, hashes, bands)
+        if index is not None:
+            idx.save(index)
+
+    click.echo('\t'.join(['query', 'rank', 'cocktail', 'id', 'distance']))
+    for ck in queries.cocktails:
+        for rank, (i, dist) in enumerate(idx.query(ck, k, weights, max_candidates)):
+            click.echo('\t'.join([ck.name, str(rank + 1), library.cocktails[i].name, str(i), str(dist)]))
+
 @cli.command()
 @click.option('--screen', '-s', required=True, help='Path to screen in JSON format or Xtuition screen id to fetch using Api')
 @click.option('--pdist', '-p', is_flag=True, default=False, help='output pairwise distances')
@@ -117,11 +269,22 @@ def isim(ctx, screen, weights):
 @click.option('--weights', '-w', type=WEIGHTS_PARAM, help='weights=1,1')
 @click.option('--dm', '-x', default=None, type=click.Path(), help='Path to pre-computed distance matrix')
 @click.option('--stats', '-l', is_flag=True, default=False, help='Output cluster statistics')
+@click.option('--dtype', '-t', type=click.Choice(['float64', 'float32', 'uint16']), default='float64', help='Storage type of the distance matrix (uint16 is quantized)')
+@click.option('--max-memory', '-m', type=MEMORY_PARAM, default=None, help='Bound memory used computing distances (ex. 8G). Larger matrices are computed out-of-core into <basename>.pdist')
+@click.option('--nearest', '-e', is_flag=True, default=False, help='Output nearest neighbor of each cocktail')
+@click.option('--medoids', '-M', is_flag=True, default=False, help='Output the medoid, radius and diameter of each cluster')
+@click.option('--pam', is_flag=True, default=False, help='Refine the clusters with k-medoids (implies --medoids)')
+@click.option('--model', '-k', is_flag=True, default=False, help='Save clustering model to <basename>.model.npz for use with assign')
+@click.option('--consensus', default=0, type=int, help='Number of resampled replicates for consensus clustering, written to <basename>.consensus (default: off)')
+@click.option('--well-fraction', default=0.8, type=float, help='Fraction of wells sampled per consensus replicate')
+@click.option('--bit-fraction', default=None, type=float, help='Fraction of fingerprint bit groups sampled per consensus replicate (default: all bits)')
+@click.option('--jobs', '-j', default=None, type=int, help='Number of parallel processes for consensus replicates (default: number of cpus)')
 @click.pass_context
-def hclust(ctx, screen, pdist, dendrogram, newick, basename, cutoff, weights, dm, stats):
+def hclust(ctx, screen, pdist, dendrogram, newick, basename, cutoff, weights, dm, stats, dtype, max_memory, nearest, medoids, pam, model, consensus, well_fraction, bit_fraction, jobs):
     """Perform hierarchical clustering on a screen"""
     try:
         import cockatoo.hclust
+        import cockatoo.consensus
     except Exception as e:
         click.echo('Fatal Error loading hclust. Please install required packages: {}'.format(e))
         return 1
@@ -130,10 +293,214 @@ def hclust(ctx, screen, pdist, dendrogram, newick, basename, cutoff, weights, dm
 
     distanceMatrix = None
     if dm is not None:
-        with open(dm, 'r') as fin:
-            distanceMatrix = np.load(fin)
+        try:
+            distanceMatrix = cockatoo.hclust.load_pdist(dm, mmap=max_memory is not None)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+
+    result = cockatoo.hclust.cluster(s, weights, cutoff, basename, distanceMatrix, pdist, dendrogram, newick, stats, dtype, max_memory, nearest, medoids, pam, model)
+
+    if consensus > 0:
+        try:
+            cr = cockatoo.consensus.run(s, weights, cutoff, consensus, well_fraction, bit_fraction,
+                                        dm=result.dm, reference=result.clusters, processes=jobs)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        cr.write(basename, matrix=pdist)
+        click.echo("Consensus of {} replicates: {} clusters, mean stability {:.4f}".format(
+            consensus, len(set(cr.clusters)), float(cr.stability.mean())))
+
+@cli.command()
+@click.option('--screen', '-s', required=True, help='Path to screen in JSON format or Xtuition screen id to fetch using Api')
+@click.option('--dm', '-x', default=None, type=click.Path(exists=True), help='Path to pre-computed distance matrix')
+@click.option('--clusters', '-c', default=None, type=click.Path(exists=True), help='Cluster assignments of the screen written by hclust (.clusters) to color the plot')
+@click.option('--method', type=click.Choice(['auto', 'classical', 'landmark']), default='auto', help='classical MDS, landmark MDS or auto (landmark MDS for large screens)')
+@click.option('--landmarks', '-L', default=500, type=int, help='Number of landmarks for landmark MDS')
+@click.option('--plot/--no-plot', default=True, help='Write a scatter plot to <basename>.embed.png')
+@click.option('--basename', '-b', default='cockatoo-embed', help='basename for output files')
+@click.option('--weights', '-w', type=WEIGHTS_PARAM, help='weights=1,1')
+@click.pass_context
+def embed(ctx, screen, dm, clusters, method, landmarks, plot, basename, weights):
+    """Compute a 2D layout of the cocktails in a screen"""
+    try:
+        import cockatoo.hclust
+        import cockatoo.embed
+        import cockatoo.hits
+    except Exception as e:
+        click.echo('Fatal Error loading hclust. Please install required packages: {}'.format(e))
+        return 1
+
+    s = cockatoo.screen.load(screen)
+
+    distanceMatrix = None
+    if dm is not None:
+        try:
+            distanceMatrix = cockatoo.hclust.load_pdist(dm, mmap=True)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+        if cockatoo.dmatrix.num_items(distanceMatrix) != len(s):
+            raise click.UsageError('Distance matrix does not match the number of cocktails in the screen')
+
+    labels = None
+    if clusters is not None:
+        labels = cockatoo.hits.load_clusters(clusters, s)
+
+    try:
+        result = cockatoo.embed.embed(s, weights, method, distanceMatrix, landmarks)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    result.write(basename, labels, plot)
+    click.echo("Embedded {} cocktails with {} MDS (variance explained: {:.4f})".format(len(s), result.method, result.explained))
+
+@cli.command()
+@click.option('--screen', '-s', required=True, help='Path to screen in JSON format or Xtuition screen id to fetch using Api')
+@click.option('--hits', '-i', required=True, type=click.Path(exists=True), help='Path to file with the names of the hit cocktails, one per line')
+@click.option('--clusters', '-c', default=None, type=click.Path(exists=True), help='Cluster assignments of the screen written by hclust (.clusters) for hit enrichment')
+@click.option('--cutoff', default=None, type=float, help='Cluster the screen at this percent of max cophenetic distance for hit enrichment (instead of --clusters)')
+@click.option('--library', '-l', multiple=True, help='Path to screen of candidate cocktails to rank by distance to the hits (can be repeated)')
+@click.option('--top', '-k', default=100, type=int, help='Number of untried candidates to report')
+@click.option('--basename', '-b', default='cockatoo-hits', help='basename for output files')
+@click.option('--weights', '-w', type=WEIGHTS_PARAM, help='weights=1,1')
+@click.option('--jobs', '-j', default=1, type=int, help='Number of parallel processes ranking library cocktails (0 for the number of cpus)')
+@click.pass_context
+def hits(ctx, screen, hits, clusters, cutoff, library, top, basename, weights, jobs):
+    """Analyze the proximity of crystal hits in a screen"""
+    if clusters is not None and cutoff is not None:
+        raise click.UsageError('Please provide either --clusters or --cutoff')
+
+    try:
+        import cockatoo.hclust
+        import cockatoo.hits
+    except Exception as e:
+        click.echo('Fatal Error loading hclust. Please install required packages: {}'.format(e))
+        return 1
+
+    s = cockatoo.screen.load(screen)
+    names = cockatoo.hits.load(hits)
+
+    labels = None
+    if clusters is not None:
+        labels = cockatoo.hits.load_clusters(clusters, s)
+    elif cutoff is not None:
+        labels = cockatoo.hclust.run(s, weights, cutoff).clusters
 
-    cockatoo.hclust.cluster(s, weights, cutoff, basename, distanceMatrix, pdist, dendrogram, newick, stats)
+    candidates = [ck for lib in cockatoo.pipeline.load_screens(library) for ck in lib.cocktails]
+
+    click.echo("Analyzing {} hits in {}...".format(len(names), s.name))
+    try:
+        result = cockatoo.hits.analyze(s, names, weights, labels, candidates, top, jobs if jobs > 0 else None)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    result.write(basename)
+
+    others = np.delete(result.distance, result.hits)
+    click.echo("Hits: {} of {} wells. Mean distance of other wells to nearest hit: {:.4f}".format(
+        len(result.hits), len(s), float(others.mean()) if len(others) > 0 else 0.0))
+    if result.enrichment is not None:
+        for (cluster, size, count, expected, fold, pvalue) in result.enrichment[:5]:
+            click.echo("Cluster {}: {} of {} wells are hits (expected {:.2f}, p={:.3g})".format(cluster, count, size, expected, pvalue))
+    if len(candidates) > 0:
+        click.echo("Ranked {} untried candidates in {}.candidates".format(len(result.candidates), basename))
+
+@cli.command()
+@click.option('--model', '-m', required=True, type=click.Path(exists=True), help='Path to clustering model saved with hclust --model')
+@click.option('--screen', '-s', default=None, help='Path to screen with the cocktails to assign')
+@click.option('--cocktail', '-c', default=None, help='Path to cocktail in JSON format or Xtuition cocktail id to assign')
+@click.pass_context
+def assign(ctx, model, screen, cocktail):
+    """Assign cocktails to the clusters of an existing clustering"""
+    import cockatoo.model
+    if screen is None and cocktail is None:
+        raise click.UsageError('Please provide a screen or cocktail to assign')
+
+    try:
+        m = cockatoo.model.load(model)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    if screen is not None:
+        cocktails = cockatoo.screen.load(screen).cocktails
+    else:
+        cocktails = [cockatoo.screen.parse_cocktail(cocktail)]
+
+    click.echo('\t'.join(['cocktail', 'cluster', 'distance', 'medoid', 'novel']))
+    for ck in cocktails:
+        (cl, dist, medoid, novel) = m.assign(ck)
+        click.echo('\t'.join([ck.name, str(cl), str(dist), m.names[medoid], 'yes' if novel else 'no']))
+
+@cli.command()
+@click.option('--screen', '-s', 'screens', required=True, multiple=True, help='Path to screen to query (can be repeated)')
+@click.option('--where', '-w', 'conditions', multiple=True, help='Compound condition, ex. "peg 3350 > 20 % (w/v)" or "hepes" (can be repeated)')
+@click.option('--ph', default=None, help='pH condition, ex. ">7"')
+@click.option('--stats', '-l', is_flag=True, default=False, help='Output compound counts of the matching cocktails instead of the cocktails')
+@click.option('--histogram', default=None, help='Output a concentration histogram of this compound in the matching cocktails')
+@click.option('--unit', default=None, help='Unit of the histogram (default: M)')
+@click.option('--bins', default=10, type=int, help='Number of histogram bins')
+@click.pass_context
+def query(ctx, screens, conditions, ph, stats, histogram, unit, bins):
+    """Find cocktails by compound, concentration and pH"""
+    import cockatoo.query
+    incidence = cockatoo.query.Incidence([cockatoo.screen.load(s) for s in screens])
+    try:
+        mask = incidence.filter(conditions, ph)
+        if histogram is not None:
+            (counts, edges) = incidence.histogram(histogram, bins, unit, mask)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    if histogram is not None:
+        click.echo('\t'.join(['from', 'to', 'count']))
+        for i in range(len(counts)):
+            click.echo('\t'.join([str(edges[i]), str(edges[i+1]), str(counts[i])]))
+    elif stats:
+        counts = incidence.counts(mask)
+        click.echo('\t'.join(['compound', 'count']))
+        for k in np.argsort(-counts, kind='stable'):
+            if counts[k] == 0: break
+            click.echo('\t'.join([incidence.compounds[k], str(counts[k])]))
+    else:
+        click.echo('\t'.join(['screen', 'cocktail', 'id', 'ph', 'components']))
+        for i in np.nonzero(mask)[0]:
+            ck = incidence.cocktails[i]
+            clist = ';'.join(c.name for c in ck.components)
+            click.echo('\t'.join([incidence.screen_names[incidence.screen[i]], ck.name, str(i), str(ck.ph), clist]))
+
+    if ctx.obj['VERBOSE']:
+        click.echo("Matched {} of {} cocktails".format(int(mask.sum()), len(incidence)))
+
+@cli.command()
+@click.option('--screen', '-s', 'screens', required=True, multiple=True, help='Path to screen to preload (can be repeated)')
+@click.option('--summary', '-u', required=False, type=click.Path(exists=True), help='Path to compound summary data used for cocktails in requests')
+@click.option('--model', '-m', 'models', multiple=True, type=click.Path(exists=True), help='Path to clustering model saved with hclust --model (can be repeated)')
+@click.option('--host', default='127.0.0.1', help='Address to listen on')
+@click.option('--port', '-p', default=8765, type=int, help='Port to listen on')
+@click.option('--socket', 'socket_path', default=None, type=click.Path(), help='Listen on a Unix socket instead of a TCP port')
+@click.pass_context
+def serve(ctx, screens, summary, models, host, port, socket_path):
+    """Serve distance queries on preloaded screens as a local JSON API"""
+    import cockatoo.server
+    data = None
+    if summary:
+        data = cockatoo.screen.load_summary(summary)
+
+    loaded = {}
+    for path in models:
+        name = os.path.basename(path)
+        if name.endswith('.model.npz'):
+            name = name[:-len('.model.npz')]
+        try:
+            loaded[name] = cockatoo.model.load(path)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+
+    service = cockatoo.server.Service([cockatoo.screen.load(s) for s in screens], data, loaded)
+    server = cockatoo.server.make_server(service, host, port, socket_path)
+    click.echo("Serving {} screens on {}".format(len(service.screens), socket_path if socket_path else 'http://{}:{}'.format(host, port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 def main():
     logging.basicConfig(
@@ -0,0 +1,302 @@
+"""
+Consensus clustering by resampling wells and fingerprint bits.
+
+Each replicate clusters a random subset of the wells (and optionally of the
+fingerprint bits) with average linkage, cutting the tree at the same percent
+of the max cophenetic distance as :func:`cockatoo.hclust.run`. The fraction
+of the replicates containing two wells in which they were put in the same
+cluster is their co-clustering frequency (consensus). The consensus partition
+clusters 1 - consensus into as many clusters as the full clustering.
+
+Distances are never recomputed per replicate:
+
+- resampling wells slices the rows of the condensed distance matrix of the
+  screen (computed once, or the matrix from hclust)
+- resampling bits uses the reduction of the fingerprint metric (see
+  :meth:`cockatoo.metric.Metric.shared`), which is a sum over the bits. The
+  bits are split into groups and the reduction of every pair of cocktails is
+  precomputed once per group (stored as float32). A replicate adds up the
+  groups it samples and finishes the metric.
+
+Replicates run in parallel worker processes which share the precomputed
+matrices.
+
+"""
+import codecs
+import logging
+import multiprocessing
+import numpy as np
+import scipy.cluster.hierarchy
+import cockatoo
+import cockatoo.hclust
+
+logger = logging.getLogger(__name__)
+
+# Data shared with worker processes
+_shared = None
+
+class _Shared(object):
+    """
+    Private class holding the precomputed matrices used by all replicates.
+
+    """
+
+    def __init__(self, n, cutoff_pct, well_fraction, bit_fraction, weights, dm=None):
+        self.n = n
+        self.cutoff_pct = cutoff_pct
+        self.well_fraction = well_fraction
+        self.bit_fraction = bit_fraction
+        self.weights = weights
+        self.dm = dm
+        self.metric = cockatoo.metric.get_metric().name
+        self.index = None
+        self.ph = None
+        self.valid = None
+        self.groups = []
+        self.norms = None
+
+def _bit_groups(screen, num_groups, seed):
+    """
+    Private function precomputing the reduction of the fingerprint metric for
+    every pair of unique cocktails per group of fingerprint bits.
+
+    :returns: tuple (index, ph, valid, groups, norms) where index maps each
+        cocktail to its unique cocktail, groups is a list of condensed
+        matrices and norms an array (unique cocktails x groups) of the part of
+        the norm of each cocktail in each group (squared for dot metrics so
+        the parts add up)
+    """
+    metric = cockatoo.metric.get_metric()
+    (unique, index, dups) = cockatoo.screen.unique_cocktails(screen.cocktails)
+    (ph, fps, valid) = cockatoo.metric._arrays(unique)
+    m = len(unique)
+    ncols = fps.shape[1]
+    num_groups = max(1, min(num_groups, ncols))
+    assign = np.random.RandomState(seed).permutation(ncols) % num_groups
+
+    logger.info("Precomputing %s fingerprint bit groups..." % num_groups)
+    groups = []
+    norms = np.zeros((m, num_groups), dtype=np.double)
+    for g in range(num_groups):
+        sub = fps[:, np.nonzero(assign == g)[0]]
+        norms[:,g] = metric.norms(sub)
+        if metric.reduction == 'dot':
+            norms[:,g] **= 2
+
+        dm = cockatoo.dmatrix.empty(m, 'float32')
+        for start in range(0, m, cockatoo.metric._BLOCK_SIZE):
+            end = min(m, start + cockatoo.metric._BLOCK_SIZE)
+            block = metric.shared(sub[start:end], sub[start:])
+            for i in range(start, end):
+                k = i*m - (i*(i+1))//2
+                dm[k:k + m - i - 1] = block[i - start, i - start + 1:]
+        groups.append(dm)
+
+    return (index, ph, valid, groups, norms)
+
+def _sample(n, fraction, rng):
+    if fraction >= 1:
+        return np.arange(n)
+    k = min(n, max(2, int(round(fraction * n))))
+    return np.sort(rng.choice(n, k, replace=False))
+
+def _pairs(k):
+    return np.triu_indices(k, 1)
+
+def _replicate_distances(shared, sample, rng):
+    """
+    Private function returning the condensed distance matrix of the sampled
+    wells from the shared matrices.
+
+    """
+    (a, b) = _pairs(len(sample))
+    if shared.dm is not None:
+        idx = cockatoo.dmatrix.condensed_index(shared.n, sample[a], sample[b])
+        return cockatoo.dmatrix.to_float(shared.dm[idx])
+
+    metric = cockatoo.metric.get_metric(shared.metric)
+    num_groups = len(shared.groups)
+    selected = _sample(num_groups, shared.bit_fraction, rng) if num_groups > 1 else np.arange(num_groups)
+
+    m = len(shared.ph)
+    u = shared.index[sample]
+    lo = np.minimum(u[a], u[b])
+    hi = np.maximum(u[a], u[b])
+    same = lo == hi
+    idx = cockatoo.dmatrix.condensed_index(m, lo, np.where(same, lo + 1, hi))
+    idx[same] = 0
+
+    norms = shared.norms[:, selected].sum(axis=1)
+    reduction = np.zeros(len(lo), dtype=np.double)
+    for g in selected:
+        reduction += shared.groups[g][idx]
+    # A cocktail meets an identical copy of itself
+    reduction[same] = norms[lo[same]]
+
+    if metric.reduction == 'dot':
+        norms = np.sqrt(norms)
+    fp = metric._finish(reduction, norms[lo], norms[hi])
+    fp[~(shared.valid[lo] & shared.valid[hi])] = np.nan
+    ph = np.abs(shared.ph[lo] - shared.ph[hi]) / 14.0
+    return cockatoo.metric._combine(ph, fp, shared.weights)
+
+def _init_worker(shared):
+    global _shared
+    _shared = shared
+
+def _replicate(seed):
+    """
+    Private function to cluster one replicate.
+
+    :returns: tuple (sample, labels) of the sampled wells and their clusters
+    """
+    rng = np.random.RandomState(seed)
+    sample = _sample(_shared.n, _shared.well_fraction, rng)
+    dm = _replicate_distances(_shared, sample, rng)
+    Z = cockatoo.hclust.linkage(dm, overwrite=True)
+    cutoff = _shared.cutoff_pct * max(Z[:,2])
+    labels = scipy.cluster.hierarchy.fcluster(Z, t=cutoff, criterion='distance')
+    return (sample, labels)
+
+class ConsensusResult(object):
+    """
+    Result of consensus clustering (see :func:`run`).
+
+    :ivar screen: The clustered screen (:class:`cockatoo.Screen`)
+    :ivar consensus: condensed matrix (float32) of co-clustering frequencies
+    :ivar clusters: consensus cluster label of each cocktail
+    :ivar stability: mean consensus of each cocktail with the other members
+        of its consensus cluster
+    :ivar sampled: number of replicates each cocktail was sampled in
+    :ivar reference: cluster label of each cocktail in the full clustering
+    :ivar replicates: number of replicates
+
+    """
+
+    def __init__(self, screen, consensus, clusters, stability, sampled, reference, replicates):
+        self.screen = screen
+        self.consensus = consensus
+        self.clusters = clusters
+        self.stability = stability
+        self.sampled = sampled
+        self.reference = reference
+        self.replicates = replicates
+
+    def cluster_stability(self):
+        """
+        :returns: list of (cluster, size, stability) tuples sorted by cluster
+            where stability is the mean consensus between the members
+        """
+        result = []
+        for cl, rec in sorted(cockatoo.hclust._cluster_members(self.clusters).items()):
+            result.append((int(cl), len(rec), float(np.mean(self.stability[rec]))))
+        return result
+
+    def write(self, base_name, matrix=False):
+        """
+        Write the consensus clusters and the stability of each cocktail to
+        <base_name>.consensus and optionally the consensus matrix to
+        <base_name>.consensus.npy.
+
+        """
+        logger.info("Writing consensus clusters...")
+        with codecs.open("%s.consensus" % base_name, 'w', 'utf-8') as out:
+            out.write('\t'.join(['cluster', 'cocktail', 'id', 'stability', 'sampled', 'reference_cluster']))
+            out.write('\n')
+            for i, ck in enumerate(self.screen.cocktails):
+                out.write('\t'.join([str(self.clusters[i]), ck.name, str(i), str(self.stability[i]), str(self.sampled[i]), str(self.reference[i])]))
+                out.write("\n")
+
+        if matrix:
+            with open("%s.consensus.npy" % base_name, 'wb') as out:
+                np.save(out, self.consensus)
+
+def run(screen, weights, cutoff_pct, replicates=100, well_fraction=0.8, bit_fraction=None, bit_groups=16, dm=None, reference=None, processes=None, seed=0):
+    """
+    Perform consensus clustering of a screen.
+
+    :param screen screen: The screen (:class:`cockatoo.Screen`)
+    :param array weights: weights
+    :param float cutoff_pct: percent of the max cophenetic distance to use as
+        cutoff in each replicate
+    :param int replicates: number of replicates (default: 100)
+    :param float well_fraction: fraction of wells sampled per replicate
+        (default: 0.8)
+    :param float bit_fraction: fraction of fingerprint bit groups sampled per
+        replicate (default: None, use all bits)
+    :param int bit_groups: number of groups the fingerprint bits are split
+        into for bit resampling (default: 16)
+    :param array dm: pre-computed condensed distance matrix used when not
+        resampling bits (default: compute)
+    :param array reference: cluster labels of the full clustering (default:
+        cluster dm at cutoff_pct)
+    :param int processes: number of worker processes (default: number of cpus)
+    :param int seed: random seed (default: 0)
+
+    :returns: The result (:class:`ConsensusResult`)
+    """
+    global _shared
+
+    n = len(screen)
+    if n < 3:
+        raise ValueError('Screen %s needs at least 3 cocktails for consensus clustering' % screen.name)
+    if not 0 < well_fraction <= 1:
+        raise ValueError('Well fraction must be between 0 and 1: %s' % well_fraction)
+    if bit_fraction is not None and not 0 < bit_fraction <= 1:
+        raise ValueError('Bit fraction must be between 0 and 1: %s' % bit_fraction)
+
+    shared = _Shared(n, cutoff_pct, well_fraction, bit_fraction, weights)
+    if bit_fraction is None:
+        if dm is None:
+            dm = cockatoo.hclust._pdist(screen, weights)
+        shared.dm = dm
+    else:
+        (shared.index, shared.ph, shared.valid, shared.groups, shared.norms) = _bit_groups(screen, bit_groups, seed)
+
+    if reference is None:
+        if dm is None:
+            dm = cockatoo.hclust._pdist(screen, weights)
+        reference = cockatoo.hclust.run(screen, weights, cutoff_pct, dm).clusters
+
+    together = np.zeros(cockatoo.dmatrix.size(n), dtype=np.uint32)
+    same = np.zeros(cockatoo.dmatrix.size(n), dtype=np.uint32)
+    sampled = np.zeros(n, dtype=np.intp)
+
+    logger.info("Clustering %s replicates..." % replicates)
+    seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, size=replicates)
+    _shared = shared
+    pool = None
+    if processes == 1 or replicates <= 1:
+        results = (_replicate(s) for s in seeds)
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, (shared,))
+        results = pool.imap(_replicate, seeds, chunksize=1)
+
+    try:
+        for (sample, labels) in results:
+            (a, b) = _pairs(len(sample))
+            idx = cockatoo.dmatrix.condensed_index(n, sample[a], sample[b])
+            together[idx] += 1
+            same[idx[labels[a] == labels[b]]] += 1
+            sampled[sample] += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _shared = None
+
+    consensus = np.zeros(len(together), dtype=np.float32)
+    np.divide(same, together, out=consensus, where=together > 0)
+
+    logger.info("Clustering consensus matrix...")
+    Z = cockatoo.hclust.linkage((1 - consensus).astype(np.float32), overwrite=True)
+    k = len(set(reference))
+    clusters = list(scipy.cluster.hierarchy.fcluster(Z, t=k, criterion='maxclust'))
+
+    stability = np.ones(n, dtype=np.double)
+    for cl, rec in cockatoo.hclust._cluster_members(clusters).items():
+        if len(rec) < 2: continue
+        (sums, maxes) = cockatoo.hclust._within_sums(consensus, n, np.asarray(rec))
+        stability[rec] = sums / (len(rec) - 1)
+
+    return ConsensusResult(screen, consensus, clusters, stability, sampled, list(reference), replicates)
@@ -0,0 +1,185 @@
+import os
+import glob
+import logging
+import multiprocessing
+import codecs
+import cockatoo
+
+logger = logging.getLogger(__name__)
+
+# Summary data shared with worker processes
+_summary = None
+
+class _MessageCollector(logging.Handler):
+    """
+    Logging handler which collects warnings emitted while converting a screen.
+
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((record.levelname, record.getMessage()))
+
+def _glob_prefix(pattern):
+    """
+    Private function returning the directory of a glob pattern before its
+    first wildcard.
+
+    """
+    parts = []
+    for part in os.path.dirname(pattern).split(os.sep):
+        if glob.has_magic(part): break
+        parts.append(part)
+    return os.sep.join(parts)
+
+def find_csv(inputs):
+    """
+    Find the CSV screen files to convert. Output paths mirror the sub
+    directories below a directory input or the part of a glob pattern before
+    its first wildcard. Files found more than once are converted once.
+
+    :param array inputs: directories (searched recursively for .csv files),
+        glob patterns or file paths
+
+    :returns: list of (path, relative output path without extension) tuples
+
+    :raises ValueError: if two different files map to the same output path
+    """
+    found = []
+    for spec in inputs:
+        if os.path.isdir(spec):
+            for root, dirs, files in os.walk(spec):
+                for f in sorted(files):
+                    if not f.lower().endswith('.csv'): continue
+                    path = os.path.join(root, f)
+                    found.append((path, os.path.splitext(os.path.relpath(path, spec))[0]))
+        else:
+            prefix = _glob_prefix(spec)
+            for path in sorted(glob.glob(spec)):
+                found.append((path, os.path.splitext(os.path.relpath(path, prefix or os.curdir))[0]))
+
+    unique = []
+    seen = set()
+    outputs = {}
+    for (path, rel) in found:
+        if os.path.realpath(path) in seen:
+            logger.warning("Skipping %s found more than once" % path)
+            continue
+        if rel in outputs:
+            raise ValueError('Files %s and %s would both be written to %s' % (outputs[rel], path, rel))
+        seen.add(os.path.realpath(path))
+        outputs[rel] = path
+        unique.append((path, rel))
+
+    return unique
+
+def bulk_convert(inputs, outdir, fmt='json', summary=None, fingerprints=False, processes=None):
+    """
+    Convert many CSV screens in parallel.
+
+    The compound summary data is loaded once and shared by all worker
+    processes. Each screen is named after its file and written to outdir
+    (mirroring the sub directories of directory inputs).
+
+    :param array inputs: directories, glob patterns or paths of CSV files
+    :param str outdir: output directory
+    :param str fmt: output format json or npz (default: json)
+    :param str summary: path to compound summary data (default: None)
+    :param bool fingerprints: Embed compound and cocktail fingerprints (default: False)
+    :param int processes: number of worker processes (default: number of cpus)
+
+    :returns: list of result dicts with keys path, output, cocktails, error
+        and messages (list of (level, message) tuples) in input order
+
+    """
+    global _summary
+
+    files = find_csv(inputs)
+    logger.info("Converting %s screens..." % len(files))
+
+    _summary = None
+    if summary is not None:
+        _summary = cockatoo.screen.load_summary(summary)
+
+    tasks = []
+    for (path, rel) in files:
+        output = os.path.join(outdir, '%s.%s' % (rel, fmt))
+        tasks.append((path, output, fmt, fingerprints))
+
+    if processes == 1 or len(tasks) <= 1:
+        return [_convert(t) for t in tasks]
+
+    pool = multiprocessing.Pool(processes, _init_worker, (_summary,))
+    try:
+        return pool.map(_convert, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def _init_worker(summary):
+    global _summary
+    _summary = summary
+
+def _convert(task):
+    """
+    Private function to convert a single CSV file, collecting any warnings.
+
+    """
+    (path, output, fmt, fingerprints) = task
+    result = {'path': path, 'output': output, 'cocktails': 0, 'error': None, 'messages': []}
+
+    collector = _MessageCollector()
+    log = logging.getLogger('cockatoo')
+    (level, propagate) = (log.level, log.propagate)
+    log.addHandler(collector)
+    log.setLevel(logging.WARNING)
+    log.propagate = False
+    try:
+        name = os.path.splitext(os.path.basename(path))[0]
+        screen = cockatoo.screen.parse_csv(name, path)
+        if _summary is not None:
+            screen._set_summary_data(_summary)
+
+        outdir = os.path.dirname(output)
+        if len(outdir) > 0 and not os.path.isdir(outdir):
+            try:
+                os.makedirs(outdir)
+            except OSError:
+                if not os.path.isdir(outdir): raise
+
+        cockatoo.screen.save(screen, output, fmt, fingerprints)
+        result['cocktails'] = len(screen)
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    finally:
+        log.removeHandler(collector)
+        log.setLevel(level)
+        log.propagate = propagate
+
+    result['messages'] = collector.messages
+    return result
+
+def write_report(results, path):
+    """
+    Write a consolidated TAB delimited report of a bulk conversion. Each file
+    has one status line (OK or ERROR) followed by any warnings.
+
+    :param array results: results returned by :func:`bulk_convert`
+    :param str path: Path to output file
+
+    """
+    with codecs.open(path, 'w', 'utf-8') as out:
+        out.write('\t'.join(['file', 'status', 'cocktails', 'output', 'message']))
+        out.write('\n')
+        for r in results:
+            status = 'OK' if r['error'] is None else 'ERROR'
+            message = '' if r['error'] is None else r['error']
+            output = r['output'] if r['error'] is None else ''
+            out.write('\t'.join([r['path'], status, str(r['cocktails']), output, message]))
+            out.write('\n')
+            for (level, message) in r['messages']:
+                out.write('\t'.join([r['path'], level, '', '', message.replace('\t', ' ').replace('\n', ' ')]))
+                out.write('\n')
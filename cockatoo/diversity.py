@@ -0,0 +1,85 @@
+"""
+Selection of maximally diverse subsets of cocktails for screen design.
+
+"""
+import logging
+import numpy as np
+import cockatoo
+
+logger = logging.getLogger(__name__)
+
+def max_min(cocktails, k, weights=None, required=None):
+    """
+    Greedy max-min (farthest point) diversity selection.
+
+    Cocktails are added one at a time, always choosing the cocktail whose
+    distance to its nearest selected cocktail is largest. The distance of each
+    cocktail to its nearest selected cocktail is updated incrementally, so
+    selecting k cocktails takes O(k*n) distance evaluations.
+
+    :param array cocktails: pool of cocktails
+    :param int k: number of cocktails to select (including required)
+    :param array weights: weights
+    :param array required: indices of cocktails which must be selected
+        (default: None). If given the selection starts from them, otherwise it
+        starts from the cocktail farthest from the first cocktail in the pool.
+
+    :returns: tuple (selected, dist) of the selected indices in selection
+        order and the distance of each to its nearest previously selected
+        cocktail (inf for the first)
+    """
+    n = len(cocktails)
+    required = [] if required is None else list(required)
+    if len(set(required)) < len(required):
+        raise ValueError('Required cocktails must be unique')
+    if k < len(required):
+        raise ValueError('Number of required cocktails (%s) exceeds k (%s)' % (len(required), k))
+    k = min(k, n)
+
+    arrays = cockatoo.metric._row_arrays(cocktails)
+    nearest = np.full(n, np.inf)
+    chosen = np.zeros(n, dtype=bool)
+    selected = []
+    dist = []
+
+    def add(i):
+        selected.append(i)
+        dist.append(float(nearest[i]))
+        chosen[i] = True
+        np.minimum(nearest, cockatoo.metric._row_distances(i, arrays, weights), out=nearest)
+
+    for i in required:
+        add(int(i))
+
+    if len(selected) == 0 and k > 0:
+        first = cockatoo.metric._row_distances(0, arrays, weights)
+        add(int(np.argmax(first)))
+
+    while len(selected) < k:
+        add(int(np.argmax(np.where(chosen, -np.inf, nearest))))
+
+    logger.info("Selected %s of %s cocktails, min distance %s" % (len(selected), n, min(dist[1:]) if len(dist) > 1 else None))
+    return (selected, dist)
+
+def select(screen, k, weights=None, required=None, name=None):
+    """
+    Select a maximally diverse sub-screen.
+
+    :param screen screen: The screen (pool of cocktails)
+    :param int k: size of the sub-screen
+    :param array weights: weights
+    :param array required: names of cocktails which must be included
+    :param str name: Name of the new screen (default: same name)
+
+    :returns: The sub-screen (:class:`cockatoo.Screen`)
+    """
+    idx = None
+    if required is not None:
+        names = dict((ck.name, i) for i, ck in enumerate(screen.cocktails))
+        missing = [r for r in required if r not in names]
+        if len(missing) > 0:
+            raise ValueError('Required cocktails not found in screen: %s' % ', '.join(missing))
+        idx = [names[r] for r in required]
+
+    (selected, dist) = max_min(screen.cocktails, k, weights, idx)
+    return screen.subset(selected, name)
@@ -0,0 +1,286 @@
+"""
+Storage of condensed pairwise distance matrices.
+
+Cocktail distances are always between 0 and 1 so the condensed distance matrix
+(see scipy.spatial.distance.pdist) can be stored with reduced precision:
+
+========  ===============  ===========================================
+dtype     bytes per pair   maximum absolute error
+========  ===============  ===========================================
+float64   8                exact
+float32   4                2**-24 (about 6e-8)
+uint16    2                1/(2*65535) (about 7.6e-6), quantized
+========  ===============  ===========================================
+
+Quantized (uint16) matrices store ``round(d * 65535)``. The helpers in this
+module convert between storage and floating point values one slice at a time
+so a matrix never has to be upcast as a whole.
+
+"""
+import numpy as np
+
+DTYPES = ('float64', 'float32', 'uint16')
+
+QUANT_SCALE = 65535.0
+
+# Number of values converted at a time
+_CHUNK_SIZE = 1 << 22
+
+def size(n):
+    """
+    :returns: the length of the condensed distance matrix for n items
+    """
+    return (n * (n - 1)) // 2
+
+def num_items(dm):
+    """
+    :returns: the number of items of a condensed distance matrix
+    """
+    n = int(np.ceil(np.sqrt(len(dm) * 2)))
+    if size(n) != len(dm):
+        raise ValueError('Invalid condensed distance matrix of length %s' % len(dm))
+    return n
+
+def nbytes(n, dtype='float64'):
+    """
+    :returns: the number of bytes needed to store the condensed distance matrix
+        for n items
+    """
+    return size(n) * np.dtype(dtype).itemsize
+
+def open_memmap(path, n, dtype='float64'):
+    """
+    Create a condensed distance matrix for n items as a memory mapped .npy file
+    on disk. The file can be loaded again with numpy.load (mmap_mode='r').
+
+    """
+    if str(np.dtype(dtype)) not in DTYPES:
+        raise ValueError('Unsupported distance matrix dtype: %s' % dtype)
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(size(n),))
+
+def load(path, mmap=False):
+    """
+    Load a condensed distance matrix saved in .npy format, optionally memory
+    mapped.
+
+    """
+    return np.load(path, mmap_mode='r' if mmap else None, allow_pickle=False)
+
+def parse_memory(value):
+    """
+    Parse a memory size such as 512M, 8G or 1024 (bytes).
+
+    :returns: number of bytes
+    """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    value = str(value).strip().upper().rstrip('B')
+    if len(value) > 0 and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+def is_quantized(dm):
+    return dm.dtype == np.uint16
+
+def empty(n, dtype='float64'):
+    """
+    Allocate a condensed distance matrix for n items in the given storage dtype.
+
+    """
+    if str(np.dtype(dtype)) not in DTYPES:
+        raise ValueError('Unsupported distance matrix dtype: %s' % dtype)
+    return np.zeros(size(n), dtype=dtype)
+
+def to_storage(values, dtype):
+    """
+    Convert distances (between 0 and 1) to the storage dtype.
+
+    """
+    if np.dtype(dtype) == np.uint16:
+        return np.rint(np.clip(values, 0, 1) * QUANT_SCALE).astype(np.uint16)
+    return np.asarray(values, dtype=dtype)
+
+def to_float(values, dtype=np.double):
+    """
+    Convert stored distances to floating point.
+
+    """
+    if values.dtype == np.uint16:
+        return values.astype(dtype) / np.dtype(dtype).type(QUANT_SCALE)
+    return values.astype(dtype, copy=False)
+
+def astype(dm, dtype):
+    """
+    Convert a condensed distance matrix to another storage dtype one chunk at a
+    time.
+
+    """
+    if dm.dtype == np.dtype(dtype):
+        return dm
+
+    out = np.zeros(len(dm), dtype=dtype)
+    for start in range(0, len(dm), _CHUNK_SIZE):
+        end = min(len(dm), start + _CHUNK_SIZE)
+        out[start:end] = to_storage(to_float(dm[start:end]), dtype)
+    return out
+
+def condensed_index(n, i, j):
+    """
+    :returns: the index of the distance between items i < j in the condensed
+        distance matrix (works on arrays)
+    """
+    return i*n - (i*(i+1))//2 + (j - i - 1)
+
+def row(dm, n, i, dtype=np.double):
+    """
+    Extract the distances between item i and all items (including itself).
+
+    :returns: array of length n with floating point distances
+    """
+    out = np.zeros(n, dtype=dtype)
+    if i > 0:
+        j = np.arange(i)
+        out[:i] = to_float(dm[condensed_index(n, j, i)], dtype)
+    start = condensed_index(n, i, i + 1)
+    out[i+1:] = to_float(dm[start:start + n - i - 1], dtype)
+    return out
+
+def squareform(dm, idx=None, dtype=np.float32):
+    """
+    Build a square distance matrix, optionally for a subset of items, one row
+    at a time.
+
+    :param array dm: condensed distance matrix
+    :param array idx: items to include (default: all)
+
+    :returns: square floating point matrix
+    """
+    n = num_items(dm)
+    if idx is None:
+        idx = np.arange(n)
+    idx = np.asarray(idx)
+
+    v = np.zeros((len(idx), len(idx)), dtype=dtype)
+    for k, i in enumerate(idx):
+        v[k] = row(dm, n, i, dtype)[idx]
+    return v
+
+def iter_values(dm, dtype=np.double):
+    """
+    Iterate over the floating point values of a condensed distance matrix in
+    chunks.
+
+    """
+    for start in range(0, len(dm), _CHUNK_SIZE):
+        yield to_float(dm[start:start + _CHUNK_SIZE], dtype)
+
+def pair_values(dm, n, a, b=None, dtype=np.double):
+    """
+    Iterate in chunks over the distances between all pairs of items in a and b,
+    or all pairs i < j within a if b is None.
+
+    """
+    a = np.asarray(a)
+    if b is None:
+        a = np.sort(a)
+        for k in range(len(a) - 1):
+            yield to_float(dm[condensed_index(n, a[k], a[k+1:])], dtype)
+        return
+
+    b = np.asarray(b)
+    rows = max(1, _CHUNK_SIZE // max(1, len(b)))
+    for start in range(0, len(a), rows):
+        i = a[start:start + rows, None]
+        lo = np.minimum(i, b[None,:])
+        hi = np.maximum(i, b[None,:])
+        yield to_float(dm[condensed_index(n, lo, hi)].ravel(), dtype)
+
+def submatrix(dm, n, a, b, dtype=np.double):
+    """
+    Extract the dense block of distances between items a and items b.
+
+    :param array dm: condensed distance matrix
+    :param int n: number of items
+    :param array a: row items
+    :param array b: column items
+
+    :returns: array of shape (len(a), len(b)), 0 where an item meets itself
+    """
+    i = np.asarray(a)[:, None]
+    j = np.asarray(b)[None, :]
+    if len(dm) == 0:
+        return np.zeros((i.shape[0], j.shape[1]), dtype=dtype)
+
+    same = i == j
+    lo = np.minimum(i, j)
+    hi = np.maximum(i, j)
+    hi = np.where(same, lo + 1, hi)
+    idx = condensed_index(n, lo, hi)
+    idx[same] = 0
+    out = to_float(dm[idx], dtype)
+    out[same] = 0
+    return out
+
+def nearest(dm, n=None):
+    """
+    Find the nearest neighbor of each item, reading the condensed distance
+    matrix sequentially one row at a time.
+
+    :returns: tuple (idx, dist) of arrays with the index of and distance to
+        the nearest other item
+    """
+    if n is None:
+        n = num_items(dm)
+
+    dist = np.full(n, np.inf)
+    idx = np.full(n, -1, dtype=np.intp)
+    for i in range(n - 1):
+        start = condensed_index(n, i, i + 1)
+        v = to_float(dm[start:start + n - i - 1])
+
+        j = int(np.argmin(v))
+        if v[j] < dist[i]:
+            dist[i] = v[j]
+            idx[i] = i + 1 + j
+
+        closer = v < dist[i+1:]
+        dist[i+1:][closer] = v[closer]
+        idx[i+1:][closer] = i
+
+    return (idx, dist)
+
+def group_sums(dm, groups, num_groups, n=None):
+    """
+    Sum the distances from each item to the items of each group, reading the
+    condensed distance matrix sequentially one row at a time. Each row
+    (distances from i to the items j > i) updates the sums of i and of every j.
+
+    :param array dm: condensed distance matrix
+    :param array groups: group (0 to num_groups - 1) of each item, or -1 for
+        items not in any group
+    :param int num_groups: number of groups
+
+    :returns: array of shape (n, num_groups) with the sum of the distances
+        from each item to the items of each group
+    """
+    if n is None:
+        n = num_items(dm)
+
+    # Shift groups by one so items not in any group add to a discarded column
+    slot = np.asarray(groups, dtype=np.intp) + 1
+    sums = np.zeros((n, num_groups + 1), dtype=np.double)
+    for i in range(n - 1):
+        start = condensed_index(n, i, i + 1)
+        v = to_float(dm[start:start + n - i - 1])
+        sums[i] += np.bincount(slot[i+1:], weights=v, minlength=num_groups + 1)
+        sums[i+1:, slot[i]] += v
+
+    return sums[:, 1:]
+
+def sample_items(n, max_items):
+    """
+    :returns: evenly spaced item indices (at most max_items) used to downsample
+        a distance matrix for plotting
+    """
+    if n <= max_items:
+        return np.arange(n)
+    return np.linspace(0, n - 1, max_items).astype(np.intp)
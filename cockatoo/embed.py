@@ -0,0 +1,217 @@
+"""
+2D embedding of screens for plotting.
+
+Small screens are embedded with classical multidimensional scaling (MDS) of
+the full distance matrix. Only the top eigenvectors of the double centered
+squared distance matrix are computed (Lanczos iteration, see
+scipy.sparse.linalg.eigsh) so there is no full eigendecomposition.
+
+Large screens are embedded with landmark MDS (de Silva and Tenenbaum, 2004):
+classical MDS of a set of landmark cocktails chosen by greedy max-min
+selection (see :func:`cockatoo.diversity.max_min`), after which every cocktail
+is placed by triangulation from its distances to the landmarks. These are
+computed in blocks so memory is O(n * landmarks / blocks) and the n x n
+distance matrix is never needed.
+
+"""
+import codecs
+import logging
+import numpy as np
+import scipy.sparse.linalg
+import cockatoo
+import cockatoo.diversity
+import cockatoo.hclust
+
+logger = logging.getLogger(__name__)
+
+# Screens with more cocktails are embedded with landmark MDS by default
+CLASSICAL_MAX_ITEMS = 2000
+
+# Default number of landmarks
+DEFAULT_LANDMARKS = 500
+
+METHODS = ('auto', 'classical', 'landmark')
+
+def classical_mds(D, dims=2):
+    """
+    Classical (Torgerson) MDS of a square distance matrix.
+
+    :param array D: square distance matrix
+    :param int dims: number of dimensions (default: 2)
+
+    :returns: tuple (coords, eigenvalues, explained) of the coordinates
+        (n x dims), the top eigenvalues and the fraction of the total variance
+        they explain
+    """
+    D = np.asarray(D, dtype=np.double)
+    n = D.shape[0]
+    B = -0.5 * D * D
+    B -= B.mean(axis=0)[None,:]
+    B -= B.mean(axis=1)[:,None]
+
+    if n <= dims + 1:
+        (vals, vecs) = np.linalg.eigh(B)
+        (vals, vecs) = (vals[::-1][:dims], vecs[:,::-1][:,:dims])
+    else:
+        (vals, vecs) = scipy.sparse.linalg.eigsh(B, k=dims, which='LA')
+        order = np.argsort(vals)[::-1]
+        (vals, vecs) = (vals[order], vecs[:,order])
+
+    vals = np.maximum(vals, 0)
+    coords = np.zeros((n, dims), dtype=np.double)
+    coords[:,:len(vals)] = vecs * np.sqrt(vals)[None,:]
+    trace = float(np.trace(B))
+    explained = float(vals.sum()) / trace if trace > 0 else 0.0
+    return (coords, vals, explained)
+
+def _undefined_as_max(D):
+    D = np.array(D, dtype=np.double)
+    D[np.isnan(D)] = 1.0
+    return D
+
+def landmark_mds(cocktails, landmarks, weights=None, dims=2, dm=None, block_size=None):
+    """
+    Landmark MDS of a list of cocktails.
+
+    :param array cocktails: list of cocktails
+    :param array landmarks: indices of the landmark cocktails
+    :param array weights: weights
+    :param int dims: number of dimensions (default: 2)
+    :param array dm: pre-computed condensed distance matrix of the cocktails
+        (default: compute the distances to the landmarks)
+    :param int block_size: number of cocktails placed at a time
+
+    :returns: tuple (coords, eigenvalues, explained) as in
+        :func:`classical_mds` for the landmarks
+    """
+    n = len(cocktails)
+    landmarks = np.asarray(landmarks, dtype=np.intp)
+    if block_size is None:
+        block_size = cockatoo.metric._BLOCK_SIZE
+
+    arrays = None
+    if dm is None:
+        arrays = cockatoo.metric._arrays(cocktails)
+
+    def to_landmarks(rows):
+        if dm is not None:
+            return _undefined_as_max(cockatoo.dmatrix.submatrix(dm, n, rows, landmarks))
+        (ph, fps, valid) = arrays
+        return _undefined_as_max(cockatoo.metric._cdist(ph[rows], fps[rows], valid[rows], ph[landmarks], fps[landmarks], valid[landmarks], weights))
+
+    D = to_landmarks(landmarks)
+    (Y, vals, explained) = classical_mds(D, dims)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pinv = np.where(vals > 0, 1.0 / vals, 0.0)[None,:] * Y
+    mean_sq = (D * D).mean(axis=0)
+
+    coords = np.zeros((n, dims), dtype=np.double)
+    for start in range(0, n, block_size):
+        rows = np.arange(start, min(n, start + block_size))
+        Dr = to_landmarks(rows)
+        coords[rows] = -0.5 * np.dot(Dr * Dr - mean_sq[None,:], pinv)
+
+    return (coords, vals, explained)
+
+class Embedding(object):
+    """
+    2D embedding of a screen (see :func:`embed`).
+
+    :ivar screen: The screen (:class:`cockatoo.Screen`)
+    :ivar coords: coordinates of each cocktail (n x 2)
+    :ivar method: classical or landmark
+    :ivar landmarks: indices of the landmark cocktails or None
+    :ivar explained: fraction of the variance (of the landmarks) explained
+
+    """
+
+    def __init__(self, screen, coords, method, landmarks=None, explained=None):
+        self.screen = screen
+        self.coords = coords
+        self.method = method
+        self.landmarks = landmarks
+        self.explained = explained
+
+    def write(self, base_name, clusters=None, plot=True):
+        """
+        Write the coordinates to <base_name>.embed and a scatter plot colored
+        by cluster to <base_name>.embed.png.
+
+        :param array clusters: cluster label of each cocktail (None if not
+            assigned) used to color the plot
+        :param bool plot: write the scatter plot (default: True)
+        """
+        landmark = np.zeros(len(self.screen), dtype=bool)
+        if self.landmarks is not None:
+            landmark[self.landmarks] = True
+
+        logger.info("Writing coordinates...")
+        with codecs.open("%s.embed" % base_name, 'w', 'utf-8') as out:
+            out.write('\t'.join(['id', 'cocktail', 'x', 'y', 'cluster', 'landmark']))
+            out.write('\n')
+            for i, ck in enumerate(self.screen.cocktails):
+                cluster = '' if clusters is None or clusters[i] is None else str(clusters[i])
+                out.write('\t'.join([str(i), ck.name, str(self.coords[i,0]), str(self.coords[i,1]), cluster, str(int(landmark[i]))]))
+                out.write('\n')
+
+        if plot:
+            _write_scatter(self.coords, clusters, base_name)
+
+def _write_scatter(coords, clusters, base_name):
+    logger.info("Writing scatter plot...")
+    (plt, mpl, diverging) = cockatoo.hclust._plotting()
+    fname = "%s.embed.png" % base_name
+    plt.clf()
+    fig = plt.figure(figsize=(12,12))
+
+    palette = cockatoo.hclust.DEND_PALETTE
+    colors = ['#BBBBBB'] * len(coords)
+    if clusters is not None:
+        colors = [palette[int(c) % len(palette)] if c is not None else '#BBBBBB' for c in clusters]
+
+    size = max(4, min(40, 20000 // max(1, len(coords))))
+    plt.scatter(coords[:,0], coords[:,1], c=colors, s=size, linewidths=0, alpha=0.8)
+    plt.xticks([])
+    plt.yticks([])
+    plt.tight_layout()
+    fig.savefig(fname)
+    plt.close(fig)
+
+def embed(screen, weights=None, method='auto', dm=None, landmarks=DEFAULT_LANDMARKS, dims=2):
+    """
+    Compute a 2D embedding of a screen.
+
+    :param screen screen: The screen (:class:`cockatoo.Screen`)
+    :param array weights: weights
+    :param str method: classical, landmark or auto (classical for screens of
+        at most :data:`CLASSICAL_MAX_ITEMS` cocktails) (default: auto)
+    :param array dm: pre-computed condensed distance matrix (default: compute)
+    :param int landmarks: number of landmarks for landmark MDS (default: 500)
+    :param int dims: number of dimensions (default: 2)
+
+    :returns: The embedding (:class:`Embedding`)
+    """
+    if method not in METHODS:
+        raise ValueError('Unknown method: %s' % method)
+    n = len(screen)
+    if n < 2:
+        raise ValueError('Screen %s needs at least 2 cocktails to embed' % screen.name)
+
+    if method == 'auto':
+        method = 'classical' if n <= CLASSICAL_MAX_ITEMS or landmarks >= n else 'landmark'
+
+    if method == 'classical':
+        logger.info("Embedding %s cocktails with classical MDS..." % n)
+        if dm is None:
+            dm = cockatoo.hclust._pdist(screen, weights)
+        D = _undefined_as_max(cockatoo.dmatrix.squareform(dm, dtype=np.double))
+        (coords, vals, explained) = classical_mds(D, dims)
+        idx = None
+    else:
+        logger.info("Selecting %s landmarks..." % min(landmarks, n))
+        (idx, dist) = cockatoo.diversity.max_min(screen.cocktails, landmarks, weights)
+        logger.info("Embedding %s cocktails with landmark MDS..." % n)
+        (coords, vals, explained) = landmark_mds(screen.cocktails, idx, weights, dims, dm)
+
+    logger.info("Variance explained: %s" % explained)
+    return Embedding(screen, coords, method, idx, explained)
@@ -1,16 +1,18 @@
-import re,logging,math,json
+import os,re,logging,math,json
 import codecs
+import tempfile
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib as mpl
-from brewer2mpl import diverging
 import scipy.spatial
 import scipy.cluster
+import scipy.cluster.hierarchy
 import cockatoo
-import pprint
+import cockatoo.model
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of cocktails shown in heatmaps. Larger matrices are downsampled.
+HEATMAP_MAX_ITEMS = 2000
+
 DEND_PALETTE = [
                 '#8E0152', '#C51B7D', '#DE77AE', '#F1B6DA', 
                 '#A6DBA0', '#5AAE61', '#1B7837', '#00441B', 
@@ -21,73 +23,511 @@ DEND_PALETTE = [
                 '#FEE08B', '#D9EF8B', '#FDAE61', '#A6D96A', 
                 ]
 
-def _pdist(screen, weights):
+def _pdist(screen, weights, dtype='float64', path=None, max_memory=None):
+    """
+    Compute the pairwise distance matrix of a screen.
+
+    :param str path: compute the matrix out-of-core into a memory mapped .npy
+        file at path (default: in memory)
+    :param int max_memory: bound on the working memory in bytes (default: None)
+    """
     logger.info("Computing pairwise distances...")
-    cocktails = np.array(screen.cocktails)
+    (cocktails, index, groups) = cockatoo.screen.unique_cocktails(screen.cocktails)
+    n = len(screen.cocktails)
     m = len(cocktails)
-    dm = np.zeros((m * (m - 1)) // 2, dtype=np.double)
+    block_size = None
+    if max_memory is not None:
+        block_size = cockatoo.metric.block_size(m, max_memory)
+
+    if len(groups) == 0:
+        out = None if path is None else cockatoo.dmatrix.open_memmap(path, n, dtype)
+        return cockatoo.metric.pdist(cocktails, weights, dtype, out, block_size)
+
+    tmp_path = None
+    out = None
+    if path is not None:
+        tmp_path = path + '.unique.tmp'
+        out = cockatoo.dmatrix.open_memmap(tmp_path, m, dtype)
+    dm = cockatoo.metric.pdist(cocktails, weights, dtype, out, block_size)
+
+    # Distance of a cocktail to an identical copy of itself
+    diag = np.array([cockatoo.metric.distance(c, c, weights) for c in cocktails])
+    full = None if path is None else cockatoo.dmatrix.open_memmap(path, n, dtype)
+    full = _expand_pdist(dm, diag, index, full)
+
+    if tmp_path is not None:
+        del dm, out
+        os.remove(tmp_path)
+
+    return full
+
+def _expand_pdist(dm, diag, index, out=None):
+    """
+    Expand a condensed distance matrix computed over unique cocktails back to
+    the full set of cocktails, one row at a time.
+
+    :param array dm: condensed distance matrix of the unique cocktails
+    :param array diag: distance of each unique cocktail to itself
+    :param array index: maps each cocktail to its unique cocktail
+    :param array out: condensed array to write the result into (default: allocate)
+
+    :returns: The condensed distance matrix over all cocktails
+    """
+    m = len(diag)
+    n = len(index)
+    full = out if out is not None else cockatoo.dmatrix.empty(n, dm.dtype)
     k = 0
-    for i in range(0, m - 1):
-        for j in range(i + 1, m):
-            dm[k] = cockatoo.metric.distance(cocktails[i], cocktails[j], weights)
-            k = k + 1
+    for i in range(0, n - 1):
+        v = cockatoo.dmatrix.row(dm, m, index[i])
+        v[index[i]] = diag[index[i]]
+        full[k:k + n - i - 1] = cockatoo.dmatrix.to_storage(v[index[i + 1:]], full.dtype)
+        k += n - i - 1
 
-    return dm
+    return full
 
 def dumps(dm, cutoff):
-    Z = scipy.cluster.hierarchy.linkage(dm, method='average', metric='euclidean')
+    Z = linkage(dm)
     T = scipy.cluster.hierarchy.to_tree(Z)
     count = [1]
     clusters = {}
     newick = _get_newick(T, "", T.dist, cutoff, count, clusters)
     return newick, clusters
 
-def cluster(screen, weights, cutoff_pct, base_name, dm=None, output_pdist=False, output_dendrogram=False, output_newick=False, stats=False):
+class ClusterResult(object):
+    """
+    Result of the hierarchical clustering of a screen.
+
+    :ivar screen: The clustered screen (:class:`cockatoo.Screen`)
+    :ivar dm: condensed distance matrix (may be memory mapped)
+    :ivar Z: linkage matrix (see scipy.cluster.hierarchy.linkage)
+    :ivar clusters: cluster label of each cocktail
+    :ivar cophenetic: cophenetic correlation coefficient
+    :ivar max_dist: maximum cophenetic distance
+    :ivar cutoff: cophenetic distance cutoff used to form the clusters
+    :ivar weights: weights
+    :ivar stats: dict with clusters, wss, bss and silhouette or None
+    :ivar medoids: list of cluster medoids (see :func:`medoids`) or None
+    :ivar pdist_path: path the distance matrix was computed into or None
+
+    A distance matrix computed into a temporary file by :func:`run` is
+    removed by :meth:`close`, or on leaving a with statement.
+
+    """
+
+    def __init__(self, screen, dm, Z, clusters, cophenetic, cutoff, weights, stats=None, medoids=None, pdist_path=None, temporary=False):
+        self.screen = screen
+        self.dm = dm
+        self.Z = Z
+        self.clusters = clusters
+        self.cophenetic = cophenetic
+        self.max_dist = max(Z[:,2]) if len(Z) > 0 else 0
+        self.cutoff = cutoff
+        self.weights = weights
+        self.stats = stats
+        self.medoids = medoids
+        self.pdist_path = pdist_path
+        self._temporary = temporary
+
+    def close(self):
+        """
+        Remove the temporary file the distance matrix was computed into, if
+        any. The distance matrix is no longer available afterwards.
+        """
+        if self._temporary:
+            self.dm = None
+            os.remove(self.pdist_path)
+            self.pdist_path = None
+            self._temporary = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_medoids(self):
+        """
+        :returns: the cluster medoids, computed on first use (see :func:`medoids`)
+        """
+        if self.medoids is None:
+            self.medoids = medoids(self.dm, self.clusters)
+        return self.medoids
+
+    def representatives(self, name=None):
+        """
+        :returns: sub-screen with the medoid of each cluster (see :func:`representatives`)
+        """
+        if name is None:
+            name = '%s-representatives' % self.screen.name
+        return self.screen.subset([m[1] for m in self.get_medoids()], name)
+
+    def newick(self):
+        """
+        :returns: the dendrogram in newick format with the clusters labeled
+        """
+        return _newick(self.Z, self.cutoff)
+
+    def model(self):
+        """
+        :returns: clustering model for assigning new cocktails (:class:`cockatoo.model.ClusterModel`)
+        """
+        return cockatoo.model.build(self.screen, self.clusters, self.cutoff, self.weights, [m[1] for m in self.get_medoids()])
+
+    def write(self, base_name, pdist=False, dendrogram=False, newick=False, nearest=False, medoids=False, model=False):
+        """
+        Write the clustering results to files named <base_name>.<ext>. The
+        cluster assignments (.clusters) and duplicate cocktail groups
+        (.duplicates) are always written.
+
+        :param str base_name: base name for output files
+        :param bool pdist: write the distance matrix (.pdist) and heatmap
+        :param bool dendrogram: write dendrogram plots
+        :param bool newick: write dendrogram in newick format (.newick)
+        :param bool nearest: write nearest neighbor of each cocktail (.nearest)
+        :param bool medoids: write cluster medoids (.medoids)
+        :param bool model: write clustering model (.model.npz)
+        """
+        if self.pdist_path == "%s.pdist" % base_name:
+            # Computed out-of-core into the output file
+            _write_pdist_settings(self.pdist_path)
+        if pdist:
+            if self.pdist_path != "%s.pdist" % base_name:
+                _write_pdist(self.dm, base_name)
+            _write_heatmap(self.dm, self.cutoff, base_name)
+        if dendrogram:
+            _write_dendrogram_heat(self.dm, self.Z, self.cutoff, self.clusters, base_name)
+            _write_dendrogram(self.dm, self.Z, self.cutoff, base_name)
+        if newick:
+            _write_newick(self.Z, base_name, self.cutoff)
+
+        if nearest:
+            _write_nearest(self.screen, self.dm, base_name)
+
+        _write_clusters(self.screen, self.clusters, base_name)
+        if medoids:
+            _write_medoids(self.screen, self.get_medoids(), base_name)
+        if model:
+            logger.info("Writing clustering model...")
+            self.model().save("%s.model.npz" % base_name)
+
+        (unique, index, groups) = cockatoo.screen.unique_cocktails(self.screen.cocktails)
+        if len(groups) > 0:
+            _write_duplicates(self.screen, groups, base_name)
+
+def run(screen, weights, cutoff_pct, dm=None, stats=False, dtype='float64', max_memory=None, pam=False, pdist_path=None):
+    """
+    Perform average linkage hierarchical clustering on a screen without
+    writing any files.
+
+    :param screen screen: The screen (:class:`cockatoo.Screen`)
+    :param array weights: weights
+    :param float cutoff_pct: percent of the max cophenetic distance to use as cutoff
+    :param array dm: pre-computed distance matrix (default: compute)
+    :param bool stats: compute cluster statistics (default: False)
+    :param str dtype: storage dtype of the distance matrix (default: float64)
+    :param int max_memory: bound on the memory in bytes used computing
+        distances (default: None)
+    :param bool pam: refine the clusters with k-medoids (default: False)
+    :param str pdist_path: path to compute the distance matrix into if it
+        does not fit in max_memory (default: a temporary file, removed by
+        :meth:`ClusterResult.close`)
+
+    :returns: The result (:class:`ClusterResult`)
+    """
+    temporary = False
     if dm is None:
-        dm = _pdist(screen, weights)
+        n = len(screen)
+        if max_memory is not None and cockatoo.dmatrix.nbytes(n, dtype) > max_memory // 2:
+            if pdist_path is None:
+                (fd, pdist_path) = tempfile.mkstemp(suffix='.pdist')
+                os.close(fd)
+                temporary = True
+            logger.info("Computing distance matrix out-of-core in %s" % pdist_path)
+            dm = _pdist(screen, weights, dtype, pdist_path, max_memory)
+        else:
+            pdist_path = None
+            dm = _pdist(screen, weights, dtype, max_memory=max_memory)
+    else:
+        pdist_path = None
 
     logger.info("Performing hierarichal clustering...")
 
-    Z = scipy.cluster.hierarchy.linkage(dm, method='average', metric='euclidean')
-    (c,d) = scipy.cluster.hierarchy.cophenet(Z, Y=dm)
+    Z = linkage(dm)
+    c = cophenetic_correlation(Z, dm)
     logger.info("Cophenetic correlation coefficient: %s" % (str(c)))
     max_dist = max(Z[:,2])
     cutoff = cutoff_pct*max_dist
     logger.info("Max cophenetic distance found: %s" % (str(max_dist)))
     logger.info("Using cophenetic distance cutoff: %s" % (str(cutoff)))
     clusters = list(scipy.cluster.hierarchy.fcluster(Z,t=cutoff, criterion='distance'))
+    meds = None
+    if pam:
+        logger.info("Refining clusters with k-medoids...")
+        labels = sorted(set(clusters))
+        (refined, assign) = refine_medoids(dm, [m[1] for m in medoids(dm, clusters)])
+        clusters = [labels[k] for k in assign]
+        meds = medoids(dm, clusters)
+
+    cluster_stats = None
     if stats:
-        (nclusters, wss,bss) = _compute_sse(screen, clusters, weights)
-        sil_coeff = _compute_silhouette(screen, clusters, weights)
+        (nclusters, wss,bss) = _compute_sse(dm, clusters)
+        sil_coeff = _compute_silhouette(dm, clusters)
         logger.info("Clusters: %s" % str(nclusters))
         logger.info("WSS: %s" % str(wss))
         logger.info("BSS: %s" % str(bss))
         logger.info("Silhouette coeff: %s" % str(sil_coeff))
-
-    if output_pdist:
-        _write_pdist(dm, base_name)
-        _write_heatmap(dm, cutoff, base_name)
-    if output_dendrogram:
-        _write_dendrogram_heat(dm, Z, cutoff, clusters, base_name)
-        _write_dendrogram(dm, Z, cutoff, base_name)
-    if output_newick:
-        _write_newick(Z, base_name, cutoff)
-
-    _write_clusters(screen, clusters, base_name)
+        cluster_stats = {'clusters': nclusters, 'wss': wss, 'bss': bss, 'silhouette': sil_coeff}
+
+    return ClusterResult(screen, dm, Z, clusters, c, cutoff, weights, cluster_stats, meds, pdist_path, temporary)
+
+def cluster(screen, weights, cutoff_pct, base_name, dm=None, output_pdist=False, output_dendrogram=False, output_newick=False, stats=False, dtype='float64', max_memory=None, output_nearest=False, output_medoids=False, pam=False, output_model=False):
+    """
+    Perform hierarchical clustering on a screen and write the results to
+    files named <base_name>.<ext> (see :func:`run` and :meth:`ClusterResult.write`).
+
+    :returns: The result (:class:`ClusterResult`)
+    """
+    result = run(screen, weights, cutoff_pct, dm, stats, dtype, max_memory, pam, "%s.pdist" % base_name)
+    result.write(base_name, output_pdist, output_dendrogram, output_newick, output_nearest, output_medoids or pam, output_model)
+    return result
+
+def linkage(dm, overwrite=False):
+    """
+    Perform average linkage hierarchical clustering on a condensed distance
+    matrix.
+
+    float64 matrices are clustered with scipy.cluster.hierarchy.linkage. For
+    float32 and uint16 matrices this implements the same nearest-neighbor
+    chain algorithm (and returns the same linkage matrix) but updates the
+    distances in place in float32 instead of a float64 copy. Quantized
+    (uint16) matrices are converted to a float32 working copy. Memory mapped
+    matrices (see :func:`load_pdist`) are read into an in-memory working copy
+    so the clustering itself needs memory for one matrix.
+
+    :param array dm: condensed distance matrix (float64, float32 or uint16)
+    :param bool overwrite: use dm as the working copy if it is float32 (its
+        contents are destroyed)
+
+    :returns: The linkage matrix Z (see scipy.cluster.hierarchy.linkage)
+    """
+    if dm.dtype == np.float64:
+        return scipy.cluster.hierarchy.linkage(dm, method='average', metric='euclidean')
+
+    n = cockatoo.dmatrix.num_items(dm)
+    if cockatoo.dmatrix.is_quantized(dm):
+        D = cockatoo.dmatrix.astype(dm, np.float32)
+    elif overwrite:
+        D = dm
+    else:
+        D = np.array(dm)
+
+    Z = np.zeros((n - 1, 4), dtype=np.double)
+    size = np.ones(n, dtype=np.intp)
+    active = np.ones(n, dtype=bool)
+    others = np.arange(n)
+    chain = []
+
+    def row_index(x):
+        lo = np.minimum(others, x)
+        hi = np.maximum(others, x)
+        idx = cockatoo.dmatrix.condensed_index(n, lo, hi)
+        idx[x] = 0
+        return idx
+
+    for k in range(n - 1):
+        if len(chain) == 0:
+            chain.append(int(np.argmax(active)))
+
+        while True:
+            x = chain[-1]
+            idx = row_index(x)
+            row = np.where(active, D[idx], np.inf)
+            row[x] = np.inf
+
+            # Prefer the previous element in the chain as the minimum to avoid
+            # going in cycles
+            if len(chain) > 1:
+                y = chain[-2]
+                current_min = row[y]
+            else:
+                y = -1
+                current_min = np.inf
+
+            i = int(np.argmin(row))
+            if row[i] < current_min:
+                current_min = row[i]
+                y = i
+
+            if len(chain) > 1 and y == chain[-2]:
+                break
+            chain.append(y)
+
+        chain.pop()
+        chain.pop()
+        if x > y:
+            (x, y) = (y, x)
+
+        nx = size[x]
+        ny = size[y]
+        Z[k] = [x, y, current_min, nx + ny]
+
+        # Update distances to the merged cluster (stored in slot y)
+        idx_x = row_index(x)
+        idx_y = row_index(y)
+        active[x] = False
+        size[y] = nx + ny
+        mask = active.copy()
+        mask[y] = False
+        D[idx_y[mask]] = (nx * D[idx_x[mask]] + ny * D[idx_y[mask]]) / (nx + ny)
+
+    # Sort by distance and relabel clusters as in scipy
+    Z = Z[np.argsort(Z[:,2], kind='mergesort')]
+    parent = np.arange(2 * n - 1)
+    csize = np.ones(2 * n - 1, dtype=np.intp)
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            (parent[x], x) = (root, parent[x])
+        return root
+
+    for k in range(n - 1):
+        x_root = find(int(Z[k,0]))
+        y_root = find(int(Z[k,1]))
+        Z[k,0] = min(x_root, y_root)
+        Z[k,1] = max(x_root, y_root)
+        parent[x_root] = parent[y_root] = n + k
+        csize[n + k] = csize[x_root] + csize[y_root]
+        Z[k,3] = csize[n + k]
+
+    return Z
+
+def cophenetic_correlation(Z, dm):
+    """
+    Compute the cophenetic correlation coefficient of a linkage without
+    building the (float64) cophenetic distance matrix.
+
+    All pairs of items joined by the same merge share the same cophenetic
+    distance so the sums needed for the correlation are accumulated one merge
+    at a time.
+
+    :param array Z: linkage matrix
+    :param array dm: condensed distance matrix (float64, float32 or uint16)
+
+    :returns: The cophenetic correlation coefficient
+    """
+    n = cockatoo.dmatrix.num_items(dm)
+    npairs = float(len(dm))
+
+    sum_y = 0.0
+    sum_yy = 0.0
+    for v in cockatoo.dmatrix.iter_values(dm):
+        sum_y += v.sum()
+        sum_yy += np.dot(v, v)
+
+    members = dict((i, np.array([i])) for i in range(n))
+    sum_c = 0.0
+    sum_cc = 0.0
+    sum_cy = 0.0
+    for k in range(n - 1):
+        a = members.pop(int(Z[k,0]))
+        b = members.pop(int(Z[k,1]))
+        h = Z[k,2]
+        pairs = float(len(a)) * len(b)
+        sum_c += h * pairs
+        sum_cc += h * h * pairs
+        for v in cockatoo.dmatrix.pair_values(dm, n, a, b):
+            sum_cy += h * v.sum()
+        members[n + k] = np.concatenate([a, b])
+
+    cov = sum_cy / npairs - (sum_c / npairs) * (sum_y / npairs)
+    var_c = sum_cc / npairs - (sum_c / npairs) ** 2
+    var_y = sum_yy / npairs - (sum_y / npairs) ** 2
+    if var_c <= 0 or var_y <= 0:
+        return 0.0
+
+    return cov / math.sqrt(var_c * var_y)
 
 def _write_pdist(dm, base_name):
     logger.info("Serializing pair wise distance matrix...")
     fname = "%s.pdist" % base_name
-    with open(fname, 'w') as out:
+    with open(fname, 'wb') as out:
         np.save(out, dm)
+    _write_pdist_settings(fname)
+
+def _write_pdist_settings(path):
+    """
+    Private function recording the fingerprint version and metric a distance
+    matrix was computed with in <path>.json.
+
+    """
+    settings = {
+        'fingerprint_version': cockatoo.screen.FINGERPRINT_VERSION,
+        'metric': cockatoo.metric.get_metric().name,
+    }
+    with codecs.open("%s.json" % path, 'w', 'utf-8') as out:
+        json.dump(settings, out)
+
+def load_pdist(path, mmap=False):
+    """
+    Load a distance matrix written with the pdist option. The storage dtype
+    (float64, float32 or quantized uint16) is preserved. The fingerprint
+    version and metric recorded in <path>.json must match the current
+    settings (files without it are loaded with a warning).
+
+    :param bool mmap: memory map the matrix instead of reading it
+
+    :raises ValueError: if the matrix was computed with other fingerprint
+        settings or another metric
+    """
+    settings_path = "%s.json" % path
+    if not os.path.exists(settings_path):
+        logger.warning('No fingerprint settings recorded for %s, assuming the current settings' % path)
+    else:
+        with codecs.open(settings_path, 'r', 'utf-8') as fh:
+            settings = json.load(fh)
+        version = settings.get('fingerprint_version')
+        if version != cockatoo.screen.FINGERPRINT_VERSION:
+            raise ValueError('Distance matrix computed with fingerprint version %s (expected %s)' % (version, cockatoo.screen.FINGERPRINT_VERSION))
+        metric = settings.get('metric')
+        if metric != cockatoo.metric.get_metric().name:
+            raise ValueError('Distance matrix computed with metric %s (expected %s)' % (metric, cockatoo.metric.get_metric().name))
+
+    return cockatoo.dmatrix.load(path, mmap)
+
+def _write_nearest(screen, dm, base_name):
+    logger.info("Writing nearest neighbors...")
+    fname = "%s.nearest" % base_name
+    (idx, dist) = cockatoo.dmatrix.nearest(dm, len(screen))
+    with codecs.open(fname, 'w', 'utf-8') as out:
+        out.write('\t'.join(['id', 'cocktail', 'nearest_id', 'nearest', 'distance']))
+        out.write('\n')
+        for i in range(len(screen)):
+            if idx[i] < 0: continue
+            out.write('\t'.join([str(i), screen.cocktails[i].name, str(idx[i]), screen.cocktails[idx[i]].name, str(dist[i])]))
+            out.write("\n")
+
+def _plotting():
+    """
+    Private function to import matplotlib only when plots are written.
+
+    """
+    import matplotlib.pyplot as plt
+    import matplotlib as mpl
+    from brewer2mpl import diverging
+    return (plt, mpl, diverging)
 
 def _write_heatmap(dm, cutoff, base_name):
     logger.info("Writing heatmap...")
+    (plt, mpl, diverging) = _plotting()
     fname = "%s.heatmap.png" % base_name
     mpl.rcParams.update({'font.size': 22})
     plt.clf()
     fig = plt.figure(figsize=(12,12))
-    v = scipy.spatial.distance.squareform(dm)
+    n = cockatoo.dmatrix.num_items(dm)
+    v = cockatoo.dmatrix.squareform(dm, cockatoo.dmatrix.sample_items(n, HEATMAP_MAX_ITEMS))
 
     (n,m) = v.shape
     plt.pcolormesh(v, cmap=diverging.RdBu['max'].get_mpl_colormap())
@@ -101,6 +541,7 @@ def _write_heatmap(dm, cutoff, base_name):
 
 def _write_dendrogram_heat(dm, Z, cutoff, clusters, base_name):
     logger.info("Writing dendrogram...")
+    (plt, mpl, diverging) = _plotting()
     fname = "%s.dendrogram-heatmap.png" % base_name
     plt.clf()
 
@@ -155,10 +596,9 @@ def _write_dendrogram_heat(dm, Z, cutoff, clusters, base_name):
 
     heat_axis = fig.add_axes((heat_x, heat_y, heat_w, heat_h))
 
-    v = scipy.spatial.distance.squareform(dm)
-    idx = ddata['leaves']
-    v = v[:,idx]
-    v = v[idx,:]
+    leaves = np.asarray(ddata['leaves'])
+    leaves = leaves[cockatoo.dmatrix.sample_items(len(leaves), HEATMAP_MAX_ITEMS)]
+    v = cockatoo.dmatrix.squareform(dm, leaves)
     im = heat_axis.matshow(v, aspect='auto', origin='lower', cmap=heat_cmap, norm=norm)
     heat_axis.set_xticks([])
     heat_axis.set_yticks([])
@@ -172,6 +612,7 @@ def _write_dendrogram_heat(dm, Z, cutoff, clusters, base_name):
 
 def _write_dendrogram(dm, Z, cutoff, base_name):
     logger.info("Writing dendrogram...")
+    (plt, mpl, diverging) = _plotting()
     fname = "%s.dendrogram.png" % base_name
     scipy.cluster.hierarchy.set_link_color_palette(DEND_PALETTE)
 
@@ -207,14 +648,17 @@ def _get_newick(node, newick, parentdist, cutoff, count, clusters):
         newick = "(%s" % (newick)
         return newick
 
-def _write_newick(Z, base_name, cutoff):
-    logger.info("Writing newick...")
-    fname = "%s.newick" % base_name
+def _newick(Z, cutoff):
     T = scipy.cluster.hierarchy.to_tree(Z)
     count = [1]
     clusters = {}
-    print("ROOT: %.2f" % (T.dist))
-    newick = _get_newick(T, "", T.dist, cutoff, count, clusters)
+    logger.info("Root distance: %.2f" % (T.dist))
+    return _get_newick(T, "", T.dist, cutoff, count, clusters)
+
+def _write_newick(Z, base_name, cutoff):
+    logger.info("Writing newick...")
+    fname = "%s.newick" % base_name
+    newick = _newick(Z, cutoff)
     with codecs.open(fname, 'w', 'utf-8') as out:
         out.write(newick)
 
@@ -229,35 +673,159 @@ def _write_clusters(screen, clusters, base_name):
             out.write('\t'.join([str(v), screen.cocktails[i].name, str(i), clist]))
             out.write("\n")
 
-def _compute_sse(screen, clusters, weights):
+def _write_duplicates(screen, groups, base_name):
+    logger.info("Writing duplicate cocktail groups...")
+    fname = "%s.duplicates" % base_name
+    with codecs.open(fname, 'w', 'utf-8') as out:
+        out.write('\t'.join(['group', 'cocktail', 'id']))
+        out.write('\n')
+        for g,members in enumerate(groups):
+            for i in members:
+                out.write('\t'.join([str(g+1), screen.cocktails[i].name, str(i)]))
+                out.write("\n")
+
+def _cluster_members(clusters):
     idx_map = {}
     for i,v in enumerate(clusters):
         idx_map[v] = idx_map.get(v, [])
         idx_map[v].append(i)
+    return idx_map
+
+def _within_sums(dm, n, rec):
+    """
+    Private function computing, for each member of a cluster, the sum of and
+    maximum distance to the other members, a block of rows at a time.
+
+    """
+    m = len(rec)
+    sums = np.zeros(m, dtype=np.double)
+    maxes = np.zeros(m, dtype=np.double)
+    rows = max(1, cockatoo.dmatrix._CHUNK_SIZE // max(1, m))
+    for start in range(0, m, rows):
+        block = cockatoo.dmatrix.submatrix(dm, n, rec[start:start + rows], rec)
+        sums[start:start + rows] = block.sum(axis=1)
+        maxes[start:start + rows] = block.max(axis=1)
+    return (sums, maxes)
+
+def medoids(dm, clusters):
+    """
+    Find the medoid of each cluster, the member with the smallest sum of
+    distances to the other members.
+
+    :param array dm: condensed distance matrix
+    :param array clusters: cluster label of each cocktail
+
+    :returns: list of (cluster, medoid, size, radius, diameter, mean) tuples
+        sorted by cluster where radius is the maximum and mean the average
+        distance from the medoid to the members, and diameter is the maximum
+        distance between members
+    """
+    n = len(clusters)
+    result = []
+    for cl, rec in sorted(_cluster_members(clusters).items()):
+        rec = np.asarray(rec)
+        (sums, maxes) = _within_sums(dm, n, rec)
+        j = int(np.argmin(sums))
+        mean = sums[j] / (len(rec) - 1) if len(rec) > 1 else 0.0
+        result.append((cl, int(rec[j]), len(rec), float(maxes[j]), float(maxes.max()), float(mean)))
+
+    return result
+
+def refine_medoids(dm, medoid_idx, max_iter=20):
+    """
+    Refine medoids with k-medoids (alternating assignment and medoid update)
+    starting from the given medoids, for example the hierarchical cluster
+    medoids. Each iteration reads the distance matrix sequentially twice (see
+    :func:`cockatoo.dmatrix.group_sums`): once to assign cocktails to their
+    nearest medoid and once for the within cluster distances to update the
+    medoids.
+
+    :param array dm: condensed distance matrix
+    :param array medoid_idx: initial medoids
+    :param int max_iter: maximum number of iterations (default: 20)
+
+    :returns: tuple (medoids, labels) of the refined medoids and the index of
+        the medoid each cocktail is assigned to
+    """
+    n = cockatoo.dmatrix.num_items(dm)
+    current = np.array(medoid_idx, dtype=np.intp)
+    k = len(current)
+    labels = None
+    for it in range(max_iter):
+        groups = np.full(n, -1, dtype=np.intp)
+        groups[current] = np.arange(k)
+        dist = cockatoo.dmatrix.group_sums(dm, groups, k, n)
+        dist[current, np.arange(k)] = -1
+        labels = np.argmin(dist, axis=1)
+
+        sums = cockatoo.dmatrix.group_sums(dm, labels, k, n)
+        updated = current.copy()
+        for c in range(k):
+            rec = np.nonzero(labels == c)[0]
+            updated[c] = rec[np.argmin(sums[rec, c])]
+
+        if np.array_equal(updated, current):
+            break
+        current = updated
+        logger.debug("k-medoids iteration %s" % (it + 1))
+
+    return (current, labels)
+
+def representatives(screen, dm, clusters, name=None):
+    """
+    Build a representative sub-screen with the medoid of each cluster.
+
+    :param screen screen: The screen (:class:`cockatoo.Screen`)
+    :param array dm: condensed distance matrix of the screen
+    :param array clusters: cluster label of each cocktail
+    :param str name: Name of the new screen (default: <screen name>-representatives)
+
+    :returns: The sub-screen (:class:`cockatoo.Screen`)
+    """
+    if name is None:
+        name = '%s-representatives' % screen.name
+    return screen.subset([m[1] for m in medoids(dm, clusters)], name)
+
+def _write_medoids(screen, meds, base_name):
+    logger.info("Writing cluster medoids...")
+    fname = "%s.medoids" % base_name
+    with codecs.open(fname, 'w', 'utf-8') as out:
+        out.write('\t'.join(['cluster', 'size', 'cocktail', 'id', 'radius', 'diameter', 'mean']))
+        out.write('\n')
+        for (cl, i, size, radius, diameter, mean) in meds:
+            out.write('\t'.join([str(cl), str(size), screen.cocktails[i].name, str(i), str(radius), str(diameter), str(mean)]))
+            out.write("\n")
+
+def _compute_sse(dm, clusters):
+    """
+    Compute the within (WSS) and between (BSS) cluster sum of squares of the
+    pairwise distances, reading the distance matrix one chunk at a time.
+
+    """
+    n = len(clusters)
+    idx_map = _cluster_members(clusters)
 
     wss = 0
     bss = 0
     means = {}
-    for cl, rec in idx_map.iteritems():
+    for cl, rec in idx_map.items():
         m = len(rec)
         if m > 1:
-            dm = np.zeros((m * (m - 1)) // 2, dtype=np.double)
             k = 0
-            for i in xrange(0, m - 1):
-                for j in xrange(i + 1, m):
-                    i_idx = rec[i]
-                    j_idx = rec[j]
-                    dm[k] = cockatoo.metric.distance(screen.cocktails[i_idx], screen.cocktails[j_idx], weights=weights)
-                    k = k + 1
-
-            mean = dm.mean()
+            dsum = 0.0
+            dsum_sq = 0.0
+            for v in cockatoo.dmatrix.pair_values(dm, n, rec):
+                k += len(v)
+                dsum += v.sum()
+                dsum_sq += np.dot(v, v)
+
+            mean = dsum / k
             means[cl] = mean
-            for i in xrange(0, k):
-                wss += math.pow(dm[i] - mean, 2)
+            wss += max(0.0, dsum_sq - k * mean * mean)
 
-    mean_arr = np.array(means.values())
-    mean = mean_arr.mean()
-    for cl, rec in idx_map.iteritems():
+    mean_arr = np.array(list(means.values()))
+    mean = mean_arr.mean() if len(mean_arr) > 0 else 0
+    for cl, rec in idx_map.items():
         m = len(rec)
         if cl in means:
             c_mean = means[cl]
@@ -265,41 +833,33 @@ def _compute_sse(screen, clusters, weights):
 
     return (len(idx_map), wss, bss)
 
-def _compute_silhouette(screen, clusters, weights):
-    idx_map = {}
-    for i,v in enumerate(clusters):
-        idx_map[v] = idx_map.get(v, [])
-        idx_map[v].append(i)
+def _compute_silhouette(dm, clusters):
+    """
+    Compute the mean silhouette coefficient, reading the distance matrix
+    sequentially once (see :func:`cockatoo.dmatrix.group_sums`).
+
+    """
+    n = len(clusters)
+    (labels, index) = np.unique(np.asarray(clusters), return_inverse=True)
+    if len(labels) < 2:
+        return 0.0
+
+    counts = np.bincount(index).astype(np.double)
+    cluster_sums = cockatoo.dmatrix.group_sums(dm, index, len(labels), n)
+    S = np.zeros(n, dtype=np.double)
+    for i in range(n):
+        v = index[i]
+        sums = cluster_sums[i]
 
-    S = np.zeros(len(clusters), dtype=np.double)
-    k = 0
-    for i,v in enumerate(clusters):
         # a(i) = average distance within cluster
-        a_i = _average_dist(screen, i, idx_map[v], weights)
+        a_i = sums[v] / (counts[v] - 1) if counts[v] > 1 else 0
 
         # b(i) = average distance outside cluster
-        outside_dists = []
-        for vv in idx_map:
-            if v == vv: continue
-            outside_dists.append(_average_dist(screen, i, idx_map[vv], weights))
-        
-        b = np.array(outside_dists)
+        b = sums / counts
+        b[v] = np.inf
         b_i = b.min()
 
-        S[k] = float(b_i-a_i)/max(a_i, b_i)
-        k += 1
+        if max(a_i, b_i) > 0:
+            S[i] = float(b_i-a_i)/max(a_i, b_i)
 
     return S.mean()
-
-
-def _average_dist(screen, i, idx, weights):
-    dists = []
-    for x in idx:
-        if x != i:
-            dists.append(cockatoo.metric.distance(screen.cocktails[i], screen.cocktails[x], weights=weights))
-
-    if len(dists) > 0:
-        d = np.array(dists)
-        return d.mean()
-
-    return 0
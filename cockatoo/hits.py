@@ -0,0 +1,271 @@
+"""
+Proximity analysis of crystal hits in a screen.
+
+Given the wells of a screen which produced crystals (hits), this module
+computes in batched passes:
+
+- the distance from every well to its nearest hit
+- the enrichment of hits in each cluster of the screen (see
+  :mod:`cockatoo.hclust`) with a hypergeometric p-value
+- a ranking of untried cocktails from a library (cocktails whose contents do
+  not occur in the screen) by their distance to the nearest hit
+
+Hit lists are text files with one cocktail name per line (see
+``data/X000009786-crystals.txt``).
+
+"""
+import codecs
+import logging
+import numpy as np
+import scipy.stats
+import cockatoo
+import cockatoo.pipeline
+
+logger = logging.getLogger(__name__)
+
+def load(path):
+    """
+    Load a hit list.
+
+    :param str path: Path to file with one cocktail name per line, lines
+        starting with # are ignored
+
+    :returns: list of cocktail names
+    """
+    names = []
+    with codecs.open(path, 'r', 'utf-8') as fh:
+        for line in fh:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'): continue
+            names.append(line)
+    return names
+
+def hit_indices(screen, names):
+    """
+    Find the wells of a screen in a hit list. Unknown names are logged and
+    ignored.
+
+    :returns: sorted array of well indices
+    """
+    index = dict((ck.name, i) for i, ck in enumerate(screen.cocktails))
+    hits = set()
+    for name in names:
+        if name not in index:
+            logger.warning("Hit %s not found in screen %s" % (name, screen.name))
+            continue
+        hits.add(index[name])
+    return np.array(sorted(hits), dtype=np.intp)
+
+def load_clusters(path, screen):
+    """
+    Load the cluster assignments written by hclust (.clusters) for a screen.
+
+    :returns: list of cluster labels, one per well (None if not assigned)
+    """
+    index = dict((ck.name, i) for i, ck in enumerate(screen.cocktails))
+    clusters = [None] * len(screen)
+    with codecs.open(path, 'r', 'utf-8') as fh:
+        header = fh.readline().rstrip('\n').split('\t')
+        (col_cluster, col_name) = (header.index('cluster'), header.index('cocktail'))
+        for line in fh:
+            row = line.rstrip('\n').split('\t')
+            if len(row) <= max(col_cluster, col_name): continue
+            if row[col_name] in index:
+                clusters[index[row[col_name]]] = int(row[col_cluster])
+
+    missing = clusters.count(None)
+    if missing > 0:
+        logger.warning("%s cocktails of screen %s have no cluster in %s" % (missing, screen.name, path))
+    return clusters
+
+def nearest(cocktails, hits, weights=None, block_size=None):
+    """
+    Compute the distance from each cocktail to the nearest hit cocktail, in
+    blocks of rows of the cocktails x hits distance matrix.
+
+    :param array cocktails: list of cocktails
+    :param array hits: list of hit cocktails
+    :param array weights: weights
+    :param int block_size: number of cocktails compared at a time
+
+    :returns: tuple (idx, dist) of arrays with the index into hits of and
+        the distance to the nearest hit
+    """
+    n = len(cocktails)
+    idx = np.full(n, -1, dtype=np.intp)
+    dist = np.full(n, np.inf)
+    if n == 0 or len(hits) == 0:
+        return (idx, dist)
+
+    (ph, fps, valid) = cockatoo.metric._arrays(list(hits) + list(cocktails))
+    h = len(hits)
+    if block_size is None:
+        block_size = cockatoo.metric._BLOCK_SIZE
+    for start in range(0, n, block_size):
+        end = min(n, start + block_size)
+        rows = slice(h + start, h + end)
+        dm = cockatoo.metric._cdist(ph[rows], fps[rows], valid[rows], ph[:h], fps[:h], valid[:h], weights)
+        idx[start:end] = dm.argmin(axis=1)
+        dist[start:end] = dm[np.arange(end - start), idx[start:end]]
+
+    return (idx, dist)
+
+def enrichment(clusters, hits):
+    """
+    Compute the enrichment of hits in each cluster.
+
+    :param array clusters: cluster label of each well (None if not assigned)
+    :param array hits: indices of the hit wells
+
+    :returns: list of tuples (cluster, size, hits, expected, fold, pvalue)
+        sorted by p-value, where expected is the number of hits expected by
+        chance, fold is hits / expected and pvalue is the hypergeometric
+        probability of observing at least that many hits
+    """
+    assigned = np.array([c is not None for c in clusters], dtype=bool)
+    labels = np.array([c if c is not None else 0 for c in clusters])[assigned]
+    is_hit = np.zeros(len(clusters), dtype=bool)
+    is_hit[hits] = True
+    is_hit = is_hit[assigned]
+
+    total = len(labels)
+    total_hits = int(is_hit.sum())
+    (names, index) = np.unique(labels, return_inverse=True)
+    sizes = np.bincount(index, minlength=len(names))
+    counts = np.bincount(index, is_hit.astype(np.double), minlength=len(names)).astype(np.intp)
+
+    expected = sizes * (float(total_hits) / total) if total > 0 else np.zeros(len(names))
+    pvalues = scipy.stats.hypergeom.sf(counts - 1, total, total_hits, sizes)
+
+    result = []
+    for k in range(len(names)):
+        fold = counts[k] / expected[k] if expected[k] > 0 else 0.0
+        result.append((names[k].item(), int(sizes[k]), int(counts[k]), float(expected[k]), float(fold), float(pvalues[k])))
+    return sorted(result, key=lambda r: (r[5], -r[2]))
+
+def candidates(screen, hits, library, weights=None, top=None, processes=1):
+    """
+    Rank untried library cocktails by their distance to the nearest hit.
+    Library cocktails with the same contents as a well of the screen (see
+    :meth:`cockatoo.Cocktail.content_hash`) are excluded as already tried, and
+    each distinct content is only ranked once.
+
+    :param screen screen: The screen (:class:`cockatoo.Screen`)
+    :param array hits: indices of the hit wells
+    :param array library: list of candidate cocktails
+    :param array weights: weights
+    :param int top: number of candidates to return (default: all)
+    :param int processes: number of worker processes fingerprinting and
+        comparing blocks of candidates (default: 1, in this process, None for
+        the number of cpus, see :func:`cockatoo.pipeline.nearest`)
+
+    :returns: list of tuples (index into library, index of the nearest hit
+        well, distance) sorted by distance
+    """
+    tried = set(ck.content_hash() for ck in screen.cocktails)
+    seen = set()
+    keep = []
+    for i, ck in enumerate(library):
+        key = ck.content_hash()
+        if key in tried or key in seen: continue
+        seen.add(key)
+        keep.append(i)
+
+    logger.info("Ranking %s untried cocktails out of %s" % (len(keep), len(library)))
+    untried = [library[i] for i in keep]
+    hit_cocktails = [screen.cocktails[h] for h in hits]
+    if processes == 1:
+        (idx, dist) = nearest(untried, hit_cocktails, weights)
+    else:
+        (idx, dist) = cockatoo.pipeline.nearest(untried, hit_cocktails, weights, processes)
+    order = np.argsort(dist, kind='stable')
+    if top is not None:
+        order = order[:top]
+    return [(keep[k], int(hits[idx[k]]), float(dist[k])) for k in order if idx[k] >= 0]
+
+class HitAnalysis(object):
+    """
+    Result of a hit proximity analysis (see :func:`analyze`).
+
+    :ivar screen: the screen
+    :ivar hits: indices of the hit wells
+    :ivar nearest: index of the nearest hit well of each well
+    :ivar distance: distance of each well to the nearest hit
+    :ivar clusters: cluster label of each well or None
+    :ivar enrichment: hit enrichment per cluster (see :func:`enrichment`) or None
+    :ivar library: candidate cocktails
+    :ivar candidates: ranked untried candidates (see :func:`candidates`)
+
+    """
+
+    def __init__(self, screen, hits, nearest, distance, clusters=None, enrichment=None, library=None, candidates=None):
+        self.screen = screen
+        self.hits = hits
+        self.nearest = nearest
+        self.distance = distance
+        self.clusters = clusters
+        self.enrichment = enrichment
+        self.library = library if library is not None else []
+        self.candidates = candidates if candidates is not None else []
+
+    def write(self, base_name):
+        """
+        Write the results to <base_name>.hits (distance of each well to the
+        nearest hit), <base_name>.enrichment if clusters were given and
+        <base_name>.candidates if a library was given.
+
+        """
+        is_hit = np.zeros(len(self.screen), dtype=bool)
+        is_hit[self.hits] = True
+        with codecs.open("%s.hits" % base_name, 'w', 'utf-8') as out:
+            out.write('\t'.join(['id', 'cocktail', 'hit', 'nearest_hit', 'distance', 'cluster']))
+            out.write('\n')
+            for i, ck in enumerate(self.screen.cocktails):
+                if self.nearest[i] < 0: continue
+                cluster = '' if self.clusters is None or self.clusters[i] is None else str(self.clusters[i])
+                out.write('\t'.join([str(i), ck.name, str(int(is_hit[i])), self.screen.cocktails[self.nearest[i]].name, str(self.distance[i]), cluster]))
+                out.write('\n')
+
+        if self.enrichment is not None:
+            with codecs.open("%s.enrichment" % base_name, 'w', 'utf-8') as out:
+                out.write('\t'.join(['cluster', 'size', 'hits', 'expected', 'fold', 'pvalue']))
+                out.write('\n')
+                for row in self.enrichment:
+                    out.write('\t'.join(str(v) for v in row))
+                    out.write('\n')
+
+        if len(self.library) > 0:
+            with codecs.open("%s.candidates" % base_name, 'w', 'utf-8') as out:
+                out.write('\t'.join(['rank', 'cocktail', 'nearest_hit', 'distance', 'components']))
+                out.write('\n')
+                for rank, (i, h, dist) in enumerate(self.candidates):
+                    ck = self.library[i]
+                    clist = ';'.join('%s %s %s' % (cp.name, cp.conc, cp.unit) for cp in ck.components)
+                    out.write('\t'.join([str(rank + 1), ck.name, self.screen.cocktails[h].name, str(dist), clist]))
+                    out.write('\n')
+
+def analyze(screen, hit_names, weights=None, clusters=None, library=None, top=None, processes=1):
+    """
+    Analyze the crystal hits of a screen.
+
+    :param screen screen: The screen (:class:`cockatoo.Screen`)
+    :param array hit_names: names of the hit cocktails (see :func:`load`)
+    :param array weights: weights
+    :param array clusters: cluster label of each well (default: no enrichment)
+    :param array library: candidate cocktails to rank (default: none)
+    :param int top: number of candidates to return (default: all)
+    :param int processes: number of worker processes ranking candidates
+        (default: 1, see :func:`candidates`)
+
+    :returns: The result (:class:`HitAnalysis`)
+    """
+    hits = hit_indices(screen, hit_names)
+    if len(hits) == 0:
+        raise ValueError('No hits found in screen %s' % screen.name)
+    logger.info("Found %s hits in %s wells" % (len(hits), len(screen)))
+
+    (idx, dist) = nearest(screen.cocktails, [screen.cocktails[h] for h in hits], weights)
+    enriched = enrichment(clusters, hits) if clusters is not None else None
+    ranked = candidates(screen, hits, library, weights, top, processes) if library else None
+
+    return HitAnalysis(screen, hits, hits[idx], dist, clusters, enriched, library, ranked)
@@ -1,4 +1,9 @@
 import math
+import numpy as np
+import scipy.sparse
+import scipy.spatial.distance
+import cockatoo
+import cockatoo.dmatrix
 
 def distance(ck1, ck2, weights=None):
     """
@@ -12,6 +17,8 @@ def distance(ck1, ck2, weights=None):
     :math:`i` and :math:`E(pH_{i})` is n estimate of the pH in condition :math:`i` normalized by a maxium pH of 14. :math:`BC(F_{i},F_{j})` is the 
     Bray-Curtis dissimilarity measure between cocktail fingerprints :math:`i` and :math:`j`. 
 
+    Other fingerprint metrics can be used in place of Bray-Curtis with
+    :func:`set_metric` (see :data:`METRICS`).
 
     """
 
@@ -55,10 +62,265 @@ def _braycurtis(fp1, fp2):
 
     return float(diff_sum)/float(summ)
 
+def _braycurtis_sorted(fp1, fp2):
+    """
+    Compute the Bray-Curtis dissimilarity measure between fingerprints stored
+    as sorted arrays (:class:`cockatoo.screen.SparseFingerprint`).
+
+    Uses sum(|a-b|) = sum(a) + sum(b) - 2*sum(min(a,b)) with the precomputed
+    sums so only the bits set in both fingerprints are visited.
+
+    :returns: distance between 0 and 1
+    """
+    summ = fp1.total + fp2.total
+    if summ == 0: return 1
+
+    if len(fp1) > len(fp2):
+        (fp1, fp2) = (fp2, fp1)
+
+    shared = 0.0
+    if len(fp1) > 0:
+        pos = np.searchsorted(fp2.bits, fp1.bits)
+        pos[pos == len(fp2)] = 0
+        hit = fp2.bits[pos] == fp1.bits
+        shared = float(np.minimum(fp1.values[hit], fp2.values[pos[hit]]).sum())
+
+    return min(1.0, max(0.0, (summ - 2*shared) / summ))
+
+class Metric(object):
+    """
+    A fingerprint dissimilarity measure with scalar, row and matrix kernels.
+
+    Every metric is computed from the fingerprint values after an element
+    wise transform (which must map 0 to 0), a reduction over the bits set in
+    both fingerprints (sum of minimums or sum of products) and the norm of
+    each fingerprint (sum or euclidean length). The same kernels therefore
+    serve all metrics for single pairs, one cocktail against a matrix and
+    blocks of matrices.
+
+    :param str name: name of the metric
+    :param function finish: function(shared, norm1, norm2) of arrays returning
+        the distances
+    :param str reduction: min or dot (default: min)
+    :param function transform: element wise transform of the fingerprint
+        values (default: None)
+    :param str description: one line description
+
+    """
+
+    def __init__(self, name, finish, reduction='min', transform=None, description=None):
+        if reduction not in ('min', 'dot'):
+            raise ValueError('Invalid reduction: %s' % reduction)
+        self.name = name
+        self.finish = finish
+        self.reduction = reduction
+        self.transform = transform
+        self.description = description
+
+    def values(self, values):
+        """
+        :returns: the transformed fingerprint values
+        """
+        return values if self.transform is None else self.transform(values)
+
+    def norm(self, values):
+        """
+        :returns: the norm of untransformed fingerprint values
+        """
+        v = self.values(np.asarray(values, dtype=np.double))
+        return float(v.sum()) if self.reduction == 'min' else math.sqrt(float(np.dot(v, v)))
+
+    def _reduce(self, a, b):
+        return np.minimum(a, b) if self.reduction == 'min' else a * b
+
+    def _finish(self, shared, norm1, norm2):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dist = self.finish(shared, norm1, norm2)
+        dist = np.where((norm1 == 0) | (norm2 == 0), 1.0, dist)
+        return np.clip(dist, 0, 1)
+
+    def pair(self, fp1, fp2):
+        """
+        Compute the distance between fingerprints stored as sorted arrays
+        (:class:`cockatoo.screen.SparseFingerprint`).
+
+        :returns: distance between 0 and 1
+        """
+        if len(fp1) > len(fp2):
+            (fp1, fp2) = (fp2, fp1)
+
+        v1 = self.values(fp1.values)
+        v2 = self.values(fp2.values)
+        shared = 0.0
+        if len(fp1) > 0:
+            pos = np.searchsorted(fp2.bits, fp1.bits)
+            pos[pos == len(fp2)] = 0
+            hit = fp2.bits[pos] == fp1.bits
+            shared = float(self._reduce(v1[hit], v2[pos[hit]]).sum())
+
+        if self.reduction == 'min':
+            (n1, n2) = (float(v1.sum()), float(v2.sum()))
+        else:
+            (n1, n2) = (math.sqrt(float(np.dot(v1, v1))), math.sqrt(float(np.dot(v2, v2))))
+        return float(self._finish(np.double(shared), np.double(n1), np.double(n2)))
+
+    def norms(self, fps):
+        """
+        :returns: the norm of each row of a sparse (or dense) fingerprint matrix
+        """
+        if scipy.sparse.issparse(fps):
+            v = _transformed(fps, self)
+            if self.reduction == 'dot':
+                v = v.multiply(v)
+            sums = np.asarray(v.sum(axis=1)).ravel()
+        else:
+            v = self.values(fps)
+            sums = (v * v if self.reduction == 'dot' else v).sum(axis=1)
+        return sums if self.reduction == 'min' else np.sqrt(sums)
+
+    def shared(self, fps1, fps2):
+        """
+        Compute the reduction (sum of minimums or sum of products) between all
+        rows of two sparse or dense fingerprint matrices. The reduction is a
+        sum over the bits so it can be computed separately for groups of bits
+        and added up.
+
+        :returns: dense matrix of shape (rows of fps1, rows of fps2)
+        """
+        if not scipy.sparse.issparse(fps1):
+            a = self.values(fps1)
+            b = self.values(fps2)
+            if self.reduction == 'dot':
+                return np.dot(a, b.T)
+            # sum(min(a,b)) = (sum(a) + sum(b) - sum(|a-b|)) / 2
+            sum1 = a.sum(axis=1).reshape(-1,1)
+            sum2 = b.sum(axis=1).reshape(1,-1)
+            return (sum1 + sum2 - scipy.spatial.distance.cdist(a, b, 'cityblock')) / 2.0
+
+        a = _transformed(fps1, self).tocsc()
+        b = _transformed(fps2, self).tocsc()
+        if self.reduction == 'dot':
+            return np.asarray((a * b.T).todense())
+
+        shared = np.zeros((a.shape[0], b.shape[0]), dtype=np.double)
+        for k in range(min(a.shape[1], b.shape[1])):
+            ia = a.indices[a.indptr[k]:a.indptr[k+1]]
+            ib = b.indices[b.indptr[k]:b.indptr[k+1]]
+            if len(ia) == 0 or len(ib) == 0: continue
+            va = a.data[a.indptr[k]:a.indptr[k+1]]
+            vb = b.data[b.indptr[k]:b.indptr[k+1]]
+            shared[np.ix_(ia, ib)] += np.minimum.outer(va, vb)
+        return shared
+
+    def matrix(self, fps1, fps2):
+        """
+        Compute the distances between all rows of two sparse non-negative
+        fingerprint matrices, or two dense matrices (see
+        :func:`cockatoo.screen.dense_fingerprint_matrix`).
+
+        :returns: distance matrix with values between 0 and 1
+        """
+        norm1 = self.norms(fps1).reshape(-1,1)
+        norm2 = self.norms(fps2).reshape(1,-1)
+        return self._finish(self.shared(fps1, fps2), norm1, norm2)
+
+    def vector(self, fp, fps, entry_rows, norms=None, norm=None):
+        """
+        Compute the distances between one dense fingerprint vector and every
+        row of a sparse fingerprint matrix in a single pass over the non-zero
+        entries.
+
+        :param array fp: dense fingerprint over the columns of fps
+        :param csr_matrix fps: fingerprint matrix
+        :param array entry_rows: row of each stored entry of fps
+        :param array norms: norm of each row of fps (default: computed)
+        :param float norm: norm of the fingerprint if it has bits outside the
+            columns of fps (default: norm of fp)
+
+        :returns: array of distances between 0 and 1
+        """
+        if norms is None:
+            norms = self.norms(fps)
+        if norm is None:
+            norm = self.norm(fp)
+
+        shared = np.bincount(entry_rows, self._reduce(self.values(fps.data), self.values(fp[fps.indices])), minlength=fps.shape[0])
+        return self._finish(shared, norms, np.double(norm))
+
+    def __repr__(self):
+        return "[ %s ]" % ", ".join('%r' % i for i in [self.name, self.reduction])
+
+def _transformed(fps, metric):
+    if metric.transform is None:
+        return fps
+    out = fps.copy()
+    out.data = metric.transform(out.data)
+    return out
+
+# Concentration (M) at which the log scaled metric is log(2)
+LOG_SCALE = 1e-3
+
+METRICS = {}
+
+def register(metric):
+    """
+    Register a metric so it can be selected with :func:`set_metric`.
+
+    :param metric metric: The metric (:class:`Metric`)
+    """
+    METRICS[metric.name] = metric
+
+register(Metric(
+    'braycurtis',
+    lambda s, n1, n2: (n1 + n2 - 2*s) / (n1 + n2),
+    description='Bray-Curtis dissimilarity (default)'))
+register(Metric(
+    'ruzicka',
+    lambda s, n1, n2: 1 - s / (n1 + n2 - s),
+    description='Weighted Jaccard (Ruzicka) distance'))
+register(Metric(
+    'cosine',
+    lambda s, n1, n2: 1 - s / (n1 * n2),
+    reduction='dot',
+    description='Cosine distance'))
+register(Metric(
+    'tanimoto',
+    lambda s, n1, n2: 1 - s / (n1 + n2 - s),
+    transform=lambda v: (v > 0).astype(np.double),
+    description='Tanimoto distance on the fingerprint bits, ignoring concentrations'))
+register(Metric(
+    'braycurtis-log',
+    lambda s, n1, n2: (n1 + n2 - 2*s) / (n1 + n2),
+    transform=lambda v: np.log1p(v / LOG_SCALE),
+    description='Bray-Curtis dissimilarity of log scaled concentrations'))
+
+_metric = METRICS['braycurtis']
+
+def get_metric(name=None):
+    """
+    :param str name: name of a registered metric (default: the current metric)
+
+    :returns: The metric (:class:`Metric`)
+    """
+    if name is None:
+        return _metric
+    if name not in METRICS:
+        raise ValueError('Unknown metric: %s' % name)
+    return METRICS[name]
+
+def set_metric(name):
+    """
+    Set the fingerprint metric used by all distance functions.
+
+    :param str name: name of a registered metric (see :data:`METRICS`)
+    """
+    global _metric
+    _metric = get_metric(name)
 
 def fp_distance(ck1, ck2):
     """
-    Compute distance between fingerprint vectors
+    Compute distance between fingerprint vectors with the current metric (see
+    :func:`set_metric`)
 
     :param cocktail ck1: First cocktail to compare
     :param cocktail ck2: Second cocktail to compare
@@ -66,12 +328,16 @@ def fp_distance(ck1, ck2):
     :returns: The distance score between 0 and 1, or None if either cocktail is missing a fingerprint
         
     """
+    fp1 = ck1.sparse_fingerprint()
+    fp2 = ck2.sparse_fingerprint()
+
     # either missing: undefined
-    if ck1.fingerprint() is None or ck2.fingerprint() is None:
+    if fp1 is None or fp2 is None:
         return None
 
-
-    return _braycurtis(ck1.fingerprint(), ck2.fingerprint())
+    if _metric.name == 'braycurtis':
+        return _braycurtis_sorted(fp1, fp2)
+    return _metric.pair(fp1, fp2)
 
 def ph_distance(ck1, ck2):
     """
@@ -88,3 +354,165 @@ def ph_distance(ck1, ck2):
         return None
 
     return math.fabs(ck1.ph - ck2.ph) / 14.0
+
+# Number of rows computed at a time in the batched kernels
+_BLOCK_SIZE = 1024
+
+# Approximate bytes of working memory per distance computed in a block
+_BYTES_PER_BLOCK_DISTANCE = 64
+
+def block_size(n, max_memory):
+    """
+    :returns: number of rows to compute at a time so the working memory of the
+        batched kernels for n cocktails stays below max_memory bytes
+    """
+    return max(1, int(max_memory // (max(1, n) * _BYTES_PER_BLOCK_DISTANCE)))
+
+def pdist(cocktails, weights=None, dtype='float64', out=None, block_size=None):
+    """
+    Compute the cocktail distance coefficient between all pairs of cocktails.
+
+    This gives the same results as calling :func:`distance` on every pair but
+    uses the batched fingerprint matrix from
+    :func:`cockatoo.screen.fingerprint_matrix` and vectorized kernels. Rows are
+    computed in blocks and written into the result, which can be a memory
+    mapped file (see :func:`cockatoo.dmatrix.open_memmap`) for matrices larger
+    than memory.
+
+    :param array cocktails: list of cocktails
+    :param array weights: weights
+    :param str dtype: storage dtype of the result, float64, float32 or uint16
+        (see :mod:`cockatoo.dmatrix`)
+    :param array out: condensed array to write the result into (default: allocate)
+    :param int block_size: number of rows computed at a time
+
+    :returns: The condensed distance matrix (see scipy.spatial.distance.pdist)
+        
+    """
+    n = len(cocktails)
+    (ph, fps, valid) = _arrays(cocktails)
+    dm = out if out is not None else cockatoo.dmatrix.empty(n, dtype)
+    if block_size is None:
+        block_size = _BLOCK_SIZE
+    for start in range(0, n, block_size):
+        end = min(n, start + block_size)
+        block = _cdist(ph[start:end], fps[start:end], valid[start:end], ph[start:], fps[start:], valid[start:], weights)
+        block = cockatoo.dmatrix.to_storage(block, dm.dtype)
+        for i in range(start, end):
+            k = i*n - (i*(i+1))//2
+            dm[k:k + n - i - 1] = block[i - start, i - start + 1:]
+
+    return dm
+
+def cdist(cocktails1, cocktails2, weights=None):
+    """
+    Compute the cocktail distance coefficient between two lists of cocktails.
+
+    This gives the same results as calling :func:`distance` on every pair but
+    uses the batched fingerprint matrix from
+    :func:`cockatoo.screen.fingerprint_matrix` and vectorized kernels.
+
+    :param array cocktails1: first list of cocktails
+    :param array cocktails2: second list of cocktails
+    :param array weights: weights
+
+    :returns: The distance matrix of shape (len(cocktails1), len(cocktails2))
+        
+    """
+    m = len(cocktails1)
+    (ph, fps, valid) = _arrays(list(cocktails1) + list(cocktails2))
+    return _cdist(ph[:m], fps[:m], valid[:m], ph[m:], fps[m:], valid[m:], weights)
+
+def _arrays(cocktails):
+    """
+    Private function returning the pH array (NaN if missing), the sparse
+    fingerprint matrix (or dense if the fingerprint settings are dense) and a
+    mask of cocktails with a fingerprint.
+
+    """
+    ph = np.array([np.nan if ck.ph is None else ck.ph for ck in cocktails], dtype=np.double)
+    if cockatoo.screen.fingerprint_settings().dense:
+        fps = cockatoo.screen.dense_fingerprint_matrix(cocktails)
+        return (ph, fps, fps.any(axis=1))
+
+    (fps, bits) = cockatoo.screen.fingerprint_matrix(cocktails)
+    valid = np.diff(fps.indptr) > 0
+    return (ph, fps, valid)
+
+def _cdist(ph1, fps1, valid1, ph2, fps2, valid2, weights):
+    """
+    Private function to compute the distance matrix from pH and fingerprint
+    arrays.
+
+    """
+    ph = np.abs(ph1[:,None] - ph2[None,:]) / 14.0
+    fp = _metric.matrix(fps1, fps2)
+    fp[~(valid1[:,None] & valid2[None,:])] = np.nan
+    return _combine(ph, fp, weights)
+
+def _global_arrays(cocktails):
+    """
+    Private function returning the pH array, the sparse fingerprint matrix
+    with one column per fingerprint bit and the mask of cocktails with a
+    fingerprint. Unlike :func:`_arrays` the columns do not depend on the
+    cocktails so matrices of different cocktails can be compared with
+    :func:`_cdist` once resized to the same number of columns.
+
+    """
+    ph = np.array([np.nan if ck.ph is None else ck.ph for ck in cocktails], dtype=np.double)
+    (fps, bits) = cockatoo.screen.fingerprint_matrix(cocktails)
+    ncols = int(bits[-1]) + 1 if len(bits) > 0 else 0
+    fps = scipy.sparse.csr_matrix((fps.data, bits[fps.indices], fps.indptr), shape=(len(cocktails), ncols))
+    valid = np.diff(fps.indptr) > 0
+    return (ph, fps, valid)
+
+def _row_arrays(cocktails):
+    """
+    Private function returning the arrays used by :func:`_row_distances` to
+    compute the distances from one cocktail to all cocktails.
+
+    """
+    (fps, bits) = cockatoo.screen.fingerprint_matrix(cocktails)
+    ph = np.array([np.nan if ck.ph is None else ck.ph for ck in cocktails], dtype=np.double)
+    valid = np.diff(fps.indptr) > 0
+    entry_rows = np.repeat(np.arange(len(cocktails)), np.diff(fps.indptr))
+    return (ph, fps, valid, entry_rows, _metric.norms(fps))
+
+def _row_distances(i, arrays, weights):
+    """
+    Private function to compute the distances from cocktail i to all
+    cocktails in O(number of fingerprint entries).
+
+    """
+    (ph, fps, valid, entry_rows, norms) = arrays
+    fp = np.zeros(fps.shape[1], dtype=np.double)
+    start, end = fps.indptr[i], fps.indptr[i+1]
+    fp[fps.indices[start:end]] = fps.data[start:end]
+
+    fpd = _metric.vector(fp, fps, entry_rows, norms, norms[i])
+    fpd[~(valid & valid[i])] = np.nan
+    return _combine(np.abs(ph - ph[i]) / 14.0, fpd, weights)
+
+def _combine(ph, fp, weights):
+    """
+    Private function to combine arrays of pH and fingerprint distances, where
+    NaN marks an undefined distance, into the cocktail distance coefficient.
+
+    """
+    # Default to equal weights
+    if weights is None: 
+        w = [1.0,1.0]
+    else:
+        w = weights[:]
+
+    w_ph = np.where(np.isnan(ph), 0.0, w[0])
+    w_fp = np.where(np.isnan(fp), 0.0, w[1])
+    wsum = w_ph + w_fp
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dist = (w_ph*np.nan_to_num(ph) + w_fp*np.nan_to_num(fp)) / wsum
+
+    # If all weights are 0, then technically it's undefined but we default to
+    # max dissimilarity 
+    dist[wsum == 0] = 1
+
+    return dist
@@ -0,0 +1,192 @@
+"""
+Registry of commercial mixtures (ex. Tacsimate) used as a single compound.
+
+Mixtures are defined in a TAB delimited file (see ``data/mixtures.csv``) with
+one row per component::
+
+    mixture  pattern  unit  name  conc  component_unit  smiles  molecular_weight  density
+
+where pattern is a regular expression matched (ignoring case) against compound
+names, unit is the unit the mixture is given in (percent of stock solution)
+and conc is the concentration of the component in the stock solution. When
+the file is not installed with the package, the built-in definition of
+Tacsimate is used.
+
+A mixture compound in a cocktail is kept as a single
+:class:`cockatoo.screen.Mixture`. The fingerprint of each mixture per unit
+stock (the sum of its component fingerprints weighted by their molarity) is
+computed once and cached, so a mixture adds a single scaled vector to the
+cocktail fingerprint.
+
+"""
+import os
+import re
+import csv
+import logging
+import cockatoo
+import cockatoo.units
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data', 'mixtures.csv')
+
+_registry = None
+
+# Tacsimate in M, see:
+# http://hamptonresearch.com/documents/product/hr000175_what_is_tacsimate_new.pdf
+_TACSIMATE = [
+    {'conc': 1.8305, 'name': 'malonic acid', 'smiles': 'C(C(=O)O)C(=O)O', 'molecular_weight': 104.06146},
+    {'conc': 0.25, 'name': 'ammonium citrate tribasic', 'smiles': 'C(C(=O)O)C(CC(=O)O)(C(=O)O)O.N.N.N', 'molecular_weight': 243.21508},
+    {'conc': 0.12, 'name': 'succinic acid', 'smiles': 'C(CC(=O)O)C(=O)O', 'molecular_weight': 118.088},
+    {'conc': 0.3, 'name': 'dl-malic acid', 'smiles': 'O=C(O)CC(O)C(=O)O', 'molecular_weight': 134.0874},
+    {'conc': 0.4, 'name': 'sodium acetate trihydrate', 'smiles': '[Na+].[O-]C(=O)C.O.O.O', 'molecular_weight': 136.0796},
+    {'conc': 0.5, 'name': 'sodium formate', 'smiles': '[Na+].[O-]C=O', 'molecular_weight': 68.0072},
+    {'conc': 0.16, 'name': 'ammonium tartrate dibasic', 'smiles': 'O=C(O)[C@H](O)[C@@H](O)C(=O)O.N.N', 'molecular_weight': 184.1479}
+]
+
+class MixtureDefinition(object):
+    """
+    A mixture and its components in the stock solution.
+
+    :param str name: name of the mixture
+    :param str pattern: regular expression matching compound names
+    :param str unit: unit the mixture is given in (ex. % (v/v))
+    :param array components: components of the stock solution
+        (:class:`cockatoo.Compound`)
+
+    """
+
+    def __init__(self, name, pattern, unit, components=None):
+        self.name = name
+        self.pattern = re.compile(pattern, re.IGNORECASE)
+        self.unit = unit
+        self.unit_code = cockatoo.units.parse_unit(unit)
+        self.components = components if components is not None else []
+
+    def fraction(self, conc):
+        """
+        :returns: the fraction of stock solution of a mixture at conc (in
+            percent)
+        """
+        return None if conc is None else conc * 0.01
+
+    def fingerprint(self):
+        """
+        Compute the fingerprint of the stock solution once per fingerprint
+        settings (see :class:`cockatoo.screen.FingerprintSettings`).
+
+        :returns: The fingerprint (:class:`cockatoo.screen.StoredFingerprint`)
+        """
+        version = cockatoo.screen.FINGERPRINT_VERSION
+        cached = getattr(self, '_fp', None)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        counts = {}
+        for cp in self.components:
+            # Components are owned by the mixture, recompute if the
+            # fingerprint settings changed
+            cp.__dict__.pop('_fp', None)
+            molarity = cp.molarity()
+            if molarity is None: molarity = 1
+            for k,v in cp.fingerprint().counts.items():
+                counts[k] = counts.get(k, 0.0) + (float(v) * molarity)
+
+        self._fp = (version, cockatoo.screen.StoredFingerprint(counts))
+        return self._fp[1]
+
+    def expand(self, conc, ph=None):
+        """
+        Expand a mixture at conc into its components.
+
+        :returns: list of compounds (:class:`cockatoo.Compound`) in M
+        """
+        fraction = self.fraction(conc)
+        return [cockatoo.screen.Compound(cp.name, cp.molarity() * fraction, 'M', ph,
+                                         cp.smiles, cp.molecular_weight, cp.density)
+                for cp in self.components]
+
+    def __repr__(self):
+        return "[ %s ]" % ", ".join('%r' % i for i in [self.name, self.unit, len(self.components)])
+
+def load(path):
+    """
+    Load mixture definitions in TAB delimited format.
+
+    :param str path: Path to file
+
+    :returns: list of mixtures (:class:`MixtureDefinition`)
+    """
+    if not os.path.exists(path):
+        raise ValueError('Mixture registry not found: %s' % path)
+
+    mixtures = {}
+    with open(path) as csvfile:
+        reader = csv.DictReader(csvfile, delimiter="\t")
+        for row in reader:
+            name = row['mixture'].strip().lower()
+            if name not in mixtures:
+                mixtures[name] = MixtureDefinition(name, row['pattern'], row['unit'])
+
+            mixtures[name].components.append(cockatoo.screen.Compound(
+                row['name'].strip().lower(),
+                float(row['conc']),
+                row['component_unit'],
+                smiles=row['smiles'] if len(row['smiles']) > 0 else None,
+                molecular_weight=float(row['molecular_weight']) if len(row['molecular_weight']) > 0 else None,
+                density=float(row['density']) if len(row['density']) > 0 else None
+            ))
+
+    return sorted(mixtures.values(), key=lambda m: m.name)
+
+def builtin():
+    """
+    :returns: the built-in mixtures (:class:`MixtureDefinition`)
+    """
+    tacsimate = MixtureDefinition('tacsimate', 'tacsimate', '% (v/v)')
+    for n in _TACSIMATE:
+        tacsimate.components.append(cockatoo.screen.Compound(
+            n['name'], n['conc'], 'M',
+            smiles=n['smiles'],
+            molecular_weight=n['molecular_weight']
+        ))
+    return [tacsimate]
+
+def set_registry(mixtures):
+    """
+    Set the mixtures recognized when parsing screens.
+
+    :param array mixtures: list of mixtures (:class:`MixtureDefinition`) or a
+        path to a mixture file
+    """
+    global _registry
+    if isinstance(mixtures, str):
+        mixtures = load(mixtures)
+    _registry = list(mixtures)
+
+def registry():
+    """
+    :returns: the mixtures recognized when parsing screens, loaded from
+        :data:`DEFAULT_PATH` on first use, or the built-in mixtures when that
+        file is not installed
+    """
+    global _registry
+    if _registry is None:
+        if os.path.exists(DEFAULT_PATH):
+            _registry = load(DEFAULT_PATH)
+        else:
+            _registry = builtin()
+    return _registry
+
+def find(name):
+    """
+    Find the mixture matching a compound name.
+
+    :returns: The mixture (:class:`MixtureDefinition`) or None
+    """
+    if name is None:
+        return None
+    for m in registry():
+        if m.pattern.search(name):
+            return m
+    return None
@@ -0,0 +1,162 @@
+"""
+Persisted clustering models for assigning new cocktails to the clusters of an
+existing clustering without reclustering.
+
+A model stores, for every cocktail of the clustered screen, its cluster
+label, pH and fingerprint along with the cluster medoids, the distance cutoff
+the weights and the fingerprint metric used. It is saved as an uncompressed numpy ``.npz`` archive
+(see :mod:`cockatoo.npz`) and memory mapped on load.
+
+A new cocktail is assigned to the cluster with the smallest average distance
+to its members, matching the average linkage used to build the clusters, and
+flagged as novel if that distance exceeds the cutoff. Distances to all members
+are computed in one vectorized pass over the stored fingerprints.
+
+"""
+import logging
+import numpy as np
+import scipy.sparse
+import cockatoo
+import cockatoo.npz
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+class ClusterModel(object):
+    """
+    Clustering model of a screen.
+
+    :param array names: cocktail names
+    :param array labels: cluster label of each cocktail
+    :param array ph: pH of each cocktail (NaN if missing)
+    :param csr_matrix fps: fingerprint matrix with one row per cocktail and
+        one column per fingerprint bit
+    :param array medoids: index of the medoid of each cluster (sorted by label)
+    :param float cutoff: distance cutoff used to form the clusters
+    :param array weights: weights
+    :param str metric: name of the fingerprint metric (default: the current
+        metric, see :func:`cockatoo.metric.set_metric`)
+
+    """
+
+    def __init__(self, names, labels, ph, fps, medoids, cutoff, weights, metric=None):
+        self.names = names
+        self.labels = np.asarray(labels)
+        self.ph = np.asarray(ph, dtype=np.double)
+        self.fps = fps
+        self.medoids = np.asarray(medoids, dtype=np.intp)
+        self.cutoff = float(cutoff)
+        self.weights = list(weights) if weights is not None else None
+        self.metric = cockatoo.metric.get_metric(metric)
+
+        (self.clusters, self._index) = np.unique(self.labels, return_inverse=True)
+        self._counts = np.bincount(self._index, minlength=len(self.clusters)).astype(np.double)
+        self._valid = np.diff(fps.indptr) > 0
+        self._entry_rows = np.repeat(np.arange(fps.shape[0]), np.diff(fps.indptr))
+        self._norms = self.metric.norms(fps)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def distances(self, cocktail):
+        """
+        Compute the distances between a cocktail and all cocktails of the
+        model.
+
+        :returns: array of distances
+        """
+        fp = cocktail.fingerprint()
+        if fp is None:
+            fpd = np.full(len(self), np.nan)
+        else:
+            vec = np.zeros(self.fps.shape[1], dtype=np.double)
+            for k, v in fp.items():
+                if k < len(vec): vec[k] = v
+            fpd = self.metric.vector(vec, self.fps, self._entry_rows, self._norms, self.metric.norm(list(fp.values())))
+            fpd[~self._valid] = np.nan
+
+        ph = np.full(len(self), np.nan) if cocktail.ph is None else np.abs(self.ph - cocktail.ph) / 14.0
+        return cockatoo.metric._combine(ph, fpd, self.weights)
+
+    def assign(self, cocktail):
+        """
+        Assign a cocktail to the nearest cluster.
+
+        :returns: tuple (cluster, distance, medoid, novel) with the label of
+            the cluster with the smallest average distance, that distance, the
+            index of the cluster medoid and whether the distance exceeds the
+            cutoff
+        """
+        avg = np.bincount(self._index, self.distances(cocktail), minlength=len(self.clusters)) / self._counts
+        k = int(np.argmin(avg))
+        return (self.clusters[k].item(), float(avg[k]), int(self.medoids[k]), bool(avg[k] > self.cutoff))
+
+    def save(self, path):
+        """
+        Save the model.
+
+        :param str path: Path to output file (.npz)
+        """
+        text = '\n'.join(self.names)
+        arrays = {
+            'format_version': np.array([FORMAT_VERSION], dtype=np.int32),
+            'fingerprint_version': np.frombuffer(cockatoo.screen.FINGERPRINT_VERSION.encode('utf-8'), dtype=np.uint8),
+            'names': np.frombuffer(text.encode('utf-8'), dtype=np.uint8),
+            'labels': self.labels,
+            'ph': self.ph,
+            'fp_indptr': self.fps.indptr.astype(np.int64),
+            'fp_indices': self.fps.indices.astype(np.int64),
+            'fp_data': self.fps.data,
+            'fp_shape': np.array(self.fps.shape, dtype=np.int64),
+            'medoids': self.medoids,
+            'cutoff': np.array([self.cutoff], dtype=np.double),
+            'weights': np.array(self.weights if self.weights is not None else [1.0, 1.0], dtype=np.double),
+            'metric': np.frombuffer(self.metric.name.encode('utf-8'), dtype=np.uint8),
+        }
+        with open(path, 'wb') as out:
+            np.savez(out, **arrays)
+
+def build(screen, clusters, cutoff, weights, medoids=None):
+    """
+    Build a clustering model from the clusters of a screen.
+
+    :param screen screen: The screen (:class:`cockatoo.Screen`)
+    :param array clusters: cluster label of each cocktail
+    :param float cutoff: distance cutoff used to form the clusters
+    :param array weights: weights
+    :param array medoids: index of the medoid of each cluster sorted by label
+        (default: first member of each cluster)
+
+    :returns: The model (:class:`ClusterModel`)
+    """
+    (ph, fps, valid) = cockatoo.metric._global_arrays(screen.cocktails)
+
+    if medoids is None:
+        (labels, first) = np.unique(np.asarray(clusters), return_index=True)
+        medoids = first
+
+    return ClusterModel([ck.name for ck in screen.cocktails], clusters, ph, fps, medoids, cutoff, weights)
+
+def load(path, mmap=True):
+    """
+    Load a clustering model saved with :meth:`ClusterModel.save`.
+
+    :param str path: Path to file
+    :param bool mmap: Memory map the arrays instead of reading them (default: True)
+
+    :returns: The model (:class:`ClusterModel`)
+    """
+    data = cockatoo.npz.load_arrays(path, mmap)
+    if int(data['format_version'][0]) != FORMAT_VERSION:
+        raise ValueError('Unsupported clustering model version: %s' % data['format_version'][0])
+
+    version = data['fingerprint_version'].tobytes().decode('utf-8')
+    if version != cockatoo.screen.FINGERPRINT_VERSION:
+        raise ValueError('Clustering model built with fingerprint version %s (expected %s)' % (version, cockatoo.screen.FINGERPRINT_VERSION))
+
+    shape = tuple(int(x) for x in data['fp_shape'])
+    fps = scipy.sparse.csr_matrix((data['fp_data'], data['fp_indices'], data['fp_indptr']), shape=shape)
+    names = data['names'].tobytes().decode('utf-8').split('\n')
+    metric = data['metric'].tobytes().decode('utf-8') if 'metric' in data else 'braycurtis'
+    return ClusterModel(names, data['labels'], data['ph'], fps, data['medoids'], data['cutoff'][0], data['weights'].tolist(), metric)
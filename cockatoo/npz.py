@@ -0,0 +1,260 @@
+"""
+Compact binary columnar screen format.
+
+Screens are stored as an uncompressed numpy ``.npz`` archive of flat arrays
+(no pickled objects). All strings (names, smiles, units) are interned into a
+single table and referenced by index, -1 meaning missing. Missing floats are
+stored as NaN. Compounds are interned into a compound table so each distinct
+compound (and its fingerprint) is stored once::
+
+    strings_data                UTF-8 encoded string table
+    strings_offsets             character offset of each string
+    compound_name               index into strings
+    compound_smiles             index into strings
+    compound_molecular_weight
+    compound_density
+    component_compound          index into compound table
+    component_conc
+    component_unit              index into strings
+    component_ph
+    cocktail_name               index into strings
+    cocktail_ph
+    cocktail_indptr             components of cocktail i are indptr[i]:indptr[i+1]
+
+Fingerprints are optionally stored in CSR layout (``compound_fp_indptr``,
+``compound_fp_indices``, ``compound_fp_data`` and the same for cocktails)
+tagged with the fingerprint version. Because the archive is not compressed the
+arrays can be memory mapped directly from disk on load.
+
+"""
+import logging
+import struct
+import zipfile
+import numpy as np
+import cockatoo
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+def save(screen, path, fingerprints=False):
+    """
+    Save a screen in binary format.
+
+    :param screen screen: The screen (:class:`cockatoo.screen.Screen`)
+    :param str path: Path to output file
+    :param bool fingerprints: Also store the compound and cocktail fingerprints
+        (default: False)
+
+    """
+    strings = {}
+    def intern(val):
+        if val is None: return -1
+        if val not in strings:
+            strings[val] = len(strings)
+        return strings[val]
+
+    compounds = {}
+    compound_list = []
+    component_compound = []
+    component_conc = []
+    component_unit = []
+    component_ph = []
+    cocktail_indptr = [0]
+    for ck in screen.cocktails:
+        for cp in ck.components:
+            key = (cp.name, cp.smiles, cp.molecular_weight, cp.density)
+            if key not in compounds:
+                compounds[key] = len(compound_list)
+                compound_list.append(cp)
+            component_compound.append(compounds[key])
+            component_conc.append(cp.conc)
+            component_unit.append(intern(cp.unit))
+            component_ph.append(cp.ph)
+        cocktail_indptr.append(len(component_compound))
+
+    arrays = {
+        'format_version': np.array([FORMAT_VERSION], dtype=np.int32),
+        'name': np.array([intern(screen.name)], dtype=np.int32),
+        'compound_name': np.array([intern(cp.name) for cp in compound_list], dtype=np.int32),
+        'compound_smiles': np.array([intern(cp.smiles) for cp in compound_list], dtype=np.int32),
+        'compound_molecular_weight': _float_array([cp.molecular_weight for cp in compound_list]),
+        'compound_density': _float_array([cp.density for cp in compound_list]),
+        'component_compound': np.array(component_compound, dtype=np.int32),
+        'component_conc': _float_array(component_conc),
+        'component_unit': np.array(component_unit, dtype=np.int32),
+        'component_ph': _float_array(component_ph),
+        'cocktail_name': np.array([intern(ck.name) for ck in screen.cocktails], dtype=np.int32),
+        'cocktail_ph': _float_array([ck.ph for ck in screen.cocktails]),
+        'cocktail_indptr': np.array(cocktail_indptr, dtype=np.int64),
+    }
+
+    if fingerprints:
+        cockatoo.screen.fingerprint_matrix(screen.cocktails)
+        arrays['fingerprint_version'] = np.array([intern(cockatoo.screen.FINGERPRINT_VERSION)], dtype=np.int32)
+        _add_csr(arrays, 'compound_fp', [cp.fingerprint().counts for cp in compound_list])
+        _add_csr(arrays, 'cocktail_fp', [ck.fingerprint() for ck in screen.cocktails])
+
+    table = sorted(strings, key=strings.get)
+    arrays['strings_data'] = np.frombuffer(''.join(table).encode('utf-8'), dtype=np.uint8)
+    arrays['strings_offsets'] = np.cumsum([0] + [len(t) for t in table]).astype(np.int64)
+
+    with open(path, 'wb') as out:
+        np.savez(out, **arrays)
+
+def load(path, mmap=True):
+    """
+    Load a screen saved in binary format.
+
+    :param str path: Path to file
+    :param bool mmap: Memory map the arrays instead of reading them (default: True)
+
+    :returns: The screen (:class:`cockatoo.screen.Screen`)
+
+    """
+    data = load_arrays(path, mmap)
+    if int(data['format_version'][0]) != FORMAT_VERSION:
+        logger.critical('Unsupported binary screen format version: %s' % data['format_version'][0])
+        return None
+
+    strings = _read_strings(data) + [None]
+    names = [strings[i] for i in data['compound_name'].tolist()]
+    smiles = [strings[i] for i in data['compound_smiles'].tolist()]
+    mw = _float_list(data['compound_molecular_weight'])
+    density = _float_list(data['compound_density'])
+
+    compound_fps = None
+    cocktail_fps = None
+    if 'fingerprint_version' in data:
+        version = strings[int(data['fingerprint_version'][0])]
+        if version == cockatoo.screen.FINGERPRINT_VERSION:
+            compound_fps = [cockatoo.screen.StoredFingerprint(fp) for fp in _read_csr(data, 'compound_fp')]
+            cocktail_fps = _read_csr(data, 'cocktail_fp')
+        else:
+            logger.warning('Ignoring fingerprints computed with version %s (expected %s)' % (version, cockatoo.screen.FINGERPRINT_VERSION))
+
+    component_compound = data['component_compound'].tolist()
+    component_conc = _float_list(data['component_conc'])
+    component_unit = [strings[i] for i in data['component_unit'].tolist()]
+    component_ph = _float_list(data['component_ph'])
+
+    screen = cockatoo.screen.Screen(strings[int(data['name'][0])])
+    indptr = data['cocktail_indptr'].tolist()
+    cocktail_ph = _float_list(data['cocktail_ph'])
+    for i, name in enumerate(data['cocktail_name'].tolist()):
+        cocktail = cockatoo.screen.Cocktail(strings[name], cocktail_ph[i])
+        for k in range(indptr[i], indptr[i+1]):
+            j = component_compound[k]
+            compound = cockatoo.screen.Compound(
+                names[j],
+                component_conc[k],
+                component_unit[k],
+                component_ph[k],
+                smiles[j],
+                mw[j],
+                density[j]
+            )
+            compound = cockatoo.screen._parse_mixture(compound)
+            if compound_fps is not None:
+                compound._fp = compound_fps[j]
+            cocktail.add_compound(compound)
+
+        if cocktail_fps is not None:
+            cocktail._fp = cocktail_fps[i]
+        screen.add_cocktail(cocktail)
+
+    return screen
+
+def load_arrays(path, mmap=True):
+    """
+    Load the raw arrays of a screen saved in binary format.
+
+    :param str path: Path to file
+    :param bool mmap: Memory map the arrays instead of reading them (default: True)
+
+    :returns: dict of array name to numpy array
+
+    """
+    if not mmap:
+        with np.load(path, allow_pickle=False) as data:
+            return dict((k, data[k]) for k in data.files)
+
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as fh:
+        for info in zf.infolist():
+            key = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if info.compress_type != zipfile.ZIP_STORED:
+                with zf.open(info) as member:
+                    arrays[key] = np.lib.format.read_array(member, allow_pickle=False)
+                continue
+
+            # Skip over the zip local file header to the start of the .npy data
+            fh.seek(info.header_offset)
+            header = fh.read(30)
+            (name_len, extra_len) = struct.unpack('<HH', header[26:30])
+            fh.seek(info.header_offset + 30 + name_len + extra_len)
+
+            version = np.lib.format.read_magic(fh)
+            if version == (1, 0):
+                (shape, fortran_order, dtype) = np.lib.format.read_array_header_1_0(fh)
+            else:
+                (shape, fortran_order, dtype) = np.lib.format.read_array_header_2_0(fh)
+
+            if int(np.prod(shape)) == 0:
+                arrays[key] = np.zeros(shape, dtype=dtype)
+                continue
+
+            arrays[key] = np.memmap(path, dtype=dtype, mode='r', offset=fh.tell(), shape=shape, order='F' if fortran_order else 'C')
+
+    return arrays
+
+def _read_strings(data):
+    """
+    Private function to read the string table. Strings are stored concatenated
+    as UTF-8 with the character offset of each string.
+
+    """
+    text = data['strings_data'].tobytes().decode('utf-8')
+    offsets = data['strings_offsets'].tolist()
+    return [text[offsets[i]:offsets[i+1]] for i in range(len(offsets) - 1)]
+
+def _float_array(vals):
+    return np.array([np.nan if v is None else v for v in vals], dtype=np.double)
+
+def _float_list(arr):
+    return [None if v != v else v for v in arr.tolist()]
+
+def _add_csr(arrays, prefix, fps):
+    """
+    Private function to add a list of fingerprint dicts (or None) to arrays in
+    CSR layout.
+
+    """
+    indptr = np.zeros(len(fps) + 1, dtype=np.int64)
+    for i, fp in enumerate(fps):
+        indptr[i+1] = indptr[i] + (0 if fp is None else len(fp))
+
+    arrays[prefix + '_indptr'] = indptr
+    arrays[prefix + '_indices'] = np.fromiter((k for fp in fps if fp is not None for k in fp), dtype=np.int64, count=indptr[-1])
+    arrays[prefix + '_data'] = np.fromiter((v for fp in fps if fp is not None for v in fp.values()), dtype=np.double, count=indptr[-1])
+    arrays[prefix + '_valid'] = np.array([fp is not None for fp in fps], dtype=np.bool_)
+
+def _read_csr(data, prefix):
+    """
+    Private function to read a list of fingerprint dicts (or None) stored in
+    CSR layout.
+
+    """
+    indptr = data[prefix + '_indptr'].tolist()
+    indices = data[prefix + '_indices'].tolist()
+    values = data[prefix + '_data'].tolist()
+    valid = data[prefix + '_valid'].tolist()
+
+    fps = []
+    for i in range(len(valid)):
+        if not valid[i]:
+            fps.append(None)
+            continue
+        fps.append(dict(zip(indices[indptr[i]:indptr[i+1]], values[indptr[i]:indptr[i+1]])))
+
+    return fps
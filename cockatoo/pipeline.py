@@ -0,0 +1,373 @@
+"""
+Streaming pipelines overlapping loading, fingerprinting and distance work.
+
+A :class:`Pipeline` passes a stream of items through a list of stages. Each
+stage runs its function on several items at once, either in threads (for I/O
+bound work such as :func:`cockatoo.screen.load` of files or Xtuition screens)
+or in worker processes (for CPU bound work such as fingerprinting with RDKit
+and blocks of distances), so all stages are busy at the same time.
+
+At most ``buffer`` items are in flight (read from the input but not yet
+consumed). When the consumer or a slow stage falls behind, reading the input
+waits (backpressure), which bounds the memory used by the pipeline. Results
+are yielded in input order. An exception raised for an item is raised by the
+consumer when that item is reached.
+
+Functions and items of process stages are pickled, so the functions must be
+defined at module level (:func:`functools.partial` can bind extra
+arguments). Worker processes use the fingerprint settings and metric of the
+parent process. Pipelines started from a thread (for example one feeding
+another) should be given a process pool created beforehand, as forking while
+threads run is unsafe (see :func:`pool`).
+
+The workloads built on pipelines are :func:`load_screens`,
+:func:`distance_matrix` (all pairs screen distances, see the sdist-matrix
+command) and :func:`nearest` (used by the hits command to rank library
+cocktails).
+
+"""
+import functools
+import logging
+import multiprocessing
+import threading
+import queue
+import numpy as np
+import cockatoo
+import cockatoo.mixture
+
+logger = logging.getLogger(__name__)
+
+# Number of threads loading screens
+DEFAULT_LOADERS = 4
+
+# Marks the end of the items passed to a stage
+_DONE = object()
+
+class Stage(object):
+    """
+    A step of a pipeline.
+
+    :param function func: function called with each item, returning the item
+        passed to the next stage
+    :param int workers: number of items processed at once (default: 1, or
+        the number of cpus for process stages)
+    :param bool processes: run in worker processes instead of threads
+        (default: False)
+    :param str name: name used in log messages (default: name of func)
+
+    """
+
+    def __init__(self, func, workers=None, processes=False, name=None):
+        if workers is None:
+            workers = multiprocessing.cpu_count() if processes else 1
+        if workers < 1:
+            raise ValueError('Number of workers must be at least 1: %s' % workers)
+        self.func = func
+        self.workers = workers
+        self.processes = processes
+        self.name = name if name is not None else getattr(func, '__name__', repr(func))
+
+    def __repr__(self):
+        return "[ %s ]" % ", ".join('%r' % i for i in [self.name, self.workers, self.processes])
+
+class _Error(object):
+    """
+    Private class carrying the exception raised for an item to the consumer.
+
+    """
+
+    def __init__(self, exc):
+        self.exc = exc
+
+def _init_worker(settings, metric, mixtures):
+    cockatoo.screen.set_fingerprint_settings(settings)
+    cockatoo.metric.set_metric(metric)
+    if mixtures is not None:
+        cockatoo.mixture.set_registry(mixtures)
+
+def pool(processes=None):
+    """
+    Create a process pool for the process stages of pipelines, with the
+    fingerprint settings, metric and mixtures of this process.
+
+    :param int processes: number of worker processes (default: number of cpus)
+
+    :returns: the pool (multiprocessing.Pool)
+    """
+    return multiprocessing.Pool(processes, _init_worker, (cockatoo.screen.fingerprint_settings(),
+                                cockatoo.metric.get_metric().name, cockatoo.mixture._registry))
+
+def _apply(pool, func, item):
+    return pool.apply(func, (item,))
+
+class Pipeline(object):
+    """
+    A pipeline of stages (see :class:`Stage`).
+
+    :param array stages: list of stages
+    :param int buffer: maximum number of items in flight (default: twice the
+        total number of workers)
+    :param pool pool: process pool shared by the process stages (default:
+        create a pool per process stage on each run, see :func:`pool`)
+
+    """
+
+    def __init__(self, stages, buffer=None, pool=None):
+        if len(stages) == 0:
+            raise ValueError('Pipeline needs at least one stage')
+        self.stages = list(stages)
+        if buffer is None:
+            buffer = 2 * sum(st.workers for st in self.stages)
+        self.buffer = max(1, buffer)
+        self.pool = pool
+
+    def run(self, items):
+        """
+        Run the pipeline over a stream of items.
+
+        :param iterable items: input items (may be a generator, which is read
+            in a separate thread)
+
+        :returns: generator of the results in input order
+        """
+        stop = threading.Event()
+        window = threading.Semaphore(self.buffer)
+        queues = [queue.Queue() for st in self.stages] + [queue.Queue()]
+        lock = threading.Lock()
+        remaining = [st.workers for st in self.stages]
+        threads = []
+        pools = []
+
+        def feed():
+            seq = 0
+            try:
+                for item in items:
+                    while not window.acquire(timeout=0.1):
+                        if stop.is_set(): return
+                    if stop.is_set(): return
+                    queues[0].put((seq, item))
+                    seq += 1
+            except Exception as e:
+                # Raised by the consumer after the items before it
+                queues[0].put((seq, _Error(e)))
+            finally:
+                # Stop generators (ex. another pipeline) feeding the items
+                if hasattr(items, 'close'):
+                    items.close()
+                for i in range(self.stages[0].workers):
+                    queues[0].put(_DONE)
+
+        def work(k, call):
+            (inq, outq) = (queues[k], queues[k+1])
+            while True:
+                task = inq.get()
+                if task is _DONE: break
+                (seq, item) = task
+                if not isinstance(item, _Error) and not stop.is_set():
+                    try:
+                        item = call(item)
+                    except Exception as e:
+                        logger.debug("Stage %s failed on item %s: %s" % (self.stages[k].name, seq, e))
+                        item = _Error(e)
+                outq.put((seq, item))
+
+            with lock:
+                remaining[k] -= 1
+                last = remaining[k] == 0
+            if last:
+                following = self.stages[k+1].workers if k + 1 < len(self.stages) else 1
+                for i in range(following):
+                    outq.put(_DONE)
+
+        for k, st in enumerate(self.stages):
+            call = st.func
+            if st.processes:
+                workers = self.pool
+                if workers is None:
+                    workers = pool(st.workers)
+                    pools.append(workers)
+                call = functools.partial(_apply, workers, st.func)
+            for i in range(st.workers):
+                threads.append(threading.Thread(target=work, args=(k, call)))
+        threads.append(threading.Thread(target=feed))
+
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        pending = {}
+        next_seq = 0
+        done = False
+        try:
+            while True:
+                while next_seq in pending:
+                    result = pending.pop(next_seq)
+                    next_seq += 1
+                    window.release()
+                    if isinstance(result, _Error):
+                        raise result.exc
+                    yield result
+                if done: break
+
+                task = queues[-1].get()
+                if task is _DONE:
+                    done = True
+                    continue
+                pending[task[0]] = task[1]
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+            for workers in pools:
+                workers.close()
+                workers.join()
+
+def imap(func, items, workers=None, processes=True, buffer=None):
+    """
+    Apply a function to a stream of items with a single stage pipeline.
+
+    :returns: generator of the results in input order
+    """
+    return Pipeline([Stage(func, workers, processes)], buffer).run(items)
+
+def load_screens(paths, loaders=DEFAULT_LOADERS):
+    """
+    Load screens in threads (see :func:`cockatoo.screen.load`).
+
+    :param array paths: paths or Xtuition screen ids
+    :param int loaders: number of threads (default: 4)
+
+    :returns: generator of screens in input order
+    """
+    return Pipeline([Stage(cockatoo.screen.load, loaders, name='load')]).run(paths)
+
+def screen_arrays(screen):
+    """
+    Fingerprint the unique cocktails of a screen.
+
+    :returns: tuple (name, index, ph, fps, valid) where index maps each
+        cocktail to its unique cocktail and (ph, fps, valid) are the arrays of
+        the unique cocktails with one fingerprint column per bit
+    """
+    (unique, index, groups) = cockatoo.screen.unique_cocktails(screen.cocktails)
+    (ph, fps, valid) = cockatoo.metric._global_arrays(unique)
+    return (screen.name, index, ph, fps, valid)
+
+def _resized(fps, ncols):
+    fps = fps.copy()
+    fps.resize((fps.shape[0], ncols))
+    return fps
+
+def _pair_distance(weights, pair):
+    """
+    Private function computing the distance between two screens from their
+    arrays (see :func:`screen_arrays`).
+
+    """
+    ((i, a), (j, b)) = pair
+    (name1, index1, ph1, fps1, valid1) = a
+    (name2, index2, ph2, fps2, valid2) = b
+    ncols = max(fps1.shape[1], fps2.shape[1])
+    dm = cockatoo.metric._cdist(ph1, _resized(fps1, ncols), valid1, ph2, _resized(fps2, ncols), valid2, weights)
+    return (i, j, cockatoo.screen._nearest_from_matrix(dm, index1, index2)[0])
+
+def distance_matrix(paths, weights=None, loaders=DEFAULT_LOADERS, processes=None, buffer=None):
+    """
+    Compute the distance (see :func:`cockatoo.screen.distance`) between all
+    pairs of screens.
+
+    Screens are loaded in threads and fingerprinted in worker processes, and
+    the distances of each new screen to the screens before it are computed in
+    worker processes while the next screens are loaded.
+
+    :param array paths: paths or Xtuition screen ids of the screens
+    :param array weights: weights
+    :param int loaders: number of threads loading screens (default: 4)
+    :param int processes: number of worker processes (default: number of cpus)
+    :param int buffer: maximum number of screens or pairs in flight
+
+    :returns: tuple (names, matrix) of the screen names and the square
+        distance matrix
+    """
+    paths = list(paths)
+    arrays = []
+    workers = pool(processes)
+    loading = Pipeline([Stage(cockatoo.screen.load, loaders, name='load'),
+                        Stage(screen_arrays, processes, True, name='fingerprint')], buffer, workers)
+    distances = Pipeline([Stage(functools.partial(_pair_distance, weights), processes, True, name='distance')], buffer, workers)
+
+    def pairs():
+        for k, a in enumerate(loading.run(paths)):
+            logger.info("Fingerprinted screen %s (%s of %s)" % (a[0], k + 1, len(paths)))
+            arrays.append(a)
+            for j in range(k):
+                yield ((j, arrays[j]), (k, a))
+
+    matrix = np.zeros((len(paths), len(paths)), dtype=np.double)
+    try:
+        for (i, j, dist) in distances.run(pairs()):
+            matrix[i,j] = matrix[j,i] = dist
+    finally:
+        workers.close()
+        workers.join()
+
+    return ([a[0] for a in arrays], matrix)
+
+def write_distance_matrix(names, matrix, out):
+    """
+    Write a square distance matrix in TAB delimited format.
+
+    :param array names: row and column names
+    :param array matrix: the matrix
+    :param file out: file object to write to
+    """
+    out.write('\t'.join(['screen'] + list(names)))
+    out.write('\n')
+    for name, row in zip(names, matrix):
+        out.write('\t'.join([name] + [str(v) for v in row]))
+        out.write('\n')
+
+def _nearest_block(hit_arrays, weights, cocktails):
+    """
+    Private function fingerprinting a block of cocktails and finding the
+    nearest hit of each.
+
+    """
+    (ph2, fps2, valid2) = hit_arrays
+    (ph1, fps1, valid1) = cockatoo.metric._global_arrays(cocktails)
+    ncols = max(fps1.shape[1], fps2.shape[1])
+    dm = cockatoo.metric._cdist(ph1, _resized(fps1, ncols), valid1, ph2, _resized(fps2, ncols), valid2, weights)
+    idx = dm.argmin(axis=1)
+    return (idx, dm[np.arange(len(cocktails)), idx])
+
+def nearest(cocktails, hits, weights=None, processes=None, block_size=None, buffer=None):
+    """
+    Compute the distance from each cocktail to the nearest hit cocktail (see
+    :func:`cockatoo.hits.nearest`), fingerprinting and comparing blocks of
+    cocktails in worker processes.
+
+    :param array cocktails: list of cocktails
+    :param array hits: list of hit cocktails
+    :param array weights: weights
+    :param int processes: number of worker processes (default: number of cpus)
+    :param int block_size: number of cocktails per block
+
+    :returns: tuple (idx, dist) of arrays with the index into hits of and
+        the distance to the nearest hit
+    """
+    n = len(cocktails)
+    idx = np.full(n, -1, dtype=np.intp)
+    dist = np.full(n, np.inf)
+    if n == 0 or len(hits) == 0:
+        return (idx, dist)
+
+    if block_size is None:
+        block_size = cockatoo.metric._BLOCK_SIZE
+    starts = range(0, n, block_size)
+    blocks = (cocktails[start:start + block_size] for start in starts)
+    func = functools.partial(_nearest_block, cockatoo.metric._global_arrays(hits), weights)
+    for start, (i, d) in zip(starts, imap(func, blocks, processes, True, buffer)):
+        idx[start:start + len(i)] = i
+        dist[start:start + len(d)] = d
+
+    return (idx, dist)
@@ -0,0 +1,253 @@
+"""
+Queries over the compounds of one or more screens.
+
+The screens are indexed once into a sparse cocktail x compound incidence
+matrix in CSR layout. Each stored entry is one component with its
+concentration, unit code (see :func:`cockatoo.units.parse_unit`) and molar
+concentration, so filters such as "peg 3350 above 20 % (w/v) at pH > 7" and
+aggregate statistics (compound counts, co-occurrence, concentration
+histograms) are computed with vectorized operations instead of walking the
+cocktail objects. Concentrations given in another unit than the query are
+compared through their molar concentration (see
+:func:`cockatoo.units.to_molarity`).
+
+"""
+import re
+import logging
+import numpy as np
+import scipy.sparse
+import cockatoo
+import cockatoo.units
+
+logger = logging.getLogger(__name__)
+
+_CONDITION_RE = re.compile(r'^\s*(.+?)\s*(>=|<=|==|=|>|<)\s*([-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)\s*(.*?)\s*$')
+
+_OPS = {
+    '>': np.greater,
+    '>=': np.greater_equal,
+    '<': np.less,
+    '<=': np.less_equal,
+    '=': np.isclose,
+    '==': np.isclose,
+}
+
+def normalize_name(name):
+    """
+    :returns: compound name in lower case with whitespace collapsed
+    """
+    return ' '.join(str(name).lower().split())
+
+def parse_condition(text):
+    """
+    Parse a compound condition such as "peg 3350 > 20 % (w/v)",
+    "sodium chloride >= 0.5 M" or just "hepes".
+
+    :returns: tuple (name, op, value, unit) where op, value and unit are None
+        if the condition only requires the compound to be present
+    """
+    m = _CONDITION_RE.match(text)
+    if m is None:
+        return (text.strip(), None, None, None)
+
+    unit = m.group(4) if len(m.group(4)) > 0 else None
+    return (m.group(1), m.group(2), float(m.group(3)), unit)
+
+def parse_ph(text):
+    """
+    Parse a pH condition such as ">7" or "<= 6.5".
+
+    :returns: tuple (op, value)
+    """
+    m = re.match(r'^\s*(>=|<=|==|=|>|<)?\s*([-+]?[0-9]*\.?[0-9]+)\s*$', text)
+    if m is None:
+        raise ValueError('Invalid pH condition: %s' % text)
+    return (m.group(1) if m.group(1) else '=', float(m.group(2)))
+
+class Incidence(object):
+    """
+    Cocktail x compound incidence index of one or more screens.
+
+    :param array screens: screens to index (:class:`cockatoo.Screen`)
+
+    :ivar screen_names: name of each screen
+    :ivar screen: screen index of each cocktail
+    :ivar cocktails: list of cocktails (:class:`cockatoo.Cocktail`)
+    :ivar compounds: compound names, one per column
+    :ivar ph: pH of each cocktail (NaN if missing)
+    :ivar indptr: components of cocktail i are entries indptr[i]:indptr[i+1]
+    :ivar indices: compound (column) of each entry
+    :ivar conc: concentration of each entry (NaN if missing)
+    :ivar unit: unit code of each entry (see :func:`cockatoo.units.parse_unit`)
+    :ivar mw: molecular weight of each entry (NaN if missing)
+    :ivar density: density of each entry (NaN if missing)
+    :ivar molarity: molar concentration of each entry (NaN if unknown)
+
+    """
+
+    def __init__(self, screens):
+        self.screen_names = [s.name for s in screens]
+        self.cocktails = [ck for s in screens for ck in s.cocktails]
+        self.screen = np.repeat(np.arange(len(screens)), [len(s) for s in screens])
+        self.ph = np.array([np.nan if ck.ph is None else ck.ph for ck in self.cocktails], dtype=np.double)
+
+        columns = {}
+        indices = []
+        indptr = [0]
+        for ck in self.cocktails:
+            for cp in ck.components:
+                indices.append(columns.setdefault(cp.name, len(columns)))
+            indptr.append(len(indices))
+
+        components = [cp for ck in self.cocktails for cp in ck.components]
+        self.compounds = sorted(columns, key=columns.get)
+        self.indptr = np.array(indptr, dtype=np.int64)
+        self.indices = np.array(indices, dtype=np.int64)
+        self.conc = np.array([cockatoo.units._float(cp.conc) for cp in components], dtype=np.double)
+        self.unit = np.array([cockatoo.units.parse_unit(cp.unit) for cp in components], dtype=np.int8)
+        self.mw = np.array([cockatoo.units._float(cp.molecular_weight) for cp in components], dtype=np.double)
+        self.density = np.array([cockatoo.units._float(cp.density) for cp in components], dtype=np.double)
+        self.molarity = cockatoo.units.to_molarity(self.conc, self.unit, self.mw, self.density)
+
+        self._lookup = dict((normalize_name(c), i) for i, c in enumerate(self.compounds))
+        self._rows = np.repeat(np.arange(len(self.cocktails)), np.diff(self.indptr))
+        self._order = np.argsort(self.indices, kind='stable')
+        self._colptr = np.concatenate([[0], np.cumsum(np.bincount(self.indices, minlength=len(self.compounds)))])
+
+    def __len__(self):
+        return len(self.cocktails)
+
+    def matrix(self, values=None):
+        """
+        :param array values: value of each entry (default: 1)
+
+        :returns: the cocktail x compound matrix (scipy.sparse.csr_matrix)
+        """
+        if values is None:
+            values = np.ones(len(self.indices), dtype=np.double)
+        return scipy.sparse.csr_matrix((values, self.indices, self.indptr), shape=(len(self), len(self.compounds)))
+
+    def compound(self, name):
+        """
+        :returns: the column of a compound (case insensitive)
+        """
+        key = normalize_name(name)
+        if key not in self._lookup:
+            raise ValueError('Unknown compound: %s' % name)
+        return self._lookup[key]
+
+    def _entries(self, col):
+        return self._order[self._colptr[col]:self._colptr[col+1]]
+
+    def _in_unit(self, entries, unit):
+        """
+        Private method returning the concentrations of entries in a unit:
+        the concentration of entries given in that unit, otherwise their
+        molar concentration converted to the unit (NaN if not convertible).
+
+        """
+        code = cockatoo.units.MOLAR if unit is None else cockatoo.units.parse_unit(unit)
+        if code == cockatoo.units.UNKNOWN:
+            raise ValueError('Unknown concentration unit: %s' % unit)
+
+        # Molarity of one unit of each entry
+        one = cockatoo.units.to_molarity(np.ones(len(entries)), np.full(len(entries), code, dtype=np.int8),
+                                         self.mw[entries], self.density[entries])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.unit[entries] == code, self.conc[entries], self.molarity[entries] / one)
+
+    def where(self, name, op=None, value=None, unit=None):
+        """
+        Find cocktails containing a compound, optionally at a concentration.
+
+        Components given in the unit of value are compared by
+        concentration, others by molar concentration (for example mg/mL
+        against % (w/v) using the molecular weight).
+
+        :param str name: compound name
+        :param str op: comparison >, >=, <, <= or = (default: presence only)
+        :param float value: concentration
+        :param str unit: unit of value, for example "% (w/v)" or "M"
+            (default: M)
+
+        :returns: boolean mask over the cocktails
+        """
+        mask = np.zeros(len(self), dtype=bool)
+        entries = self._entries(self.compound(name))
+        if op is not None:
+            vals = self._in_unit(entries, unit)
+            with np.errstate(invalid='ignore'):
+                entries = entries[_OPS[op](vals, value) & ~np.isnan(vals)]
+
+        mask[self._rows[entries]] = True
+        return mask
+
+    def where_ph(self, op, value):
+        """
+        :returns: boolean mask of the cocktails with a pH satisfying op value
+        """
+        with np.errstate(invalid='ignore'):
+            return _OPS[op](self.ph, value) & ~np.isnan(self.ph)
+
+    def filter(self, conditions=None, ph=None, screen=None):
+        """
+        Find the cocktails matching all conditions.
+
+        :param array conditions: compound conditions as strings (see
+            :func:`parse_condition`) or (name, op, value, unit) tuples
+        :param str ph: pH condition (see :func:`parse_ph`)
+        :param str screen: only include cocktails of this screen
+
+        :returns: boolean mask over the cocktails
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for cond in (conditions or []):
+            if not isinstance(cond, tuple):
+                cond = parse_condition(cond)
+            mask &= self.where(*cond)
+        if ph is not None:
+            mask &= self.where_ph(*parse_ph(ph))
+        if screen is not None:
+            if screen not in self.screen_names:
+                raise ValueError('Unknown screen: %s' % screen)
+            mask &= self.screen == self.screen_names.index(screen)
+        return mask
+
+    def counts(self, mask=None):
+        """
+        :returns: number of times each compound occurs in the cocktails (in
+            mask)
+        """
+        indices = self.indices if mask is None else self.indices[mask[self._rows]]
+        return np.bincount(indices, minlength=len(self.compounds))
+
+    def cooccurrence(self, mask=None):
+        """
+        :returns: compound x compound sparse matrix of the number of cocktails
+            (in mask) containing both compounds
+        """
+        B = self.matrix()
+        if mask is not None:
+            B = B[np.nonzero(mask)[0]]
+        B.data[:] = 1
+        B.sum_duplicates()
+        B.data[:] = 1
+        return (B.T * B).tocsr()
+
+    def histogram(self, name, bins=10, unit=None, mask=None):
+        """
+        Histogram of the concentrations of a compound.
+
+        :param str name: compound name
+        :param int bins: number of bins
+        :param str unit: histogram concentrations in this unit (default: M)
+        :param array mask: only include these cocktails
+
+        :returns: tuple (counts, bin edges) as returned by numpy.histogram
+        """
+        entries = self._entries(self.compound(name))
+        if mask is not None:
+            entries = entries[mask[self._rows[entries]]]
+
+        vals = self._in_unit(entries, unit)
+        return np.histogram(vals[~np.isnan(vals)], bins=bins)
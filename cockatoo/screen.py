@@ -1,12 +1,129 @@
-import csv,re,logging,json
-from e3fp.fingerprint.fprint import Fingerprint,CountFingerprint
-from rdkit import Chem
-from rdkit.Chem import AllChem
+import csv,re,logging,json,hashlib
+import numpy as np
+import scipy.sparse
 from marshmallow import Schema, fields
 import cockatoo
+import cockatoo.units
+import cockatoo.mixture
+import cockatoo.npz
+import cockatoo.query
 
 logger = logging.getLogger(__name__)
 _mol_cache = {}
+_fp_cache = {}
+
+# Revision of the fingerprint computation, part of the version tag
+_FINGERPRINT_REVISION = 2
+
+class FingerprintSettings(object):
+    """
+    Parameters of the compound fingerprints.
+
+    :param int radius: Morgan radius (default: 2)
+    :param int length: Number of bits the fingerprints are folded to (default: 2048)
+    :param bool counts: Count the occurrences of each substructure instead of
+        setting bits (default: False)
+    :param bool dense: Compare cocktail fingerprints as dense vectors of the
+        folded length (see :func:`dense_fingerprint_matrix`) instead of sparse
+        matrices. Only competitive for short lengths such as 256 as cocktail
+        fingerprints are sparse (default: False)
+
+    """
+
+    def __init__(self, radius=2, length=2048, counts=False, dense=False):
+        if radius < 0:
+            raise ValueError('Invalid fingerprint radius: %s' % radius)
+        if length <= 0:
+            raise ValueError('Invalid fingerprint length: %s' % length)
+        self.radius = int(radius)
+        self.length = int(length)
+        self.counts = bool(counts)
+        self.dense = bool(dense)
+
+    def version(self):
+        """
+        :returns: The version tag of the settings. The dense option is not
+            part of the tag as it does not change the fingerprints.
+        """
+        return 'e3fp-morgan-r%s-%s-%s-%s' % (self.radius, self.length, 'count' if self.counts else 'bit', _FINGERPRINT_REVISION)
+
+    def __repr__(self):
+        return "[ %s ]" % ", ".join('%r' % i for i in [self.radius, self.length, self.counts, self.dense])
+
+_settings = FingerprintSettings()
+
+# Version tag of the fingerprint parameters. Fingerprints embedded in screen
+# files are only used if they were computed with the same version.
+FINGERPRINT_VERSION = _settings.version()
+
+def fingerprint_settings():
+    """
+    :returns: The current fingerprint settings (:class:`FingerprintSettings`)
+    """
+    return _settings
+
+def set_fingerprint_settings(settings):
+    """
+    Set the fingerprint parameters. Should be called before loading screens
+    as compounds already fingerprinted keep their fingerprints.
+
+    :param settings settings: The settings (:class:`FingerprintSettings`)
+    """
+    global _settings, FINGERPRINT_VERSION
+    if settings.version() != FINGERPRINT_VERSION:
+        _fp_cache.clear()
+    _settings = settings
+    FINGERPRINT_VERSION = settings.version()
+
+# Patterns used when parsing screens, compiled once
+_COMMENT_RE = re.compile(r'^#')
+_PH_RE = re.compile(r'(?i)ph\s*')
+_PEG_RE = re.compile(r'^((?:peg|polyethylene\sglycol)[^\d]+)(\d+)')
+
+def _morgan_counts(mol, settings):
+    """
+    Private function to compute the folded Morgan fingerprint of a molecule.
+
+    :returns: dict of bit to count (1 unless settings.counts)
+    """
+    from rdkit.Chem import AllChem
+
+    if settings.counts:
+        fp = AllChem.GetHashedMorganFingerprint(mol, settings.radius, nBits=settings.length)
+        return dict((int(k), int(v)) for k,v in fp.GetNonzeroElements().items())
+
+    fp = AllChem.GetMorganFingerprintAsBitVect(mol, settings.radius, nBits=settings.length)
+    return dict((int(k), 1) for k in fp.GetOnBits())
+
+class StoredFingerprint(object):
+    """
+    Compound fingerprint counts loaded from a screen file. Provides the same
+    counts attribute as e3fp's CountFingerprint without importing RDKit.
+
+    """
+
+    def __init__(self, counts):
+        self.counts = counts
+
+class SparseFingerprint(object):
+    """
+    Cocktail fingerprint frozen into arrays of the set bits (sorted) and their
+    values, with the precomputed sum of the values (the L1 norm as values are
+    non-negative).
+
+    """
+    __slots__ = ('bits', 'values', 'total')
+
+    def __init__(self, fp):
+        bits = np.fromiter(fp.keys(), dtype=np.int64, count=len(fp))
+        values = np.fromiter(fp.values(), dtype=np.double, count=len(fp))
+        order = np.argsort(bits)
+        self.bits = bits[order]
+        self.values = values[order]
+        self.total = float(self.values.sum())
+
+    def __len__(self):
+        return len(self.bits)
 
 class Compound(object):
     """
@@ -34,17 +151,17 @@ class Compound(object):
         self.smiles = smiles
 
     def mol(self):
+        from rdkit import Chem
+
         if self.smiles in _mol_cache:
             return _mol_cache[self.smiles]
 
         mol = None
         if self.smiles is not None:
-            try:
-                mol = Chem.MolFromSmiles(self.smiles)
-                mfp = AllChem.GetMorganFingerprintAsBitVect(mol, 2)
-                _mol_cache[self.smiles] = mfp
-            except:
+            mol = Chem.MolFromSmiles(self.smiles)
+            if mol is None:
                 logger.critical("Invalid smiles format, failed to parse smiles for compound: %s" % self.name)
+            _mol_cache[self.smiles] = mol
 
         return mol
 
@@ -60,10 +177,17 @@ class Compound(object):
         except AttributeError:
             pass
 
+        if self.smiles in _fp_cache:
+            self._fp = _fp_cache[self.smiles]
+            return self._fp
+
+        from e3fp.fingerprint.fprint import CountFingerprint
+
         self._fp = CountFingerprint(counts={})
-        if self.mol() is not None:
-            fp = Fingerprint.from_rdkit(self.mol())
-            self._fp = CountFingerprint.from_fingerprint(fp)
+        mol = self.mol()
+        if mol is not None:
+            self._fp = CountFingerprint(counts=_morgan_counts(mol, _settings), bits=_settings.length)
+            _fp_cache[self.smiles] = self._fp
 
         return self._fp
 
@@ -79,18 +203,7 @@ class Compound(object):
         except AttributeError:
             pass
 
-        self._molarity = None
-
-        # If missing unit bail
-        if self.unit is None: return self._molarity
-
-        if re.search(r'w/v', self.unit) and (self.molecular_weight is not None and self.molecular_weight > 0):
-            self._molarity = (self.conc * 10) / float(self.molecular_weight)
-        elif re.search(r'v/v', self.unit) and self.molecular_weight > 0 and self.density is not None:
-            self._molarity =  (self.conc * 0.01) * ((self.density / self.molecular_weight)*1000)
-        elif self.unit.lower() == 'm':
-            self._molarity = self.conc
-
+        self._molarity = cockatoo.units.molarity(self.conc, self.unit, self.molecular_weight, self.density)
         return self._molarity
 
     def __repr__(self):
@@ -106,6 +219,60 @@ class Compound(object):
             ])
 
 
+class Mixture(Compound):
+    """
+    This class represents a commercial mixture (ex. Tacsimate) used as a single
+    compound in a cocktail. See :mod:`cockatoo.mixture`.
+
+    """
+
+    def __init__(self, name, conc, unit, ph=None, mixture=None):
+        """
+        :param str name: Name of the mixture as given in the screen
+        :param float conc: Concentration of the mixture in percent of stock
+        :param str unit: Unit of the concentration (ex. % v/v)
+        :param float ph: ph of the mixture in solution
+        :param mixture mixture: The registered mixture (:class:`cockatoo.mixture.MixtureDefinition`)
+
+        """
+        super(Mixture, self).__init__(name, conc, unit, ph)
+        self.mixture = mixture
+
+    def fingerprint(self):
+        """
+        :returns: The fingerprint embedded in the screen file if any, else the
+            cached fingerprint of the stock solution
+            
+        """
+        fp = getattr(self, '_fp', None)
+        if fp is not None:
+            return fp
+        return self.mixture.fingerprint()
+
+    def molarity(self):
+        """
+        A mixture has no single molarity.
+
+        :returns: None
+
+        """
+        return None
+
+    def fraction(self):
+        """
+        :returns: The fraction of stock solution scaling the mixture fingerprint
+
+        """
+        return self.mixture.fraction(self.conc)
+
+    def components(self):
+        """
+        :returns: The components of the mixture at this concentration
+
+        """
+        return self.mixture.expand(self.conc, self.ph)
+
+
 class Cocktail(object):
     """
     This class represents a cocktail.
@@ -158,7 +325,7 @@ class Cocktail(object):
         self._fp = {}
         for cp in self.components:
             if cp.fingerprint() is None: continue
-            conc_molarity = cp.molarity()
+            conc_molarity = cp.fraction() if isinstance(cp, Mixture) else cp.molarity()
             if conc_molarity == None: conc_molarity = 1
             for k,v in cp.fingerprint().counts.items():
                 self._fp[k] = self._fp.get(k, 0.0) + (float(v) * conc_molarity)
@@ -168,6 +335,49 @@ class Cocktail(object):
 
         return self._fp
 
+    def sparse_fingerprint(self):
+        """
+        The cocktail fingerprint as sorted arrays, computed once from
+        :meth:`fingerprint`.
+
+        :returns: The fingerprint (:class:`SparseFingerprint`) or None
+            
+        """
+        fp = self.fingerprint()
+        cached = getattr(self, '_sfp', None)
+        if cached is not None and cached[0] is fp:
+            return cached[1]
+
+        sfp = None if fp is None else SparseFingerprint(fp)
+        self._sfp = (fp, sfp)
+        return sfp
+
+    def content_hash(self):
+        """
+        Compute a canonical hash of the cocktail contents.
+
+        Two cocktails with the same compounds (compared by normalized name),
+        molar concentrations and pH have the same hash regardless of their
+        names or the order of their components. Compounds which can not be
+        converted to molarity are compared by concentration and unit.
+
+        :returns: The hex digest of the cocktail contents
+            
+        """
+        parts = []
+        for cp in self.components:
+            name = ' '.join(str(cp.name).lower().split())
+            molarity = cp.molarity()
+            if molarity is not None:
+                parts.append('%s|%.6g|M' % (name, molarity))
+            else:
+                unit = '' if cp.unit is None else ''.join(cp.unit.lower().split())
+                parts.append('%s|%r|%s' % (name, cp.conc, unit))
+
+        ph = '' if self.ph is None else '%.6g' % self.ph
+        key = '\n'.join(sorted(parts) + ['ph|%s' % ph])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
     def __repr__(self):
         return "[ %s ]" % ", ".join('%r' % i for i in [self.name,len(self),self.ph])
 
@@ -206,34 +416,54 @@ class Screen(object):
         """
         self.cocktails.append(cocktail)
 
+    def subset(self, indices, name=None):
+        """
+        Create a screen from a subset of the cocktails of this screen. The
+        cocktail objects are shared, not copied.
+
+        :param array indices: indices of the cocktails to include (in order)
+        :param str name: Name of the new screen (default: same name)
+
+        :returns: The screen (:class:`cockatoo.Screen`)
+
+        """
+        return Screen(self.name if name is None else name, [self.cocktails[i] for i in indices])
+
     def print_stats(self):
         """
         Print summary stats for the screen.
 
         """
-        cmap = {}
-        for cocktail in self.cocktails:
-            for c in cocktail.components:
-                cmap[c.name] = cmap.get(c.name, 0) + 1
+        incidence = cockatoo.query.Incidence([self])
+        counts = incidence.counts()
+
+        (unique, index, groups) = unique_cocktails(self.cocktails)
 
         print("Name: %s" % self.name)
         print("Wells: %s" % len(self))
-        print("Distinct Compounds: %s" % len(cmap.keys()))
-        for k in sorted(cmap, key=cmap.get, reverse=True):
-            print("%s: %s" % (k, cmap[k]))
+        print("Unique Cocktails: %s" % len(unique))
+        print("Distinct Compounds: %s" % len(incidence.compounds))
+        for k in sorted(range(len(counts)), key=lambda k: counts[k], reverse=True):
+            print("%s: %s" % (incidence.compounds[k], counts[k]))
+
+        report = cockatoo.units.unconvertible([cp for ck in self.cocktails for cp in ck.components if not isinstance(cp, Mixture)])
+        for (unit, reason) in sorted(report, key=report.get, reverse=True):
+            print("Unconvertible to molarity: %s (%s): %s" % (unit, reason, report[(unit, reason)]))
 
     def _set_summary_stats(self, path):
         """
         Set summary data for each compound (ex. mw,density,smiles).
 
+        """
+        self._set_summary_data(load_summary(path))
+
+    def _set_summary_data(self, data):
+        """
+        Set summary data for each compound from data already loaded with
+        :func:`load_summary`.
+
         """
         cols = ['molecular_weight', 'density']
-        data = {}
-        with open(path) as csvfile:
-            reader = csv.DictReader(csvfile, delimiter="\t")
-            for row in reader:
-                data[row['name'].lower()] = row
-        
         for ck in self.cocktails:
             for cp in ck.components:
                 if cp.name not in data:
@@ -256,9 +486,30 @@ class Screen(object):
                 else:
                     logger.info("Missing smiles data for compound: %s" % cp.name)
 
-    def json(self):
+    def json(self, fingerprints=False):
+        """
+        Serialize the screen to JSON.
+
+        :param bool fingerprints: Embed the compound and cocktail fingerprints
+            tagged with :data:`FINGERPRINT_VERSION` so they are not recomputed
+            when the screen is loaded (default: False)
+
+        :returns: The JSON string
+            
+        """
         schema = ScreenSerializer()
-        return schema.dumps(self).data
+        if not fingerprints:
+            return schema.dumps(self).data
+
+        fingerprint_matrix(self.cocktails)
+        data = schema.dump(self).data
+        data['fingerprint_version'] = FINGERPRINT_VERSION
+        for ck, ck_data in zip(self.cocktails, data['cocktails']):
+            ck_data['fingerprint'] = _dump_fingerprint(ck.fingerprint())
+            for cp, cp_data in zip(ck.components, ck_data['components']):
+                cp_data['fingerprint'] = _dump_fingerprint(cp.fingerprint().counts)
+
+        return json.dumps(data)
 
     def __repr__(self):
         return "[ %s ]" % ", ".join([self.name,str(len(self))])
@@ -282,11 +533,56 @@ class ScreenSerializer(Schema):
     cocktails = fields.Nested(CocktailSerializer, many=True)
     name = fields.String(default=None)
 
+def load_summary(path):
+    """
+    Load compound summary data (ex. mw,density,smiles) in TAB delimited format.
+
+    :param str path: Path to file
+
+    :returns: dict of lower case compound name to row
+        
+    """
+    data = {}
+    with open(path) as csvfile:
+        reader = csv.DictReader(csvfile, delimiter="\t")
+        for row in reader:
+            data[row['name'].lower()] = row
+
+    return data
+
+def save(screen, path, fmt=None, fingerprints=False):
+    """
+    Save a screen in JSON or binary format.
+
+    :param screen screen: The screen
+    :param str path: Path to output file
+    :param str fmt: json or npz (default: npz if path ends in .npz otherwise json)
+    :param bool fingerprints: Embed compound and cocktail fingerprints (default: False)
+
+    """
+    if fmt is None:
+        fmt = 'npz' if path.endswith('.npz') else 'json'
+
+    if fmt == 'npz':
+        cockatoo.npz.save(screen, path, fingerprints)
+    else:
+        with open(path, 'w') as out:
+            out.write(screen.json(fingerprints))
+
 def loads(data):
-    screen_json = json.loads(data, encoding="utf-8")
+    screen_json = json.loads(data)
     return _parse_json(screen_json)
 
 def load(path):
+    """
+    Load a screen from a JSON or binary (.npz) file, or from the Xtuition Api
+    if path is an integer screen id.
+
+    :param str path: Path to file or Xtuition screen id
+
+    :returns: The screen (:class:`cockatoo.Screen`)
+        
+    """
     try:
         # If integer try fetching from xtuition api
         sid = int(path)
@@ -294,8 +590,11 @@ def load(path):
     except(ValueError):
         pass
 
+    if path.endswith('.npz'):
+        return cockatoo.npz.load(path)
+
     with open(path) as f:
-        screen_json = json.load(f, encoding="utf-8")
+        screen_json = json.load(f)
         return _parse_json(screen_json)
 
 def _parse_json(screen_json):
@@ -321,8 +620,14 @@ def _parse_json(screen_json):
 
     screen = Screen(screen_json['name'])
 
+    fingerprints = False
+    if 'fingerprint_version' in screen_json:
+        fingerprints = screen_json['fingerprint_version'] == FINGERPRINT_VERSION
+        if not fingerprints:
+            logger.warning('Ignoring fingerprints computed with version %s (expected %s)' % (screen_json['fingerprint_version'], FINGERPRINT_VERSION))
+
     for ck in screen_json['cocktails']:
-        cocktail = _parse_cocktail_json(ck)
+        cocktail = _parse_cocktail_json(ck, fingerprints)
         if cocktail is None:
             name = ck.get('name', None)
             logger.critical('Invalid json for cocktail %s.. Skipping', name)
@@ -344,7 +649,7 @@ def parse_cocktail(path):
         pass
 
     with open(path) as f:
-        ck = json.load(f, encoding="utf-8")
+        ck = json.load(f)
         return _parse_cocktail_json(ck)
 
 
@@ -358,16 +663,22 @@ def parse_csv(name, path):
     :returns: The screen (:class:`cockatoo.Screen`)
         
     """
-    screen = Screen(name)
-
     with open(path) as csvfile:
-        reader = csv.reader(csvfile)
-        for row in reader:
-            # Skip comments
-            if re.search(r'^#', row[0]): continue
-            cocktail = _parse_cocktail_csv(row)
-            if cocktail is not None:
-                screen.add_cocktail(cocktail)
+        return _parse_csv_file(name, csvfile)
+
+def _parse_csv_file(name, csvfile):
+    """
+    Private function to parse a screen from an open CSV file.
+
+    """
+    screen = Screen(name)
+    reader = csv.reader(csvfile)
+    for row in reader:
+        # Skip comments
+        if len(row) == 0 or _COMMENT_RE.search(row[0]): continue
+        cocktail = _parse_cocktail_csv(row)
+        if cocktail is not None:
+            screen.add_cocktail(cocktail)
 
     return screen
 
@@ -381,13 +692,33 @@ def _parse_float(val):
     return val
 
 
-def _parse_cocktail_json(ck):
+def _dump_fingerprint(fp):
+    """
+    Private function to convert a fingerprint into a JSON serializable dict.
+
+    """
+    if fp is None:
+        return None
+    return dict((int(k), float(v)) for k,v in fp.items())
+
+def _parse_fingerprint_json(fp):
+    """
+    Private function to parse an embedded fingerprint from JSON (bit keys are
+    stored as strings).
+
+    """
+    if fp is None:
+        return None
+    return dict((int(k), float(v)) for k,v in fp.items())
+
+def _parse_cocktail_json(ck, fingerprints=False):
     """
     Private function to parse cocktail data from JSON object
 
     See test screens for example of JSON format.
 
     :param dict ck: JSON object
+    :param bool fingerprints: Use the fingerprints embedded in the JSON object
 
     :returns: The cocktail (:class:`cockatoo.Cocktail`)
 
@@ -418,21 +749,25 @@ def _parse_cocktail_json(ck):
         if not is_valid:
             return None
 
-        compound = Compound(cp['name'].encode('utf-8'), cp['conc'], cp['unit'])
+        compound = Compound(cp['name'], cp['conc'], cp['unit'])
         for key in compound.__dict__.keys():
             if key.startswith('_'): continue
             if key not in cp:
                 continue
             setattr(compound, key, cp[key])
 
-        # handle special case for tacsimate
-        if re.search(r'tacsimate', compound.name, re.IGNORECASE):
-            if not re.search(r'v\/v', compound.unit, re.IGNORECASE):
-                logger.warning('Malformed line, tacsimate should be % v/v: {}'.format(compound))
-            for c in _create_tacsimate(compound):
-                cocktail.add_compound(c)
-        else:
-            cocktail.add_compound(compound)
+        if fingerprints and 'fingerprint' in cp:
+            compound._fp = StoredFingerprint(_parse_fingerprint_json(cp['fingerprint']))
+            if compound.smiles is not None and compound.smiles not in _fp_cache:
+                _fp_cache[compound.smiles] = compound._fp
+
+        compound = _parse_mixture(compound)
+        if isinstance(compound, Mixture) and cockatoo.units.parse_unit(compound.unit) != compound.mixture.unit_code:
+            logger.warning('Malformed line, {} should be {}: {}'.format(compound.mixture.name, compound.mixture.unit, compound))
+        cocktail.add_compound(compound)
+
+    if fingerprints and 'fingerprint' in ck:
+        cocktail._fp = _parse_fingerprint_json(ck['fingerprint'])
                 
     return cocktail
 
@@ -459,7 +794,7 @@ def _parse_cocktail_csv(row):
     """
     cocktail = Cocktail(
         row[0].strip(),
-        _parse_float(re.sub(r'(?i)ph\s*','', row[1].strip()))
+        _parse_float(_PH_RE.sub('', row[1].strip()))
     )
 
     if len(cocktail.name) <= 0:
@@ -477,7 +812,7 @@ def _parse_cocktail_csv(row):
             compounds[index+2].strip(),
             _parse_float(compounds[index].strip()),
             compounds[index+1].strip(),
-            _parse_float(re.sub(r'(?i)ph\s*','', compounds[index+3].strip()))
+            _parse_float(_PH_RE.sub('', compounds[index+3].strip()))
         )
 
         if len(compound.name) > 0:
@@ -493,17 +828,13 @@ def _parse_cocktail_csv(row):
         if compound.ph is not None:
             ph_vals.append(compound.ph)
 
-        matches = re.search(r'^((?:peg|polyethylene\sglycol)[^\d]+)(\d+)', compound.name)
+        matches = _PEG_RE.search(compound.name)
 
-        # handle special case for tacsimate
-        if re.search(r'tacsimate', compound.name, re.IGNORECASE):
-            if not re.search(r'v\/v', compound.unit, re.IGNORECASE):
-                logger.warning('Malformed line, tacsimate should be % v/v: {}'.format(row))
-                return None
-            for c in _create_tacsimate(compound):
-                cocktail.add_compound(c)
-        else:
-            cocktail.add_compound(compound)
+        compound = _parse_mixture(compound)
+        if isinstance(compound, Mixture) and cockatoo.units.parse_unit(compound.unit) != compound.mixture.unit_code:
+            logger.warning('Malformed line, {} should be {}: {}'.format(compound.mixture.name, compound.mixture.unit, row))
+            return None
+        cocktail.add_compound(compound)
 
         index += 4
 
@@ -518,42 +849,159 @@ def _parse_cocktail_csv(row):
 
     return cocktail
 
-# XXX: Tacsimate is mixture. consider adding support for mixtures. For now we hardcode (yuck)
-_TACSIMATE = [
-    {'conc': 1.8305, 'name': 'malonic acid', 'smiles': 'C(C(=O)O)C(=O)O', 'unit': 'M', 'ph': 7.0, 'molecular_weight': 104.06146, 'density': None},
-    {'conc': 0.25, 'name': 'ammonium citrate tribasic', 'smiles': 'C(C(=O)O)C(CC(=O)O)(C(=O)O)O.N.N.N', 'unit': 'M', 'ph': 7.0, 'molecular_weight': 243.21508, 'density': None},
-    {'conc': 0.12, 'name': 'succinic acid', 'smiles': 'C(CC(=O)O)C(=O)O', 'unit': 'M', 'ph': 7.0, 'molecular_weight': 118.088, 'density': None},
-    {'conc': 0.3, 'name': 'dl-malic acid', 'smiles': 'O=C(O)CC(O)C(=O)O', 'unit': 'M', 'ph': 7.0, 'molecular_weight': 134.0874, 'density': None},
-    {'conc': 0.4, 'name': 'sodium acetate trihydrate', 'smiles': '[Na+].[O-]C(=O)C.O.O.O', 'unit': 'M', 'ph': 7.0, 'molecular_weight': 136.0796, 'density': None},
-    {'conc': 0.5, 'name': 'sodium formate', 'smiles': '[Na+].[O-]C=O', 'unit': 'M', 'ph': 7.0, 'molecular_weight': 68.0072, 'density': None},
-    {'conc': 0.16, 'name': 'ammonium tartrate dibasic', 'smiles': 'O=C(O)[C@H](O)[C@@H](O)C(=O)O.N.N', 'unit': 'M', 'ph': 7.0, 'molecular_weight': 184.1479, 'density': None}
-]
+def _parse_mixture(compound):
+    """
+    Private function to replace a compound by a :class:`Mixture` if its name
+    matches a registered mixture (see :mod:`cockatoo.mixture`).
 
-def _create_tacsimate(cp):
     """
-    Private function handle Tacsimate (actually a mixture). See:
-    http://hamptonresearch.com/documents/product/hr000175_what_is_tacsimate_new.pdf
+    mixture = cockatoo.mixture.find(compound.name)
+    if mixture is None:
+        return compound
+    result = Mixture(compound.name, compound.conc, compound.unit, compound.ph, mixture)
+    if hasattr(compound, '_fp'):
+        result._fp = compound._fp
+    return result
+
+def unique_cocktails(cocktails):
+    """
+    Group cocktails with identical contents (see :meth:`Cocktail.content_hash`).
+
+    :param array cocktails: An array of :class:`cockatoo.Cocktail` objects
 
+    :returns: A tuple (unique, index, groups) where unique is the list of
+        distinct cocktails (first occurrence kept), index is an integer array
+        mapping each input cocktail to its position in unique and groups is a
+        list of input index lists for every set of 2 or more duplicates
+        
+    """
+    seen = {}
+    unique = []
+    members = []
+    index = np.zeros(len(cocktails), dtype=np.intp)
+    for i, ck in enumerate(cocktails):
+        key = ck.content_hash()
+        if key not in seen:
+            seen[key] = len(unique)
+            unique.append(ck)
+            members.append([])
+        index[i] = seen[key]
+        members[seen[key]].append(i)
+
+    groups = [m for m in members if len(m) > 1]
+    if len(groups) > 0:
+        logger.info("Found %s unique cocktails out of %s (%s duplicate groups)" % (len(unique), len(cocktails), len(groups)))
+
+    return (unique, index, groups)
+
+def fingerprint_matrix(cocktails):
     """
-    mixture = []
-    for n in _TACSIMATE:
-        mixture.append(Compound(
-            n['name'],
-            n['conc'] * (cp.conc * 0.01), # assume % v/v
-            'M',
-            cp.ph
-        ))
+    Compute the fingerprints for a list of cocktails as a sparse matrix.
 
-        cp.smiles = n['smiles']
-        cp.molecular_weight = n['molecular_weight']
-        cp.density = n['density']
+    Each distinct compound (by smiles) and mixture is fingerprinted once into a
+    sparse compound x bit matrix. The cocktail fingerprints are then computed with a
+    single sparse product of the cocktail x compound matrix of molar
+    concentrations and the compound fingerprints. Cocktails which have not
+    computed their fingerprint yet are assigned the resulting fingerprint so
+    :meth:`Cocktail.fingerprint` returns the same values.
 
-    return mixture
+    :param array cocktails: An array of :class:`cockatoo.Cocktail` objects
+
+    :returns: A tuple (fps, bits) where fps is a scipy.sparse.csr_matrix with
+        one row per cocktail and bits is an array of the fingerprint bit
+        stored in each column. Rows of cocktails without a fingerprint are
+        empty.
+        
+    """
+    compounds = {}
+    compound_fps = []
+    components = []
+    mixtures = []
+    rows = []
+    cols = []
+    for i, ck in enumerate(cocktails):
+        for cp in ck.components:
+            if isinstance(cp, Mixture):
+                key = ('mixture', cp.mixture.name)
+                mixtures.append(len(components))
+            elif cp.smiles is None:
+                continue
+            else:
+                key = cp.smiles
+            j = compounds.get(key)
+            if j is None:
+                j = compounds[key] = len(compound_fps)
+                compound_fps.append(cp.fingerprint().counts)
+            components.append(cp)
+            rows.append(i)
+            cols.append(j)
+
+    vals = cockatoo.units.molarities(components)
+    for k in mixtures:
+        fraction = components[k].fraction()
+        vals[k] = np.nan if fraction is None else fraction
+    vals[np.isnan(vals)] = 1
+
+    bits = np.array(sorted(set(k for counts in compound_fps for k in counts)), dtype=np.int64)
+    indptr = np.zeros(len(compound_fps) + 1, dtype=np.int64)
+    for j, counts in enumerate(compound_fps):
+        indptr[j+1] = indptr[j] + len(counts)
+    indices = np.searchsorted(bits, np.fromiter((k for counts in compound_fps for k in counts), dtype=np.int64, count=indptr[-1]))
+    data = np.fromiter((v for counts in compound_fps for v in counts.values()), dtype=np.double, count=indptr[-1])
+    compound_matrix = scipy.sparse.csr_matrix((data, indices, indptr), shape=(len(compound_fps), len(bits)))
+
+    molarity_matrix = scipy.sparse.csr_matrix((vals, (rows, cols)), shape=(len(cocktails), len(compound_fps)))
+    fps = (molarity_matrix * compound_matrix).tocsr()
+    fps.sort_indices()
+
+    for i, ck in enumerate(cocktails):
+        if hasattr(ck, '_fp'): continue
+        start, end = fps.indptr[i], fps.indptr[i+1]
+        if start == end:
+            ck._fp = None
+        else:
+            ck._fp = dict(zip(bits[fps.indices[start:end]].tolist(), fps.data[start:end].tolist()))
+
+    return (fps, bits)
+
+def dense_fingerprint_matrix(cocktails, length=None, dtype=np.double):
+    """
+    Compute the fingerprints for a list of cocktails folded into dense vectors
+    of a fixed length. Bit k is added to column k modulo length.
+
+    :param array cocktails: An array of :class:`cockatoo.Cocktail` objects
+    :param int length: Length of the vectors (default: the fingerprint length
+        of the current settings)
+    :param dtype dtype: dtype of the vectors (default: float64)
+
+    :returns: array of shape (len(cocktails), length), rows of cocktails
+        without a fingerprint are 0
+        
+    """
+    if length is None:
+        length = _settings.length
+
+    (fps, bits) = fingerprint_matrix(cocktails)
+    dense = np.zeros((len(cocktails), length), dtype=dtype)
+    rows = np.repeat(np.arange(len(cocktails)), np.diff(fps.indptr))
+    np.add.at(dense, (rows, bits[fps.indices] % length), fps.data)
+    return dense
+
+def _distance_matrix(cocktails1, cocktails2, weights):
+    """
+    Private function to compute the full distance matrix between two lists of
+    cocktails.
+
+    """
+    return cockatoo.metric.cdist(cocktails1, cocktails2, weights)
 
 def distance(screen1, screen2, weights):
     """
     Compute the distance between two screens (from Newman et al. 2010).
 
+    Duplicate cocktails within each screen are only compared once and the
+    distance is computed once per pair of unique cocktails.
+
     :param screen screen1: First screen
     :param screen screen2: Second screen
     :param array weights: weights
@@ -561,45 +1009,109 @@ def distance(screen1, screen2, weights):
     :returns: The distance score between 0 and 1
         
     """
-    sum1 = 0.0
-    for c1 in screen1.cocktails:
-        mini = 100000000
-        for c2 in screen2.cocktails:
-            distance = cockatoo.metric.distance(c1, c2, weights)
-            if mini > distance:
-                mini = distance
-        sum1 += mini
-
-    sum2 = 0.0
-    for c1 in screen2.cocktails:
-        mini = 100000000
-        for c2 in screen1.cocktails:
-            distance = cockatoo.metric.distance(c1, c2, weights)
-            if mini > distance:
-                mini = distance
-        sum2 += mini
-
-    score = ( (sum1/float(len(screen1))) + (sum2/float(len(screen2))) )/2.0
-    return score
+    return _nearest_wells(screen1, screen2, weights)[0]
+
+def distance_mapping(screen1, screen2, weights):
+    """
+    Compute the distance between two screens along with the nearest well in
+    the other screen of every cocktail of both screens, in the same pass.
+
+    :param screen screen1: First screen
+    :param screen screen2: Second screen
+    :param array weights: weights
+
+    :returns: A tuple (score, mapping) where score is the distance score (see
+        :func:`distance`) and mapping is a list of tuples (screen, cocktail,
+        nearest screen, nearest cocktail, distance, ph distance, fingerprint
+        distance) with one row per cocktail of screen1 followed by screen2.
+        The pH and fingerprint distances are None if undefined.
+        
+    """
+    (score, nearest) = _nearest_wells(screen1, screen2, weights)
+
+    mapping = []
+    for (s1, s2, (near, dist)) in ((screen1, screen2, nearest[0]), (screen2, screen1, nearest[1])):
+        for i, ck in enumerate(s1.cocktails):
+            other = s2.cocktails[near[i]]
+            ph = cockatoo.metric.ph_distance(ck, other)
+            fp = cockatoo.metric.fp_distance(ck, other)
+            mapping.append((s1.name, ck.name, s2.name, other.name, float(dist[i]), ph, fp))
+
+    return (score, mapping)
+
+def write_mapping(mapping, out):
+    """
+    Write the nearest well mapping of :func:`distance_mapping` in TAB
+    delimited format, one row at a time.
+
+    :param array mapping: the mapping
+    :param file out: file object to write to
+        
+    """
+    out.write('\t'.join(['screen', 'cocktail', 'nearest_screen', 'nearest', 'distance', 'ph_distance', 'fp_distance']))
+    out.write('\n')
+    for row in mapping:
+        out.write('\t'.join('' if v is None else str(v) for v in row))
+        out.write('\n')
+
+def _nearest_wells(screen1, screen2, weights):
+    """
+    Private function to compute the screen distance and, for every cocktail
+    of each screen, the index of and distance to its nearest cocktail in the
+    other screen.
+
+    """
+    (unique1, index1, groups1) = unique_cocktails(screen1.cocktails)
+    (unique2, index2, groups2) = unique_cocktails(screen2.cocktails)
+    dm = _distance_matrix(unique1, unique2, weights)
+    return _nearest_from_matrix(dm, index1, index2)
+
+def _nearest_from_matrix(dm, index1, index2):
+    """
+    Private function computing the result of :func:`_nearest_wells` from the
+    distance matrix between the unique cocktails of two screens, where index1
+    and index2 map each cocktail to its unique cocktail.
+
+    """
+    (m1, m2) = dm.shape
+    counts1 = np.bincount(index1, minlength=m1)
+    counts2 = np.bincount(index2, minlength=m2)
+
+    arg1 = dm.argmin(axis=1)
+    arg2 = dm.argmin(axis=0)
+    min1 = dm[np.arange(m1), arg1]
+    min2 = dm[arg2, np.arange(m2)]
+
+    sum1 = float((min1 * counts1).sum())
+    sum2 = float((min2 * counts2).sum())
+
+    score = ( (sum1/float(len(index1))) + (sum2/float(len(index2))) )/2.0
+
+    # First well of each unique cocktail
+    first1 = np.unique(index1, return_index=True)[1]
+    first2 = np.unique(index2, return_index=True)[1]
+    nearest = (
+        (first2[arg1[index1]], min1[index1]),
+        (first1[arg2[index2]], min2[index2]),
+    )
+    return (score, nearest)
 
 def internal_similarity(s, weights):
     """
     Compute the internal diversity within a screen (from Newman et al. 2010).
 
+    Duplicate cocktails are only compared once and weighted by the number of
+    times they occur in the screen.
+
     :param screen s: The screen
     :param array weights: weights
 
     :returns: The diversity score between 0 and 1
         
     """
-    sum_avg = 0
-    for c1 in s.cocktails:
-        isum = 0
-        n = 0
-        for c2 in s.cocktails:
-            isum += cockatoo.metric.distance(c1, c2, weights)
-            n += 1
+    (unique, index, groups) = unique_cocktails(s.cocktails)
+    counts = np.bincount(index, minlength=len(unique)).astype(np.double)
 
-        sum_avg += isum / n
+    dm = _distance_matrix(unique, unique, weights)
 
-    return sum_avg / len(s)
+    return float(counts.dot(dm).dot(counts)) / (len(s) * len(s))
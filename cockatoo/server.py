@@ -0,0 +1,297 @@
+"""
+Local JSON API serving distance queries against preloaded screens.
+
+Screens, the compound summary data and clustering models are loaded once when
+the service starts. The fingerprint matrices of the screens are computed once
+and kept in memory, and screen level results (isim, sdist) are cached, so each
+request only fingerprints the cocktails it contains. Every endpoint accepts a
+batch of cocktails which are compared in a single vectorized call.
+
+The service uses only the Python standard library and listens on a local TCP
+port or a Unix socket. Requests are POSTed as JSON objects and cocktails are
+given either in cockatoo JSON format or as a reference to a loaded cocktail
+``{"screen": "name", "cocktail": "name"}``::
+
+    GET  /status   loaded screens and models
+    POST /cdist    {"cocktails1": [...], "cocktails2": [...], "weights": [1,1]}
+    POST /sdist    {"screen1": "name", "screen2": "name", "weights": [1,1]}
+    POST /isim     {"screen": "name", "weights": [1,1]}
+    POST /nearest  {"screen": "name", "cocktails": [...], "k": 5, "weights": [1,1]}
+    POST /assign   {"model": "name", "cocktails": [...]}
+
+Responses are JSON objects with a ``result`` key, or an ``error`` key and HTTP
+status 400 for invalid requests.
+
+"""
+import os
+import json
+import logging
+import socketserver
+import numpy as np
+import cockatoo
+import cockatoo.model
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of distances computed at a time for nearest queries
+_CHUNK_SIZE = 1 << 22
+
+class Service(object):
+    """
+    Preloaded screens, compound data and models answering API requests.
+
+    :param array screens: screens to serve (:class:`cockatoo.Screen`), keyed
+        by screen name
+    :param dict summary: compound summary data (see
+        :func:`cockatoo.screen.load_summary`) used to complete cocktails given
+        in requests (default: None)
+    :param dict models: clustering models (:class:`cockatoo.model.ClusterModel`)
+        keyed by name (default: None)
+
+    """
+
+    def __init__(self, screens, summary=None, models=None):
+        self.screens = dict((s.name, s) for s in screens)
+        self.summary = summary
+        self.models = models if models is not None else {}
+        self._arrays = {}
+        self._names = {}
+        self._results = {}
+
+        # Fingerprint bits are below the fingerprint length, so the cached and
+        # query matrices all get this many columns and are never resized
+        # while other request threads read them
+        self._ncols = cockatoo.screen.fingerprint_settings().length
+
+        for name, s in self.screens.items():
+            logger.info("Fingerprinting screen %s (%s cocktails)..." % (name, len(s)))
+            self._arrays[name] = self._query_arrays(s.cocktails)
+            self._names[name] = dict((ck.name, i) for i, ck in enumerate(s.cocktails))
+
+    def handle(self, endpoint, request):
+        """
+        Answer a request.
+
+        :param str endpoint: status, cdist, sdist, isim, nearest or assign
+        :param dict request: the decoded JSON request
+
+        :returns: the result (JSON serializable)
+        """
+        handlers = {
+            'status': self.status,
+            'cdist': self.cdist,
+            'sdist': self.sdist,
+            'isim': self.isim,
+            'nearest': self.nearest,
+            'assign': self.assign,
+        }
+        if endpoint not in handlers:
+            raise ValueError('Unknown endpoint: %s' % endpoint)
+        if not isinstance(request, dict):
+            raise ValueError('Request must be a JSON object')
+        return handlers[endpoint](request)
+
+    def status(self, request):
+        return {
+            'version': cockatoo.__version__,
+            'screens': dict((name, len(s)) for name, s in self.screens.items()),
+            'models': dict((name, len(m)) for name, m in self.models.items()),
+        }
+
+    def cdist(self, request):
+        cocktails1 = self._cocktails(request, 'cocktails1')
+        cocktails2 = self._cocktails(request, 'cocktails2')
+        dist = self._distances(cocktails1, self._query_arrays(cocktails2), self._weights(request))
+        return {
+            'cocktails1': [ck.name for ck in cocktails1],
+            'cocktails2': [ck.name for ck in cocktails2],
+            'distances': dist.tolist(),
+        }
+
+    def sdist(self, request):
+        s1 = self._screen(request, 'screen1')
+        s2 = self._screen(request, 'screen2')
+        weights = self._weights(request)
+        key = ('sdist', s1.name, s2.name, tuple(weights))
+        if key not in self._results:
+            self._results[key] = cockatoo.screen.distance(s1, s2, weights)
+        return {'screen1': s1.name, 'screen2': s2.name, 'distance': self._results[key]}
+
+    def isim(self, request):
+        s = self._screen(request, 'screen')
+        weights = self._weights(request)
+        key = ('isim', s.name, tuple(weights))
+        if key not in self._results:
+            self._results[key] = cockatoo.screen.internal_similarity(s, weights)
+        return {'screen': s.name, 'internal_similarity': self._results[key]}
+
+    def nearest(self, request):
+        s = self._screen(request, 'screen')
+        cocktails = self._cocktails(request, 'cocktails')
+        k = int(request.get('k', 5))
+        weights = self._weights(request)
+
+        arrays = self._arrays[s.name]
+        n = len(s)
+        result = []
+        rows = max(1, _CHUNK_SIZE // max(1, n))
+        for start in range(0, len(cocktails), rows):
+            block = cocktails[start:start + rows]
+            dist = self._distances(block, arrays, weights)
+            for ck, d in zip(block, dist):
+                order = np.argsort(d, kind='stable')[:k]
+                result.append({
+                    'cocktail': ck.name,
+                    'nearest': [{'cocktail': s.cocktails[i].name, 'id': int(i), 'distance': float(d[i])} for i in order],
+                })
+        return result
+
+    def assign(self, request):
+        name = request.get('model')
+        if name not in self.models:
+            raise ValueError('Unknown model: %s' % name)
+        m = self.models[name]
+        result = []
+        for ck in self._cocktails(request, 'cocktails'):
+            (cl, dist, medoid, novel) = m.assign(ck)
+            result.append({'cocktail': ck.name, 'cluster': cl, 'distance': dist, 'medoid': m.names[medoid], 'novel': novel})
+        return result
+
+    def _weights(self, request):
+        weights = request.get('weights', [1.0, 1.0])
+        if not isinstance(weights, list) or len(weights) != 2 or sum(weights) <= 0:
+            raise ValueError('weights must be of the form [w1, w2] with sum > 0')
+        return [float(w) for w in weights]
+
+    def _screen(self, request, key):
+        name = request.get(key)
+        if name not in self.screens:
+            raise ValueError('Unknown screen: %s' % name)
+        return self.screens[name]
+
+    def _cocktails(self, request, key):
+        """
+        Private method to parse the cocktails of a request, completing new
+        cocktails with the compound summary data.
+
+        """
+        items = request.get(key)
+        if not isinstance(items, list) or len(items) == 0:
+            raise ValueError('%s must be a non empty list of cocktails' % key)
+
+        cocktails = []
+        new = []
+        for item in items:
+            if not isinstance(item, dict):
+                raise ValueError('Invalid cocktail: %s' % item)
+            if 'screen' in item:
+                s = self._screen(item, 'screen')
+                if item.get('cocktail') not in self._names[s.name]:
+                    raise ValueError('Unknown cocktail %s in screen %s' % (item.get('cocktail'), s.name))
+                cocktails.append(s.cocktails[self._names[s.name][item['cocktail']]])
+            else:
+                try:
+                    ck = cockatoo.screen._parse_cocktail_json(item)
+                except Exception as e:
+                    raise ValueError('Invalid cocktail: %s' % e)
+                cocktails.append(ck)
+                new.append(ck)
+
+        if self.summary is not None and len(new) > 0:
+            cockatoo.screen.Screen('request', new)._set_summary_data(self.summary)
+        return cocktails
+
+    def _query_arrays(self, cocktails):
+        (ph, fps, valid) = cockatoo.metric._global_arrays(cocktails)
+        if fps.shape[1] > self._ncols:
+            raise ValueError('Fingerprint bit %s exceeds the fingerprint length %s' % (fps.shape[1] - 1, self._ncols))
+        fps.resize((fps.shape[0], self._ncols))
+        return (ph, fps.tocsc(), valid)
+
+    def _distances(self, cocktails, arrays, weights):
+        """
+        Private method to compute the distances between cocktails and the
+        cocktails of cached arrays in one batch.
+
+        """
+        (ph1, fps1, valid1) = self._query_arrays(cocktails)
+        (ph2, fps2, valid2) = arrays
+        return cockatoo.metric._cdist(ph1, fps1, valid1, ph2, fps2, valid2, weights)
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP request handler passing JSON requests to the service.
+
+    """
+
+    def do_GET(self):
+        self._respond(self.path.strip('/').split('?')[0], {})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8')) if length > 0 else {}
+        except ValueError as e:
+            self._send(400, {'error': 'Invalid JSON: %s' % e})
+            return
+        self._respond(self.path.strip('/').split('?')[0], request)
+
+    def _respond(self, endpoint, request):
+        try:
+            result = self.server.service.handle(endpoint, request)
+        except ValueError as e:
+            self._send(400, {'error': str(e)})
+            return
+        except Exception as e:
+            logger.exception("Failed to handle request %s" % endpoint)
+            self._send(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+            return
+        self._send(200, {'result': result})
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, fmt, *args):
+        logger.info("%s %s" % (self.address_string(), fmt % args))
+
+class _TCPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(service, host='127.0.0.1', port=8765, socket_path=None):
+    """
+    Create the HTTP server for a service.
+
+    :param service service: The service (:class:`Service`)
+    :param str host: address to listen on (default: 127.0.0.1)
+    :param int port: port to listen on, 0 picks a free port (default: 8765)
+    :param str socket_path: listen on a Unix socket at this path instead of
+        a TCP port (default: None)
+
+    :returns: The server, call serve_forever() to start answering requests
+    """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _UnixServer(socket_path, _RequestHandler)
+    else:
+        server = _TCPServer((host, port), _RequestHandler)
+
+    server.service = service
+    return server
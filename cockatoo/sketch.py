@@ -0,0 +1,298 @@
+"""
+Approximate cocktail similarity search using weighted MinHash sketches.
+
+Each cocktail fingerprint (weighted bit counts, see
+:meth:`cockatoo.screen.Cocktail.fingerprint`) is summarized by a fixed size
+sketch computed with Improved Consistent Weighted Sampling (Ioffe 2010). The
+probability that two sketches agree at a position is the weighted Jaccard
+similarity J = sum(min(a,b)) / sum(max(a,b)) of the fingerprints, which is
+related to the Bray-Curtis dissimilarity by::
+
+    BC = 1 - 2J / (1 + J)
+
+Sketches are split into bands and hashed into sorted band tables
+(locality-sensitive hashing). A query only looks up its own band keys to find
+candidate cocktails which are then re-ranked with the exact cocktail distance
+(:func:`cockatoo.metric.cdist`). With ``b`` bands of ``r`` rows a cocktail with
+weighted Jaccard similarity J becomes a candidate with probability
+``1 - (1 - J**r)**b``: more bands increase recall, more rows per band reduce
+the number of candidates (and latency).
+
+Cocktails without a fingerprint are always re-ranked exactly as their
+distance only depends on pH.
+
+"""
+import logging
+import numpy as np
+import cockatoo
+import cockatoo.npz
+
+logger = logging.getLogger(__name__)
+
+SKETCH_VERSION = 2
+
+# Sketch value of cocktails without a fingerprint
+_EMPTY = np.iinfo(np.int64).min
+
+# Number of fingerprint entries x hashes sketched at a time
+_CHUNK_SIZE = 1 << 22
+
+class SketchIndex(object):
+    """
+    Index of cocktail sketches for approximate nearest neighbor search.
+
+    :param array cocktails: list of cocktails to index
+    :param int num_hashes: sketch length (default: 64)
+    :param int bands: number of LSH bands, must divide num_hashes (default: 16)
+    :param int seed: random seed of the hash functions (default: 0)
+
+    The length of the fingerprint bit vectors is taken from the current
+    fingerprint settings (see :class:`cockatoo.screen.FingerprintSettings`).
+
+    """
+
+    def __init__(self, cocktails, num_hashes=64, bands=16, seed=0, sketches=None, tables=None):
+        if num_hashes % bands != 0:
+            raise ValueError('Number of bands (%s) must divide the number of hashes (%s)' % (bands, num_hashes))
+
+        self.cocktails = cocktails
+        self.num_hashes = num_hashes
+        self.bands = bands
+        self.seed = seed
+        self.num_bits = cockatoo.screen.fingerprint_settings().length
+        self._random = _random_tables(num_hashes, self.num_bits, seed)
+        self._multipliers = _band_multipliers(num_hashes // bands, seed)
+        self._ph = np.array([np.nan if ck.ph is None else ck.ph for ck in cocktails], dtype=np.double)
+
+        if sketches is None:
+            logger.info("Sketching %s cocktails..." % len(cocktails))
+            (fps, bits) = cockatoo.screen.fingerprint_matrix(cocktails)
+            sketches = _sketch_matrix(fps, bits, self._random)
+
+        if len(sketches) != len(cocktails):
+            raise ValueError('Number of sketches (%s) does not match number of cocktails (%s)' % (len(sketches), len(cocktails)))
+
+        self.sketches = sketches
+        self._empty = np.nonzero(sketches[:,0] == _EMPTY)[0] if len(sketches) > 0 else np.zeros(0, dtype=np.intp)
+
+        if tables is None:
+            tables = self._build_tables()
+        self._tables = tables
+
+    def __len__(self):
+        return len(self.cocktails)
+
+    def _build_tables(self):
+        """
+        Private method to build the sorted band tables. Each band is stored as
+        a pair (keys, order) of the sorted band keys and cocktail indices.
+
+        """
+        keys = _band_keys(self.sketches, self.bands, self._multipliers)
+        valid = self.sketches[:,0] != _EMPTY if len(self.sketches) > 0 else np.zeros(0, dtype=bool)
+        tables = []
+        for b in range(self.bands):
+            idx = np.nonzero(valid)[0]
+            order = idx[np.argsort(keys[idx, b], kind='stable')]
+            tables.append((keys[order, b], order))
+        return tables
+
+    def sketch(self, cocktail):
+        """
+        Compute the sketch of a cocktail.
+
+        :returns: array of length num_hashes
+        """
+        (fps, bits) = cockatoo.screen.fingerprint_matrix([cocktail])
+        return _sketch_matrix(fps, bits, self._random)[0]
+
+    def candidates(self, sketch):
+        """
+        Find the indexed cocktails sharing at least one band with a sketch.
+
+        :returns: sorted array of cocktail indices
+        """
+        if sketch[0] == _EMPTY:
+            return np.zeros(0, dtype=np.intp)
+
+        keys = _band_keys(sketch[None,:], self.bands, self._multipliers)[0]
+        found = []
+        for b, (table_keys, order) in enumerate(self._tables):
+            lo = np.searchsorted(table_keys, keys[b], 'left')
+            hi = np.searchsorted(table_keys, keys[b], 'right')
+            if hi > lo:
+                found.append(order[lo:hi])
+
+        if len(found) == 0:
+            return np.zeros(0, dtype=np.intp)
+        return np.unique(np.concatenate(found))
+
+    def query(self, cocktail, k=10, weights=None, max_candidates=None):
+        """
+        Find the approximate k nearest cocktails to a cocktail.
+
+        Candidates from the band tables are re-ranked with the exact cocktail
+        distance. If there are more than max_candidates candidates only those
+        with the highest estimated similarity are re-ranked.
+
+        :param cocktail cocktail: query cocktail
+        :param int k: number of neighbors (default: 10)
+        :param array weights: weights
+        :param int max_candidates: maximum number of candidates to re-rank
+            (default: all)
+
+        :returns: list of (index, distance) tuples sorted by distance
+        """
+        sketch = self.sketch(cocktail)
+        if sketch[0] == _EMPTY:
+            # Without a fingerprint the distance only depends on pH
+            ph = np.full(len(self), np.nan) if cocktail.ph is None else np.abs(self._ph - cocktail.ph) / 14.0
+            dist = cockatoo.metric._combine(ph, np.full(len(self), np.nan), weights)
+            return _top(np.arange(len(self)), dist, k)
+
+        cand = self.candidates(sketch)
+        if max_candidates is not None and len(cand) > max_candidates:
+            est = (self.sketches[cand] == sketch[None,:]).sum(axis=1)
+            cand = np.sort(cand[np.argsort(-est, kind='stable')[:max_candidates]])
+
+        cand = np.concatenate([cand, self._empty])
+        if len(cand) == 0:
+            return []
+
+        dist = cockatoo.metric.cdist([cocktail], [self.cocktails[i] for i in cand], weights)[0]
+        return _top(cand, dist, k)
+
+    def save(self, path):
+        """
+        Save the sketches and band tables along with the fingerprint version.
+        The cocktails are not saved and must be passed to :func:`load`.
+
+        :param str path: Path to output file (.npz)
+        """
+        arrays = {
+            'sketch_version': np.array([SKETCH_VERSION], dtype=np.int32),
+            'params': np.array([self.num_hashes, self.bands, self.seed, self.num_bits], dtype=np.int64),
+            'fingerprint_version': np.frombuffer(cockatoo.screen.FINGERPRINT_VERSION.encode('utf-8'), dtype=np.uint8),
+            'sketches': self.sketches,
+        }
+        for b, (keys, order) in enumerate(self._tables):
+            arrays['band%s_keys' % b] = keys
+            arrays['band%s_order' % b] = order
+
+        with open(path, 'wb') as out:
+            np.savez(out, **arrays)
+
+def load(path, cocktails, mmap=True):
+    """
+    Load a sketch index saved with :meth:`SketchIndex.save`.
+
+    :param str path: Path to file
+    :param array cocktails: the indexed cocktails in the same order
+    :param bool mmap: Memory map the arrays instead of reading them (default: True)
+
+    :returns: The index (:class:`SketchIndex`)
+    """
+    data = cockatoo.npz.load_arrays(path, mmap)
+    if int(data['sketch_version'][0]) != SKETCH_VERSION:
+        raise ValueError('Unsupported sketch index version: %s' % data['sketch_version'][0])
+
+    version = data['fingerprint_version'].tobytes().decode('utf-8')
+    if version != cockatoo.screen.FINGERPRINT_VERSION:
+        raise ValueError('Sketch index built with fingerprint version %s (expected %s)' % (version, cockatoo.screen.FINGERPRINT_VERSION))
+
+    (num_hashes, bands, seed, num_bits) = [int(p) for p in data['params']]
+
+    tables = [(data['band%s_keys' % b], data['band%s_order' % b]) for b in range(bands)]
+    return SketchIndex(cocktails, num_hashes, bands, seed, data['sketches'], tables)
+
+def estimate_distance(sketch1, sketch2):
+    """
+    Estimate the Bray-Curtis dissimilarity of two fingerprints from their
+    sketches.
+
+    :returns: distance between 0 and 1, or None if either fingerprint is missing
+    """
+    if sketch1[0] == _EMPTY or sketch2[0] == _EMPTY:
+        return None
+
+    j = float(np.mean(np.asarray(sketch1) == np.asarray(sketch2)))
+    return 1.0 - 2.0*j / (1.0 + j)
+
+def _top(idx, dist, k):
+    order = np.argsort(dist, kind='stable')[:k]
+    return [(int(idx[i]), float(dist[i])) for i in order]
+
+def _random_tables(num_hashes, num_bits, seed):
+    """
+    Private function to draw the random variables of consistent weighted
+    sampling for every (hash, bit) pair.
+
+    """
+    rng = np.random.RandomState(seed)
+    r = rng.gamma(2.0, 1.0, (num_hashes, num_bits))
+    log_c = np.log(rng.gamma(2.0, 1.0, (num_hashes, num_bits)))
+    beta = rng.uniform(0.0, 1.0, (num_hashes, num_bits))
+    return (r, log_c, beta)
+
+def _band_multipliers(rows, seed):
+    rng = np.random.RandomState(seed + 1)
+    return (rng.randint(1, 1 << 62, size=rows, dtype=np.int64).astype(np.uint64) << np.uint64(1)) | np.uint64(1)
+
+def _band_keys(sketches, bands, multipliers):
+    """
+    Private function to hash each band of the sketches to a single key.
+
+    """
+    rows = len(multipliers)
+    s = np.ascontiguousarray(sketches).view(np.uint64).reshape(len(sketches), bands, rows)
+    return (s * multipliers[None,None,:]).sum(axis=2, dtype=np.uint64)
+
+def _sketch_matrix(fps, bits, random):
+    """
+    Private function to sketch the rows of a sparse fingerprint matrix (see
+    :func:`cockatoo.screen.fingerprint_matrix`) using Improved Consistent
+    Weighted Sampling. Each sketch value encodes the sampled (bit, t) pair as
+    t * num_bits + bit.
+
+    """
+    (r, log_c, beta) = random
+    (num_hashes, num_bits) = r.shape
+    n = fps.shape[0]
+    sketches = np.full((n, num_hashes), _EMPTY, dtype=np.int64)
+
+    if len(bits) > 0 and bits[-1] >= num_bits:
+        raise ValueError('Fingerprint bit %s out of range (%s bits)' % (bits[-1], num_bits))
+
+    counts = np.diff(fps.indptr)
+    rows_per_chunk = max(1, _CHUNK_SIZE // max(1, num_hashes * max(1, int(counts.max()) if n > 0 else 1)))
+    for start in range(0, n, rows_per_chunk):
+        end = min(n, start + rows_per_chunk)
+        lo = fps.indptr[start]
+        hi = fps.indptr[end]
+        bit = bits[fps.indices[lo:hi]]
+        w = fps.data[lo:hi]
+        keep = w > 0
+        seg = np.repeat(np.arange(start, end), counts[start:end])[keep]
+        bit = bit[keep]
+        w = w[keep]
+
+        # Rows whose weights are all 0 stay empty
+        rows = np.unique(seg)
+        if len(rows) == 0: continue
+        seg = np.searchsorted(rows, seg)
+
+        rb = r[:, bit]
+        bb = beta[:, bit]
+        t = np.floor(np.log(w)[None,:] / rb + bb)
+        log_a = log_c[:, bit] - rb * (t - bb + 1.0)
+
+        starts = np.searchsorted(seg, np.arange(len(rows)))
+        mins = np.minimum.reduceat(log_a, starts, axis=1)
+        (hh, ee) = np.nonzero(log_a == mins[:, seg])
+        (_, first) = np.unique(hh * len(rows) + seg[ee], return_index=True)
+        pick = ee[first].reshape(num_hashes, len(rows))
+
+        vals = t[np.arange(num_hashes)[:,None], pick].astype(np.int64) * num_bits + bit[pick]
+        sketches[rows] = vals.T
+
+    return sketches
@@ -0,0 +1,158 @@
+"""
+Concentration units and conversion to molarity.
+
+Unit strings are parsed once per distinct string into one of the unit codes
+below, ignoring case, whitespace and parentheses (so ``% (w/v)``, ``%w/v`` and
+``w/v`` are the same unit). Molar concentrations are then computed for whole
+arrays of concentrations, molecular weights and densities at once.
+
+========== ===================================================
+unit       molarity
+========== ===================================================
+M          conc
+mM         conc / 1e3
+uM         conc / 1e6
+% (w/v)    conc * 10 / mw
+% (w/w)    conc * 10 / mw (assuming a solution density of 1)
+% (v/v)    conc * 10 * density / mw (density in g/mL)
+mg/mL, g/L conc / mw
+========== ===================================================
+
+"""
+import re
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+UNKNOWN = 0
+MOLAR = 1
+MILLIMOLAR = 2
+MICROMOLAR = 3
+PERCENT_WV = 4
+PERCENT_WW = 5
+PERCENT_VV = 6
+MG_PER_ML = 7
+
+NAMES = ('unknown', 'M', 'mM', 'uM', '% (w/v)', '% (w/w)', '% (v/v)', 'mg/mL')
+
+_ALIASES = {
+    'm': MOLAR,
+    'mol/l': MOLAR,
+    'mm': MILLIMOLAR,
+    'mmol/l': MILLIMOLAR,
+    'um': MICROMOLAR,
+    u'µm': MICROMOLAR,
+    u'μm': MICROMOLAR,
+    '%w/v': PERCENT_WV,
+    'w/v': PERCENT_WV,
+    '%w/w': PERCENT_WW,
+    'w/w': PERCENT_WW,
+    '%v/v': PERCENT_VV,
+    'v/v': PERCENT_VV,
+    'mg/ml': MG_PER_ML,
+    'g/l': MG_PER_ML,
+}
+
+_unit_cache = {}
+
+def parse_unit(unit):
+    """
+    Parse a unit string into a unit code. Results are cached per distinct
+    string and unknown units are logged once.
+
+    :param str unit: the unit (ex. M, % (w/v))
+
+    :returns: the unit code (UNKNOWN if not recognized or None)
+    """
+    try:
+        return _unit_cache[unit]
+    except KeyError:
+        pass
+
+    code = UNKNOWN
+    if unit is not None:
+        key = re.sub(r'[\s()]', '', unit).lower()
+        code = _ALIASES.get(key, UNKNOWN)
+        if code == UNKNOWN:
+            logger.warning("Unknown concentration unit: %s" % unit)
+
+    _unit_cache[unit] = code
+    return code
+
+def to_molarity(conc, codes, mw, density):
+    """
+    Convert arrays of concentrations to molarity.
+
+    :param array conc: concentrations (NaN if missing)
+    :param array codes: unit codes (see :func:`parse_unit`)
+    :param array mw: molecular weights (NaN if missing)
+    :param array density: densities in g/mL (NaN if missing)
+
+    :returns: array of molar concentrations, NaN where the concentration can
+        not be converted
+    """
+    conc = np.asarray(conc, dtype=np.double)
+    codes = np.asarray(codes)
+    mw = np.asarray(mw, dtype=np.double)
+    density = np.asarray(density, dtype=np.double)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mw = np.where(mw > 0, mw, np.nan)
+        return np.select(
+            [codes == MOLAR, codes == MILLIMOLAR, codes == MICROMOLAR,
+             (codes == PERCENT_WV) | (codes == PERCENT_WW), codes == PERCENT_VV, codes == MG_PER_ML],
+            [conc, conc / 1e3, conc / 1e6,
+             conc * 10 / mw, conc * 10 * density / mw, conc / mw],
+            np.nan)
+
+def molarity(conc, unit, mw=None, density=None):
+    """
+    Convert a single concentration to molarity.
+
+    :returns: The molar concentration or None if missing data
+    """
+    m = float(to_molarity(_float(conc), parse_unit(unit), _float(mw), _float(density)))
+    return None if m != m else m
+
+def molarities(compounds):
+    """
+    Compute the molar concentrations of a list of compounds at once.
+
+    :param array compounds: list of compounds (:class:`cockatoo.Compound`)
+
+    :returns: array of molar concentrations, NaN where unknown
+    """
+    conc = np.array([_float(cp.conc) for cp in compounds], dtype=np.double)
+    codes = np.array([parse_unit(cp.unit) for cp in compounds], dtype=np.int8)
+    mw = np.array([_float(cp.molecular_weight) for cp in compounds], dtype=np.double)
+    density = np.array([_float(cp.density) for cp in compounds], dtype=np.double)
+    return to_molarity(conc, codes, mw, density)
+
+def unconvertible(compounds):
+    """
+    Report the compounds whose concentration can not be converted to
+    molarity.
+
+    :param array compounds: list of compounds (:class:`cockatoo.Compound`)
+
+    :returns: dict of (unit, reason) to count where reason is "unknown unit",
+        "missing molecular weight" or "missing density"
+    """
+    report = {}
+    m = molarities(compounds)
+    for cp, val in zip(compounds, m):
+        if val == val or cp.conc is None: continue
+        code = parse_unit(cp.unit)
+        if code == UNKNOWN:
+            reason = 'unknown unit'
+        elif cp.molecular_weight is None or not cp.molecular_weight > 0:
+            reason = 'missing molecular weight'
+        else:
+            reason = 'missing density'
+        key = (cp.unit, reason)
+        report[key] = report.get(key, 0) + 1
+    return report
+
+def _float(val):
+    return np.nan if val is None else float(val)
@@ -10,7 +10,7 @@ def compute_distances():
 
     We fetch all the cocktails that produced a crystal for this sample using
     the xtuition API and compute the distance between the reference cocktail
-    from the PDB.
+    from the PDB. Each distinct cocktail is only fetched and scored once.
     """
     sample_id = 916
     ref_cocktail = reference_cocktail()
@@ -18,10 +18,18 @@ def compute_distances():
     endpoint = '/sample/' + str(sample_id) + '/list'
     r = cockatoo.xtuition.fetch_json(endpoint, payload={'crystals': '1'})
     wells = r.json()
+    cocktails = {}
     for w in wells['wells']:
-        cocktail = cockatoo.xtuition.fetch_cocktail(w['cocktail_id'])
-        score = cockatoo.metric.distance(ref_cocktail, cocktail, [1.0, 1.0])
-        print('{}: {:.5f}'.format(cocktail.name, score))
+        if w['cocktail_id'] not in cocktails:
+            cocktails[w['cocktail_id']] = cockatoo.xtuition.fetch_cocktail(w['cocktail_id'])
+
+    scores = {}
+    for w in wells['wells']:
+        cocktail = cocktails[w['cocktail_id']]
+        key = cocktail.content_hash()
+        if key not in scores:
+            scores[key] = cockatoo.metric.distance(ref_cocktail, cocktail, [1.0, 1.0])
+        print('{}: {:.5f}'.format(cocktail.name, scores[key]))
 
 def reference_cocktail():
     """
@@ -1,6 +1,8 @@
 from nose.tools import *
 import os
 import csv
+import shutil
+import tempfile
 from pinky.smiles import smilin
 import cockatoo
 from cockatoo import xtuition
@@ -19,9 +21,10 @@ class TestUtil:
         self.anion_screen = "%s/../screens/json/test-screens/anion.json" % self.path
         self.hwi_gen8 = "%s/../screens/json/hwi/hwi-gen8.json" % self.path
         self.hwi_gen8A = "%s/../screens/json/hwi/hwi-gen8A.json" % self.path
+        self.tmpdir = tempfile.mkdtemp()
 
     def teardown(self):
-        pass
+        shutil.rmtree(self.tmpdir)
 
     def test_basic(self):
         cp1 = Compound('sodium chloride', 1.0, 'M')
@@ -85,6 +88,803 @@ class TestUtil:
                 score = cockatoo.metric.distance(s.cocktails[i], s.cocktails[j], w)
                 print("\t".join([str(i),str(j),str(score)]))
 
+    def test_unique_cocktails(self):
+        import copy
+        import cockatoo.hclust
+        w = [1,1]
+        s = cockatoo.screen.load(self.salt_screen)
+        s2 = cockatoo.screen.load(self.salt_screen)
+        for i in (0, 3, 3, 7):
+            dup = copy.deepcopy(s.cocktails[i])
+            dup.name = 'dup-%s' % dup.name
+            dup.components.reverse()
+            s.add_cocktail(dup)
+
+        (unique, index, groups) = cockatoo.screen.unique_cocktails(s.cocktails)
+        assert len(unique) == 12
+        assert len(groups) == 3
+        assert [len(g) for g in groups] == [2, 3, 2]
+
+        dm = cockatoo.hclust._pdist(s, w)
+        k = 0
+        for i in range(0, len(s) - 1):
+            for j in range(i + 1, len(s)):
+                assert abs(dm[k] - cockatoo.metric.distance(s.cocktails[i], s.cocktails[j], w)) < 1e-12
+                k += 1
+
+        sum1 = sum(min(cockatoo.metric.distance(c1, c2, w) for c2 in s2.cocktails) for c1 in s.cocktails)
+        sum2 = sum(min(cockatoo.metric.distance(c1, c2, w) for c2 in s.cocktails) for c1 in s2.cocktails)
+        expected = (sum1/len(s) + sum2/len(s2)) / 2.0
+        assert abs(cockatoo.screen.distance(s, s2, w) - expected) < 1e-12
+
+        isim = sum(cockatoo.metric.distance(c1, c2, w) for c1 in s.cocktails for c2 in s.cocktails) / (len(s) ** 2)
+        assert abs(cockatoo.screen.internal_similarity(s, w) - isim) < 1e-12
+
+    def test_fingerprint_matrix(self):
+        s1 = cockatoo.screen.load(self.hwi_gen8)
+        s2 = cockatoo.screen.load(self.hwi_gen8)
+        (fps, bits) = cockatoo.screen.fingerprint_matrix(s2.cocktails)
+        assert fps.shape == (len(s2), len(bits))
+
+        for i in range(0, len(s1), 7):
+            fp1 = s1.cocktails[i].fingerprint()
+            fp2 = s2.cocktails[i].fingerprint()
+            assert sorted(fp1.keys()) == sorted(fp2.keys())
+            row = fps.getrow(i)
+            assert sorted(bits[row.indices]) == sorted(fp1.keys())
+            for k in fp1:
+                assert abs(fp1[k] - fp2[k]) < 1e-9
+
+        w = [1,1]
+        dm = cockatoo.metric.cdist(s1.cocktails[:40], s1.cocktails[100:130], w)
+        for i in range(0, 40):
+            for j in range(0, 30):
+                assert abs(dm[i,j] - cockatoo.metric.distance(s1.cocktails[i], s1.cocktails[100+j], w)) < 1e-9
+
+    def test_embedded_fingerprints(self):
+        w = [1,1]
+        s1 = cockatoo.screen.load(self.salt_screen)
+        data = s1.json(fingerprints=True)
+        s2 = cockatoo.screen.loads(data)
+        assert len(s2) == len(s1)
+        for ck in s2.cocktails:
+            for cp in ck.components:
+                assert isinstance(cp._fp, cockatoo.screen.StoredFingerprint)
+
+        for i in range(0, len(s1)):
+            assert s2.cocktails[i].fingerprint() == s1.cocktails[i].fingerprint()
+            for j in range(0, len(s1)):
+                assert cockatoo.metric.distance(s2.cocktails[i], s2.cocktails[j], w) == cockatoo.metric.distance(s1.cocktails[i], s1.cocktails[j], w)
+
+        # Fingerprints with a different version are ignored
+        s3 = cockatoo.screen.loads(data.replace(cockatoo.screen.FINGERPRINT_VERSION, 'other-version'))
+        assert not hasattr(s3.cocktails[0], '_fp')
+
+    def test_npz(self):
+        s = cockatoo.screen.load(self.hwi_gen8)
+        for fingerprints in (False, True):
+            path = os.path.join(self.tmpdir, 'hwi-gen8-%s.npz' % fingerprints)
+            cockatoo.npz.save(s, path, fingerprints)
+            for mmap in (True, False):
+                s2 = cockatoo.npz.load(path, mmap)
+                assert s2.name == s.name
+                assert len(s2) == len(s)
+                assert s2.json() == s.json()
+                assert hasattr(s2.cocktails[10], '_fp') == fingerprints
+
+            s2 = cockatoo.screen.load(path)
+            for i in range(0, len(s), 11):
+                assert s2.cocktails[i].fingerprint() == s.cocktails[i].fingerprint()
+
+    def test_bulk_convert(self):
+        import cockatoo.convert
+        bad = os.path.join(self.tmpdir, 'bad.csv')
+        with open(bad, 'w') as fh:
+            fh.write('C1,7.0,0.1,M,hepes,\n')
+            fh.write(',7.0,0.1,M,hepes,\n')
+
+        inputs = ["%s/../screens/csv/test-screens/*.csv" % self.path, bad]
+        summary = "%s/../data/hwi-compounds.csv" % self.path
+        results = cockatoo.convert.bulk_convert(inputs, os.path.join(self.tmpdir, 'out'), 'json', summary, processes=2)
+        assert len(results) == 7
+        for r in results:
+            assert r['error'] is None
+            assert len(cockatoo.screen.load(r['output'])) == r['cocktails']
+
+        assert results[-1]['cocktails'] == 1
+        assert len(results[-1]['messages']) == 1
+
+        s = cockatoo.screen.load(os.path.join(self.tmpdir, 'out', 'salt-concentration.json'))
+        assert s.cocktails[0].components[0].smiles is not None
+
+        report = os.path.join(self.tmpdir, 'report.tsv')
+        cockatoo.convert.write_report(results, report)
+        with open(report) as fh:
+            assert len(fh.readlines()) == 9
+
+        for d in ('a', 'b'):
+            os.makedirs(os.path.join(self.tmpdir, 'vendor', d))
+            shutil.copy(bad, os.path.join(self.tmpdir, 'vendor', d, 'screen.csv'))
+        found = cockatoo.convert.find_csv([os.path.join(self.tmpdir, 'vendor', '*', '*.csv'), bad, bad])
+        assert [rel for (path, rel) in found] == [os.path.join('a', 'screen'), os.path.join('b', 'screen'), 'bad']
+        same = [os.path.join(self.tmpdir, 'vendor', d, 'screen.csv') for d in ('a', 'b')]
+        assert_raises(ValueError, cockatoo.convert.find_csv, same)
+
+    def test_dmatrix_dtypes(self):
+        import numpy as np
+        import scipy.cluster.hierarchy
+        import cockatoo.hclust
+        w = [1,1]
+        s = cockatoo.screen.load(self.hwi_gen8)
+        s.cocktails = s.cocktails[:200]
+        dm = cockatoo.hclust._pdist(s, w)
+
+        Z = cockatoo.hclust.linkage(dm)
+        Zs = scipy.cluster.hierarchy.linkage(dm, method='average')
+        assert np.allclose(Z, Zs)
+
+        # The float32 nearest-neighbor chain matches scipy on the same values
+        dm32 = dm.astype(np.float32)
+        Zs32 = scipy.cluster.hierarchy.linkage(dm32.astype(np.double), method='average')
+        assert np.allclose(cockatoo.hclust.linkage(dm32), Zs32, atol=1e-6)
+        (c, d) = scipy.cluster.hierarchy.cophenet(Zs, Y=dm)
+        assert abs(cockatoo.hclust.cophenetic_correlation(Z, dm) - c) < 1e-9
+
+        for (dtype, bound) in (('float32', 1e-7), ('uint16', 0.5/65535 + 1e-12)):
+            dm2 = cockatoo.hclust._pdist(s, w, dtype)
+            assert dm2.dtype == np.dtype(dtype)
+            assert np.abs(cockatoo.dmatrix.to_float(dm2) - dm).max() <= bound
+            Z2 = cockatoo.hclust.linkage(dm2)
+            assert Z2.shape == Z.shape
+            assert abs(cockatoo.hclust.cophenetic_correlation(Z2, dm2) - c) < 1e-3
+            assert np.allclose(cockatoo.dmatrix.squareform(dm2), scipy.spatial.distance.squareform(dm), atol=1e-5)
+
+    def test_out_of_core_pdist(self):
+        import numpy as np
+        import scipy.spatial.distance
+        import cockatoo.hclust
+        w = [1,1]
+        s = cockatoo.screen.load(self.hwi_gen8)
+        s.cocktails = s.cocktails[:150] + s.cocktails[:10]
+        n = len(s)
+        dm = cockatoo.hclust._pdist(s, w)
+
+        path = os.path.join(self.tmpdir, 'test.pdist')
+        mm = cockatoo.hclust._pdist(s, w, 'float32', path, max_memory=cockatoo.metric._BYTES_PER_BLOCK_DISTANCE*150*7)
+        del mm
+        cockatoo.hclust._write_pdist_settings(path)
+        mm = cockatoo.hclust.load_pdist(path, mmap=True)
+        assert isinstance(mm, np.memmap)
+        assert np.allclose(mm, dm, atol=1e-6)
+        assert not os.path.exists(path + '.unique.tmp')
+
+        (idx, dist) = cockatoo.dmatrix.nearest(mm)
+        v = scipy.spatial.distance.squareform(dm)
+        v[np.diag_indices_from(v)] = np.inf
+        assert np.allclose(dist, v.min(axis=1), atol=1e-6)
+        assert np.allclose(v[np.arange(n), idx], dist, atol=1e-6)
+
+        groups = np.arange(n) % 4 - 1
+        sums = cockatoo.dmatrix.group_sums(mm, groups, 3)
+        v[np.diag_indices_from(v)] = 0
+        for g in range(3):
+            assert np.allclose(sums[:,g], v[:, groups == g].sum(axis=1), atol=1e-4)
+
+        # Matrices computed with another metric or fingerprint settings are refused
+        metric = cockatoo.metric.get_metric().name
+        settings = cockatoo.screen.fingerprint_settings()
+        try:
+            cockatoo.metric.set_metric('cosine')
+            assert_raises(ValueError, cockatoo.hclust.load_pdist, path)
+            cockatoo.metric.set_metric(metric)
+            cockatoo.screen.set_fingerprint_settings(cockatoo.screen.FingerprintSettings(length=1024))
+            assert_raises(ValueError, cockatoo.hclust.load_pdist, path)
+        finally:
+            cockatoo.metric.set_metric(metric)
+            cockatoo.screen.set_fingerprint_settings(settings)
+
+        # A temporary out-of-core matrix is removed with the result
+        tempdir = tempfile.tempdir
+        try:
+            tempfile.tempdir = self.tmpdir
+            with cockatoo.hclust.run(s, w, 0.5, dtype='float32', max_memory=cockatoo.dmatrix.nbytes(n, 'float32')) as result:
+                assert result.pdist_path.startswith(self.tmpdir)
+                assert np.allclose(result.dm, dm, atol=1e-6)
+                temp_path = result.pdist_path
+            assert not os.path.exists(temp_path)
+            assert result.dm is None
+        finally:
+            tempfile.tempdir = tempdir
+        assert [f for f in os.listdir(self.tmpdir) if f.endswith('.pdist')] == ['test.pdist']
+
+        assert cockatoo.dmatrix.parse_memory('8G') == 8 << 30
+        assert cockatoo.dmatrix.parse_memory('512m') == 512 << 20
+
+    def test_sketch_search(self):
+        import numpy as np
+        import cockatoo.sketch
+        s = cockatoo.screen.load(self.hwi_gen8)
+        idx = cockatoo.sketch.SketchIndex(s.cocktails, 64, 16)
+        assert idx.sketches.shape == (len(s), 64)
+
+        i, j = 0, 1
+        est = cockatoo.sketch.estimate_distance(idx.sketches[i], idx.sketches[j])
+        exact = cockatoo.metric._braycurtis(s.cocktails[i].fingerprint(), s.cocktails[j].fingerprint())
+        assert abs(est - exact) < 0.2
+
+        res = idx.query(s.cocktails[10], k=3)
+        assert len(res) == 3
+        assert res[0][0] == 10 or res[0][1] < 1e-9
+        assert abs(res[1][1] - cockatoo.metric.distance(s.cocktails[10], s.cocktails[res[1][0]])) < 1e-9
+
+        path = os.path.join(self.tmpdir, 'index.npz')
+        idx.save(path)
+        idx2 = cockatoo.sketch.load(path, s.cocktails)
+        assert np.array_equal(idx2.sketches, idx.sketches)
+        assert idx2.query(s.cocktails[10], k=3) == res
+
+    def test_sparse_fingerprint(self):
+        from cockatoo import metric
+        s = cockatoo.screen.load(self.hwi_gen8)
+        cks = s.cocktails[:40]
+        for ck1 in cks:
+            for ck2 in cks:
+                d1 = metric._braycurtis(ck1.fingerprint(), ck2.fingerprint())
+                d2 = metric._braycurtis_sorted(ck1.sparse_fingerprint(), ck2.sparse_fingerprint())
+                assert abs(d1 - d2) < 1e-12
+
+        ck = cks[0]
+        fp = ck.sparse_fingerprint()
+        assert list(fp.bits) == sorted(ck.fingerprint().keys())
+        assert ck.sparse_fingerprint() is fp
+        ck._fp = {1: 2.0}
+        assert list(ck.sparse_fingerprint().bits) == [1]
+        assert metric.fp_distance(ck, Cocktail('empty')) is None
+
+    def test_diversity_select(self):
+        import numpy as np
+        from cockatoo import metric
+        import cockatoo.diversity
+        s = cockatoo.screen.load(self.hwi_gen8)
+        s.cocktails = s.cocktails[:200]
+        D = metric.cdist(s.cocktails, s.cocktails)
+
+        arrays = metric._row_arrays(s.cocktails)
+        assert np.allclose(metric._row_distances(7, arrays, [1,1]), D[7])
+
+        (selected, dist) = cockatoo.diversity.max_min(s.cocktails, 20, required=[3])
+        assert selected[0] == 3
+        assert len(set(selected)) == 20
+        for m in range(1, 20):
+            nearest = D[selected[:m]].min(axis=0)
+            nearest[selected[:m]] = -1
+            assert abs(dist[m] - nearest.max()) < 1e-12
+
+        sub = cockatoo.diversity.select(s, 5, required=[s.cocktails[3].name], name='sub')
+        assert sub.name == 'sub'
+        assert sub.cocktails[0] is s.cocktails[3]
+        assert_raises(ValueError, cockatoo.diversity.select, s, 5, None, ['nope'])
+
+    def test_medoids(self):
+        import numpy as np
+        import scipy.spatial.distance
+        import cockatoo.hclust
+        s = cockatoo.screen.load(self.hwi_gen8)
+        s.cocktails = s.cocktails[:150]
+        dm = cockatoo.hclust._pdist(s, [1,1])
+        v = scipy.spatial.distance.squareform(dm)
+        clusters = [i % 7 + 1 for i in range(len(s))]
+
+        meds = cockatoo.hclust.medoids(dm, clusters)
+        assert len(meds) == 7
+        for (cl, i, size, radius, diameter, mean) in meds:
+            rec = [j for j in range(len(s)) if clusters[j] == cl]
+            sub = v[np.ix_(rec, rec)]
+            assert i == rec[np.argmin(sub.sum(axis=1))]
+            assert size == len(rec)
+            assert abs(radius - v[i, rec].max()) < 1e-12
+            assert abs(diameter - sub.max()) < 1e-12
+
+        (refined, labels) = cockatoo.hclust.refine_medoids(dm, [m[1] for m in meds])
+        cost = lambda m: v[m].min(axis=0).sum()
+        assert cost(refined) <= cost([m[1] for m in meds]) + 1e-12
+        assert np.array_equal(labels, np.argmin(v[refined], axis=0))
+
+        rep = cockatoo.hclust.representatives(s, dm, clusters)
+        assert len(rep) == 7
+        assert rep.cocktails[0] is s.cocktails[meds[0][1]]
+
+    def test_cluster_model(self):
+        import numpy as np
+        from cockatoo import metric
+        import cockatoo.model
+        s = cockatoo.screen.load(self.hwi_gen8)
+        s.cocktails = s.cocktails[:100]
+        clusters = [i % 5 + 1 for i in range(len(s))]
+        w = [1,1]
+        m = cockatoo.model.build(s, clusters, 0.3, w)
+
+        new = cockatoo.screen.load(self.hwi_gen8).cocktails[200]
+        d = metric.cdist([new], s.cocktails, w)[0]
+        assert np.allclose(m.distances(new), d)
+
+        avg = [d[np.array(clusters) == c].mean() for c in range(1, 6)]
+        (cl, dist, medoid, novel) = m.assign(new)
+        assert cl == np.argmin(avg) + 1
+        assert abs(dist - min(avg)) < 1e-12
+        assert novel == (dist > 0.3)
+        assert clusters[medoid] == cl
+
+        path = os.path.join(self.tmpdir, 'test.model.npz')
+        m.save(path)
+        m2 = cockatoo.model.load(path)
+        assert m2.names == [ck.name for ck in s.cocktails]
+        assert m2.assign(new) == (cl, dist, medoid, novel)
+
+        settings = cockatoo.screen.fingerprint_settings()
+        try:
+            cockatoo.screen.set_fingerprint_settings(cockatoo.screen.FingerprintSettings(length=1024))
+            assert_raises(ValueError, cockatoo.model.load, path)
+        finally:
+            cockatoo.screen.set_fingerprint_settings(settings)
+
+    def test_cluster_result(self):
+        import cockatoo.hclust
+        s = cockatoo.screen.load(self.hwi_gen8)
+        s.cocktails = s.cocktails[:120]
+        cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        try:
+            res = cockatoo.hclust.run(s, [1,1], 0.7, stats=True)
+            assert os.listdir(self.tmpdir) == []
+        finally:
+            os.chdir(cwd)
+
+        assert len(res.clusters) == len(s)
+        assert res.Z.shape == (len(s) - 1, 4)
+        assert abs(res.cutoff - 0.7*res.max_dist) < 1e-12
+        assert res.stats['clusters'] == len(set(res.clusters))
+        assert res.newick().endswith(';')
+        assert len(res.representatives()) == res.stats['clusters']
+
+        base = os.path.join(self.tmpdir, 'test')
+        res.write(base, newick=True, medoids=True)
+        cockatoo.hclust._write_pdist(res.dm, base)
+        assert os.path.exists(base + '.pdist.json')
+        assert (cockatoo.hclust.load_pdist(base + '.pdist') == res.dm).all()
+        assert os.path.exists(base + '.clusters')
+        assert os.path.exists(base + '.medoids')
+        with open(base + '.newick') as fh:
+            assert fh.read() == res.newick()
+
+    def test_server(self):
+        import json
+        import threading
+        import cockatoo.server
+        try:
+            from http.client import HTTPConnection
+        except ImportError:
+            from httplib import HTTPConnection
+        from cockatoo import metric
+        s = cockatoo.screen.load(self.hwi_gen8)
+        service = cockatoo.server.Service([s])
+
+        with open(self.test_cocktail) as fh:
+            ck = json.load(fh)
+        res = service.handle('cdist', {'cocktails1': [{'screen': s.name, 'cocktail': '8_C0001'}], 'cocktails2': [{'screen': s.name, 'cocktail': '8_C0002'}, ck]})
+        assert abs(res['distances'][0][0] - metric.distance(s.cocktails[0], s.cocktails[1])) < 1e-12
+
+        res = service.handle('nearest', {'screen': s.name, 'cocktails': [ck], 'k': 2})
+        assert res[0]['nearest'][0]['cocktail'] == '8_C0160'
+        # Cached matrices are shared by request threads and never resized
+        assert service._arrays[s.name][1].shape[1] == cockatoo.screen.fingerprint_settings().length
+        assert_raises(ValueError, service.handle, 'isim', {'screen': 'missing'})
+
+        server = cockatoo.server.make_server(service, port=0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            conn = HTTPConnection('127.0.0.1', server.server_address[1])
+            conn.request('POST', '/isim', json.dumps({'screen': s.name}))
+            resp = conn.getresponse()
+            assert resp.status == 200
+            score = json.loads(resp.read().decode('utf-8'))['result']['internal_similarity']
+            assert abs(score - cockatoo.screen.internal_similarity(s, [1,1])) < 1e-12
+
+            conn.request('POST', '/nearest', '{bad json')
+            resp = conn.getresponse()
+            assert resp.status == 400
+            resp.read()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_incidence_query(self):
+        import numpy as np
+        import cockatoo.query
+        s = cockatoo.screen.load(self.hwi_gen8)
+        s2 = cockatoo.screen.load(self.ph_screen)
+        inc = cockatoo.query.Incidence([s, s2])
+        assert len(inc) == len(s) + len(s2)
+
+        mask = inc.filter(['PEG 3350 > 20 % (w/v)'], '>7')
+        expected = [any(cp.name == 'peg 3350' and cp.unit == '% (w/v)' and cp.conc > 20 for cp in ck.components) and ck.ph is not None and ck.ph > 7 for ck in inc.cocktails]
+        assert np.array_equal(mask, expected)
+        assert mask.sum() > 0
+
+        mask = inc.filter(['sodium chloride >= 1 M'], screen=s.name)
+        expected = [any(cp.name == 'sodium chloride' and cp.molarity() >= 1 for cp in ck.components) for ck in s.cocktails]
+        assert np.array_equal(mask[:len(s)], expected)
+        assert not mask[len(s):].any()
+
+        counts = inc.counts()
+        assert counts[inc.compound('peg 3350')] == sum(1 for ck in inc.cocktails for cp in ck.components if cp.name == 'peg 3350')
+        co = inc.cooccurrence()
+        (a, b) = (inc.compound('peg 3350'), inc.compound('hepes'))
+        assert co[a, b] == sum(1 for ck in inc.cocktails if set(['peg 3350', 'hepes']) <= set(cp.name for cp in ck.components))
+
+        (hist, edges) = inc.histogram('peg 3350', 5, '% (w/v)')
+        assert hist.sum() == sum(1 for ck in inc.cocktails for cp in ck.components if cp.name == 'peg 3350' and cp.unit == '% (w/v)')
+        assert cockatoo.query.parse_condition('hepes') == ('hepes', None, None, None)
+        assert_raises(ValueError, inc.filter, ['unobtainium'])
+
+        # Units are compared by code and through the molar concentration
+        assert np.array_equal(inc.filter(['PEG 3350 > 20 w/v']), inc.filter(['PEG 3350 > 20 % (w/v)']))
+        ck1 = Cocktail('c1')
+        ck1.add_compound(Compound('peg 3350', 250, 'mg/mL', molecular_weight=3350.0))
+        ck1.add_compound(Compound('hepes', 100, 'mM'))
+        ck2 = Cocktail('c2')
+        ck2.add_compound(Compound('peg 3350', 15, '% (w/v)', molecular_weight=3350.0))
+        ck2.add_compound(Compound('hepes', 0.01, 'M'))
+        inc = cockatoo.query.Incidence([Screen('units', [ck1, ck2])])
+        assert list(inc.filter(['peg 3350 > 20 % (w/v)'])) == [True, False]
+        assert list(inc.filter(['hepes >= 50000 uM'])) == [True, False]
+        assert list(inc.filter(['hepes < 50 mM'])) == [False, True]
+        assert np.allclose(np.sort(inc._in_unit(inc._entries(inc.compound('peg 3350')), 'mg/mL')), [150, 250])
+        assert_raises(ValueError, inc.filter, ['hepes > 1 furlongs'])
+
+    def test_units(self):
+        import numpy as np
+        from cockatoo import units
+        assert units.parse_unit('% (w/v)') == units.PERCENT_WV
+        assert units.parse_unit('%w/v') == units.PERCENT_WV
+        assert units.parse_unit('M') == units.MOLAR
+        assert units.parse_unit('mM') == units.MILLIMOLAR
+        assert units.parse_unit('mg/mL') == units.MG_PER_ML
+        assert units.parse_unit('furlongs') == units.UNKNOWN
+
+        assert Compound('sodium chloride', 200, 'mM').molarity() == 0.2
+        assert abs(Compound('peg 3350', 25, '% (w/v)', molecular_weight=3350).molarity() - 250/3350.) < 1e-12
+        assert abs(Compound('glycerol', 10, '% (v/v)', molecular_weight=92.09, density=1.26).molarity() - 0.1*1.26/92.09*1000) < 1e-12
+        assert abs(Compound('lysozyme', 5, 'mg/mL', molecular_weight=14300).molarity() - 5/14300.) < 1e-12
+        assert Compound('glycerol', 10, '% (v/v)', molecular_weight=92.09).molarity() is None
+        assert Compound('x', 1, 'furlongs').molarity() is None
+
+        cps = [Compound('a', 1, 'M'), Compound('b', 2, 'furlongs'), Compound('c', 3, '% (w/v)')]
+        assert np.allclose(units.molarities(cps), [1, np.nan, np.nan], equal_nan=True)
+        report = units.unconvertible(cps)
+        assert report == {('furlongs', 'unknown unit'): 1, ('% (w/v)', 'missing molecular weight'): 1}
+
+        s = cockatoo.screen.load(self.hwi_gen8)
+        cps = [cp for ck in s.cocktails for cp in ck.components]
+        expected = [np.nan if cp.molarity() is None else cp.molarity() for cp in cps]
+        assert np.allclose(units.molarities(cps), expected, equal_nan=True)
+
+    def test_mixture(self):
+        from cockatoo.screen import Mixture
+        ck = cockatoo.screen._parse_cocktail_csv(['A1', '7.0', '10', '% v/v', 'Tacsimate', '7.0', '0.1', 'M', 'sodium chloride', ''])
+        assert len(ck) == 2
+        assert isinstance(ck.components[0], Mixture)
+        assert ck.components[0].mixture.name == 'tacsimate'
+        assert len(ck.components[0].components()) == 7
+        assert abs(ck.components[0].components()[0].conc - 1.8305 * 0.1) < 1e-12
+        assert cockatoo.screen._parse_cocktail_csv(['A1', '7.0', '10', 'M', 'Tacsimate', '7.0']) is None
+
+        ck.components[1].smiles = '[Na+].[Cl-]'
+        expanded = Cocktail('expanded', 7.0, ck.components[0].components() + [ck.components[1]])
+        fp1 = ck.fingerprint()
+        fp2 = expanded.fingerprint()
+        assert set(fp1) == set(fp2)
+        for k in fp1:
+            assert abs(fp1[k] - fp2[k]) < 1e-9
+
+        assert ck.components[0].fingerprint() is ck.components[0].mixture.fingerprint()
+        del ck._fp
+        (fps, bits) = cockatoo.screen.fingerprint_matrix([ck, expanded])
+        assert abs(fps[0] - fps[1]).max() < 1e-9
+
+        s = cockatoo.screen.loads(Screen('mix', [ck]).json())
+        assert isinstance(s.cocktails[0].components[0], Mixture)
+
+    def test_mixture_registry_fallback(self):
+        import cockatoo.mixture
+        default_path = cockatoo.mixture.DEFAULT_PATH
+        registry = cockatoo.mixture._registry
+        try:
+            cockatoo.mixture._registry = None
+            cockatoo.mixture.DEFAULT_PATH = os.path.join(self.tmpdir, 'missing.csv')
+            ck = cockatoo.screen._parse_cocktail_csv(['A1', '7.0', '10', '% v/v', 'Tacsimate', '7.0'])
+            mixture = ck.components[0]
+            assert mixture.mixture.name == 'tacsimate'
+            assert len(mixture.fingerprint().counts) > 0
+            assert mixture.fingerprint() is mixture.mixture.fingerprint()
+
+            expected = cockatoo.mixture.load(default_path)
+            assert [m.name for m in cockatoo.mixture.builtin()] == [m.name for m in expected]
+            for (a, b) in zip(cockatoo.mixture.builtin()[0].components, expected[0].components):
+                assert (a.name, a.conc, a.unit, a.smiles, a.molecular_weight) == (b.name, b.conc, b.unit, b.smiles, b.molecular_weight)
+
+            assert_raises(ValueError, cockatoo.mixture.set_registry, cockatoo.mixture.DEFAULT_PATH)
+        finally:
+            cockatoo.mixture.DEFAULT_PATH = default_path
+            cockatoo.mixture._registry = registry
+
+    def test_embedded_mixture_fingerprints(self):
+        import sys
+        import numpy as np
+        from cockatoo.screen import Mixture
+        s = cockatoo.screen.parse_csv('hwi-gen8', "%s/../screens/csv/hwi/hwi-gen8.csv" % self.path)
+        s._set_summary_data(cockatoo.screen.load_summary("%s/../data/hwi-compounds.csv" % self.path))
+        mixed = [ck for ck in s.cocktails if any(isinstance(cp, Mixture) for cp in ck.components)]
+        assert len(mixed) > 0
+        s.cocktails = mixed[:5] + s.cocktails[:5]
+        D = cockatoo.metric.cdist(s.cocktails, s.cocktails)
+        paths = [os.path.join(self.tmpdir, 'mixed.json'), os.path.join(self.tmpdir, 'mixed.npz')]
+        for path in paths:
+            cockatoo.screen.save(s, path, fingerprints=True)
+
+        # Loading and comparing must not fingerprint anything with RDKit/e3fp
+        blocked = ['rdkit', 'rdkit.Chem', 'e3fp', 'e3fp.fingerprint', 'e3fp.fingerprint.fprint']
+        modules = dict((m, sys.modules[m]) for m in blocked if m in sys.modules)
+        fp_cache = dict(cockatoo.screen._fp_cache)
+        tacsimate = cockatoo.mixture.find('tacsimate')
+        mixture_fp = tacsimate.__dict__.pop('_fp', None)
+        try:
+            for m in blocked:
+                sys.modules[m] = None
+            cockatoo.screen._fp_cache.clear()
+            for path in paths:
+                s2 = cockatoo.screen.load(path)
+                assert any(isinstance(cp, Mixture) for cp in s2.cocktails[0].components)
+                assert np.allclose(cockatoo.metric.cdist(s2.cocktails, s2.cocktails), D)
+        finally:
+            for m in blocked:
+                sys.modules.pop(m)
+            sys.modules.update(modules)
+            cockatoo.screen._fp_cache.update(fp_cache)
+            if mixture_fp is not None:
+                tacsimate._fp = mixture_fp
+
+    def test_fingerprint_settings(self):
+        import numpy as np
+        from cockatoo.screen import FingerprintSettings
+        default = cockatoo.screen.fingerprint_settings()
+        assert default.version() == cockatoo.screen.FINGERPRINT_VERSION
+        assert FingerprintSettings(3, 1024, True).version() != default.version()
+        assert FingerprintSettings(dense=True).version() == default.version()
+
+        s = cockatoo.screen.load(self.hwi_gen8)
+        cks = s.cocktails[:100]
+        sparse = cockatoo.metric.pdist(cks)
+        dense = cockatoo.screen.dense_fingerprint_matrix(cks)
+        assert dense.shape == (100, default.length)
+        (fps, bits) = cockatoo.screen.fingerprint_matrix(cks)
+        assert np.allclose(dense[:, bits], fps.toarray())
+
+        try:
+            cockatoo.screen.set_fingerprint_settings(FingerprintSettings(dense=True))
+            assert np.allclose(cockatoo.metric.pdist(cks), sparse)
+
+            cockatoo.screen.set_fingerprint_settings(FingerprintSettings(radius=1, length=256, counts=True))
+            cp = Compound('malonic acid', 1.0, 'M', smiles='C(C(=O)O)C(=O)O')
+            counts = cp.fingerprint().counts
+            assert max(counts) < 256
+            assert max(counts.values()) > 1
+            ck = Cocktail('tacsimate', 7.0, [cockatoo.screen._parse_mixture(Compound('tacsimate', 10, '% (v/v)'))])
+            assert max(ck.fingerprint()) < 256
+        finally:
+            cockatoo.screen.set_fingerprint_settings(default)
+
+    def test_metric_registry(self):
+        import numpy as np
+        import scipy.spatial.distance
+        from cockatoo import metric
+        s = cockatoo.screen.load(self.hwi_gen8)
+        cks = s.cocktails[:40]
+        (fps, bits) = cockatoo.screen.fingerprint_matrix(cks)
+        dense = fps.toarray()
+        expected = {
+            'braycurtis': scipy.spatial.distance.cdist(dense, dense, 'braycurtis'),
+            'cosine': scipy.spatial.distance.cdist(dense, dense, 'cosine'),
+            'tanimoto': scipy.spatial.distance.cdist(dense > 0, dense > 0, 'jaccard'),
+        }
+        try:
+            for name in sorted(metric.METRICS):
+                metric.set_metric(name)
+                D = metric.cdist(cks, cks, [0, 1])
+                assert np.allclose(np.diag(D), 0)
+                pairs = np.array([[metric.distance(a, b, [0, 1]) for b in cks] for a in cks])
+                assert np.allclose(D, pairs)
+                arrays = metric._row_arrays(cks)
+                assert np.allclose(metric._row_distances(5, arrays, [0, 1]), D[5])
+                assert np.allclose(scipy.spatial.distance.squareform(metric.pdist(cks, [0, 1])), D - np.diag(np.diag(D)))
+                if name in expected:
+                    assert np.allclose(D, expected[name])
+        finally:
+            metric.set_metric('braycurtis')
+
+        try:
+            metric.get_metric('nope')
+            assert False
+        except ValueError:
+            pass
+
+    def test_approx(self):
+        import cockatoo.approx
+        s1 = cockatoo.screen.load(self.hwi_gen8)
+        s2 = cockatoo.screen.load(self.hwi_gen8A)
+        s1.cocktails = s1.cocktails[:400]
+        s2.cocktails = s2.cocktails[200:600]
+        w = [1.0, 1.0]
+
+        exact = cockatoo.screen.internal_similarity(s1, w)
+        (score, half_width, samples) = cockatoo.approx.internal_similarity(s1, w, tolerance=0.01)
+        assert half_width <= 0.01
+        assert samples < len(s1)
+        assert abs(score - exact) <= 2 * half_width
+        (score, half_width, samples) = cockatoo.approx.internal_similarity(s1, w, tolerance=0)
+        assert half_width == 0 and samples == len(s1)
+        assert abs(score - exact) < 1e-9
+
+        exact = cockatoo.screen.distance(s1, s2, w)
+        (score, half_width, samples) = cockatoo.approx.distance(s1, s2, w, tolerance=0.02)
+        assert half_width <= 0.02
+        assert abs(score - exact) <= 2 * half_width
+        (score, half_width, samples) = cockatoo.approx.distance(s1, s2, w, tolerance=0)
+        assert half_width == 0 and samples == len(s1) + len(s2)
+        assert abs(score - exact) < 1e-9
+
+    def test_distance_mapping(self):
+        import io
+        import numpy as np
+        s1 = cockatoo.screen.load(self.hwi_gen8)
+        s2 = cockatoo.screen.load(self.hwi_gen8A)
+        s1.cocktails = s1.cocktails[:100] + s1.cocktails[:5]
+        s2.cocktails = s2.cocktails[50:150]
+        w = [1.0, 1.0]
+
+        (score, mapping) = cockatoo.screen.distance_mapping(s1, s2, w)
+        assert score == cockatoo.screen.distance(s1, s2, w)
+        assert len(mapping) == len(s1) + len(s2)
+
+        D = cockatoo.metric.cdist(s1.cocktails, s2.cocktails, w)
+        names2 = [ck.name for ck in s2.cocktails]
+        for i, row in enumerate(mapping[:len(s1)]):
+            assert row[0] == s1.name and row[1] == s1.cocktails[i].name
+            assert abs(row[4] - D[i].min()) < 1e-9
+            assert abs(D[i, names2.index(row[3])] - row[4]) < 1e-9
+            assert abs(cockatoo.metric._combine(np.array([row[5] if row[5] is not None else np.nan]), np.array([row[6] if row[6] is not None else np.nan]), w)[0] - row[4]) < 1e-9
+        for j, row in enumerate(mapping[len(s1):]):
+            assert row[1] == s2.cocktails[j].name
+            assert abs(row[4] - D[:, j].min()) < 1e-9
+
+        out = io.StringIO()
+        cockatoo.screen.write_mapping(mapping, out)
+        lines = out.getvalue().splitlines()
+        assert len(lines) == len(mapping) + 1
+        assert lines[0].split('\t')[4] == 'distance'
+
+    def test_hits(self):
+        import numpy as np
+        import cockatoo.hits
+        s = cockatoo.screen.load(self.hwi_gen8)
+        lib = cockatoo.screen.load(self.hwi_gen8A)
+        names = cockatoo.hits.load('%s/../data/X000009786-crystals.txt' % self.path)
+        s.cocktails = s.cocktails[:300]
+        w = [1.0, 1.0]
+
+        hits = cockatoo.hits.hit_indices(s, names + ['no-such-well'])
+        assert len(hits) > 0 and all(s.cocktails[h].name in names for h in hits)
+
+        clusters = [i % 7 for i in range(len(s))]
+        result = cockatoo.hits.analyze(s, names, w, clusters=clusters, library=lib.cocktails[:200], top=10)
+        D = cockatoo.metric.cdist(s.cocktails, [s.cocktails[h] for h in hits], w)
+        assert np.allclose(result.distance, D.min(axis=1))
+        assert np.all(result.distance[hits] < 1e-9)
+
+        assert sum(r[1] for r in result.enrichment) == len(s)
+        assert sum(r[2] for r in result.enrichment) == len(hits)
+        assert abs(sum(r[3] for r in result.enrichment) - len(hits)) < 1e-9
+
+        tried = set(ck.content_hash() for ck in s.cocktails)
+        assert len(result.candidates) <= 10
+        dists = [r[2] for r in result.candidates]
+        assert dists == sorted(dists)
+        for (i, h, dist) in result.candidates:
+            assert lib.cocktails[i].content_hash() not in tried
+            assert h in hits
+
+    def test_consensus(self):
+        import numpy as np
+        import cockatoo.hclust
+        import cockatoo.consensus
+        s = cockatoo.screen.load(self.hwi_gen8)
+        s.cocktails = s.cocktails[:150] + s.cocktails[:3]
+        w = [1.0, 1.0]
+        dm = cockatoo.hclust._pdist(s, w)
+        reference = cockatoo.hclust.run(s, w, 0.7, dm).clusters
+
+        # Without resampling every replicate is the full clustering
+        r = cockatoo.consensus.run(s, w, 0.7, replicates=2, well_fraction=1.0, bit_fraction=1.0, bit_groups=4, reference=reference, processes=1)
+        same = np.array([reference[i] == reference[j] for i in range(len(s)) for j in range(i + 1, len(s))])
+        assert np.array_equal(r.consensus, same.astype(np.float32))
+        assert np.all(r.sampled == 2)
+        assert np.allclose(r.stability, 1.0)
+
+        r1 = cockatoo.consensus.run(s, w, 0.7, replicates=6, dm=dm, reference=reference, processes=1, seed=3)
+        r2 = cockatoo.consensus.run(s, w, 0.7, replicates=6, dm=dm, reference=reference, processes=2, seed=3)
+        assert np.array_equal(r1.consensus, r2.consensus)
+        assert r1.consensus.min() >= 0 and r1.consensus.max() <= 1
+        assert len(set(r1.clusters)) == len(set(reference))
+        assert sum(c[1] for c in r1.cluster_stability()) == len(s)
+
+    def test_embed(self):
+        import numpy as np
+        import scipy.spatial.distance
+        import cockatoo.embed
+
+        # Points in a plane are recovered up to rotation
+        X = np.random.RandomState(0).rand(30, 2)
+        D = scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(X))
+        (coords, vals, explained) = cockatoo.embed.classical_mds(D)
+        assert np.allclose(scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(coords)), D)
+        assert abs(explained - 1.0) < 1e-9
+
+        s = cockatoo.screen.load(self.hwi_gen8)
+        s.cocktails = s.cocktails[:200]
+        w = [1.0, 1.0]
+        e = cockatoo.embed.embed(s, w)
+        assert e.method == 'classical' and e.coords.shape == (len(s), 2)
+
+        # With every cocktail as a landmark landmark MDS is classical MDS
+        (coords, vals, explained) = cockatoo.embed.landmark_mds(s.cocktails, np.arange(len(s)), w, block_size=64)
+        assert np.allclose(np.abs(coords), np.abs(e.coords))
+
+        e = cockatoo.embed.embed(s, w, 'landmark', landmarks=50)
+        assert len(e.landmarks) == 50 and np.all(np.isfinite(e.coords))
+
+    def test_pipeline(self):
+        import numpy as np
+        import cockatoo.hits
+        import cockatoo.pipeline
+
+        # Results are in input order whatever order the workers finish in
+        p = cockatoo.pipeline.Pipeline([cockatoo.pipeline.Stage(abs, 4), cockatoo.pipeline.Stage(abs, 2, True)], buffer=3)
+        assert list(p.run(range(-50, 0))) == list(range(50, 0, -1))
+
+        try:
+            list(cockatoo.pipeline.load_screens([self.ph_screen, '/no/such/screen.json']))
+            assert False
+        except IOError:
+            pass
+
+        paths = [self.ph_screen, self.anion_screen, self.peg_screen]
+        w = [1.0, 1.0]
+        (names, M) = cockatoo.pipeline.distance_matrix(paths, w, processes=2)
+        screens = [cockatoo.screen.load(path) for path in paths]
+        assert names == [sc.name for sc in screens]
+        for i in range(len(paths)):
+            for j in range(len(paths)):
+                expected = cockatoo.screen.distance(screens[i], screens[j], w) if i != j else 0.0
+                assert abs(M[i,j] - expected) < 1e-9
+
+        s = cockatoo.screen.load(self.hwi_gen8)
+        hits = s.cocktails[:20]
+        (idx1, dist1) = cockatoo.pipeline.nearest(s.cocktails[:500], hits, w, processes=2, block_size=128)
+        (idx2, dist2) = cockatoo.hits.nearest(s.cocktails[:500], hits, w)
+        assert np.allclose(dist1, dist2)
+
     def test_xtuition(self):
         if 'XTUITION_TOKEN' in os.environ:
             s = xtuition.fetch_screen(6)